@@ -0,0 +1,106 @@
+"""
+Measure the import time of the plugin entry point, as paid by every certbot
+invocation, with and without the lazily imported client.
+
+Each variant is imported in fresh interpreters with ``python -X importtime``.
+The median total import time is written as JSON, by default to
+reports/bench/import_time.json::
+
+    poetry run bench-import --runs 20
+"""
+import argparse
+import datetime
+import json
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Set, Tuple
+
+DEFAULT_OUTPUT = "reports/bench/import_time.json"
+PACKAGE = "certbot_dns_ispconfig_ddns"
+
+VARIANTS = {
+    # what certbot itself imports for any dns plugin
+    "certbot": ["certbot.plugins.dns_common"],
+    # what certbot imports for this plugin's entry point
+    "entry-point": [f"{PACKAGE}.authenticator"],
+    # the entry point with the client loaded eagerly, as before
+    "entry-point-eager": [f"{PACKAGE}.authenticator",
+                          f"{PACKAGE}.ispconfig_client"],
+}
+
+
+def measure(modules: List[str]) -> Tuple[float, Set[str]]:
+    """
+    Import modules in a fresh interpreter.
+
+    :param modules: the modules to import
+    :return: the total import time in milliseconds, and the names of all
+             imported modules
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c",
+         f"import {', '.join(modules)}"],
+        stderr=subprocess.PIPE, text=True, check=True
+    )
+    total_us = 0
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        if not self_us.strip().isdigit():
+            continue  # header line
+        total_us += int(self_us)
+        imported.add(name.strip())
+    return total_us / 1000, imported
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=10,
+                        help="fresh interpreters per variant")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT,
+                        help="JSON report path (default: %(default)s)")
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    results: Dict[str, Dict] = {}
+    for name, modules in VARIANTS.items():
+        measure(modules)  # warm up the filesystem and bytecode caches
+        timings = []
+        for _ in range(args.runs):
+            milliseconds, imported = measure(modules)
+            timings.append(milliseconds)
+        results[name] = {
+            "modules": modules,
+            "median_ms": round(statistics.median(timings), 3),
+            "min_ms": round(min(timings), 3),
+            "plugin_modules": sorted(m for m in imported
+                                     if m.startswith(PACKAGE + ".")),
+            "imports_requests": "requests" in imported,
+        }
+        print(f"{name:>18}: median {results[name]['median_ms']:8.2f} ms, "
+              f"min {results[name]['min_ms']:8.2f} ms")
+
+    base = results["certbot"]["median_ms"]
+    for name in ("entry-point", "entry-point-eager"):
+        results[name]["over_certbot_ms"] = round(
+            results[name]["median_ms"] - base, 3
+        )
+    report = {
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "runs": args.runs,
+        "results": results,
+    }
+    output = pathlib.Path(args.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2) + "\n")
+    print(f"Report written to {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
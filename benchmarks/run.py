@@ -0,0 +1,265 @@
+"""
+Benchmark the ISPConfig DDNS client and authenticator against a local stub
+server.
+
+Every scenario adds and deletes the TXT records of N domains. The results
+(ops/sec and p50/p95/p99 request latency per scenario and N) are written as
+JSON, by default to reports/bench/results.json::
+
+    poetry run bench --sizes 1,10,100,1000 --latency 0.005 --error-rate 0.01
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import pathlib
+import platform
+import sys
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Tuple
+
+import requests
+from certbot._internal.display import obj as display_obj
+
+from benchmarks.stub_server import StubDDNSServer
+from certbot_dns_ispconfig_ddns.authenticator import Authenticator
+from certbot_dns_ispconfig_ddns.ispconfig_client import ISPConfigBulkError, \
+    ISPConfigClient, ISPConfigClientError
+from certbot_dns_ispconfig_ddns.metrics import percentile
+from certbot_dns_ispconfig_ddns.retry import RetryPolicy
+from tests.util import achall
+
+DEFAULT_OUTPUT = "reports/bench/results.json"
+PLUGIN_NAME = "dns-ispconfig-ddns"
+TOKEN = "bench-token"
+
+
+class LatencyRecorder:
+    """
+    Records the duration of every HTTP request sent through requests.
+    """
+
+    def __init__(self) -> None:
+        self.samples: List[float] = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def installed(self) -> Iterator["LatencyRecorder"]:
+        original = requests.Session.request
+        recorder = self
+
+        def request(session, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return original(session, *args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                with recorder._lock:
+                    recorder.samples.append(elapsed)
+
+        requests.Session.request = request
+        try:
+            yield self
+        finally:
+            requests.Session.request = original
+
+
+def _records(n: int) -> List[Tuple[str, str]]:
+    return [(f"_acme-challenge.d{i}.bench.example", f"validation-{i}")
+            for i in range(n)]
+
+
+def _client(server: StubDDNSServer, args) -> ISPConfigClient:
+    return ISPConfigClient(
+        endpoint=server.endpoint, token=TOKEN, pool_maxsize=args.pool_size,
+        retry_policy=RetryPolicy(retries=args.retries, backoff_factor=0.01)
+    )
+
+
+def bench_client_serial(server: StubDDNSServer, n: int, args) -> int:
+    """Add and delete the records one after another."""
+    failed = 0
+    with _client(server, args) as client:
+        for send in (client.set_txt_record, client.del_txt_record):
+            for record in _records(n):
+                try:
+                    send(*record)
+                except ISPConfigClientError:
+                    failed += 1
+    return failed
+
+
+def bench_client_bulk(server: StubDDNSServer, n: int, args) -> int:
+    """Add and delete the records with the bulk API."""
+    failed = 0
+    with _client(server, args) as client:
+        for send in (client.set_txt_records, client.del_txt_records):
+            try:
+                send(_records(n), max_workers=args.max_workers)
+            except ISPConfigBulkError as e:
+                failed += len(e.failures)
+    return failed
+
+
+def bench_authenticator(server: StubDDNSServer, n: int, args) -> int:
+    """Run perform and cleanup of the certbot authenticator."""
+    authenticator = Authenticator(_plugin_config(
+        endpoint=server.endpoint, token=TOKEN, propagation_seconds=0,
+        pool_size=args.pool_size, max_workers=args.max_workers,
+        retries=args.retries
+    ), PLUGIN_NAME)
+    achalls = [achall(f"d{i}.bench.example") for i in range(n)]
+    failed = 0
+    for step in (authenticator.perform, authenticator.cleanup):
+        try:
+            step(achalls)
+        except Exception:
+            failed += n
+    return failed
+
+
+SCENARIOS: Dict[str, Callable[[StubDDNSServer, int, argparse.Namespace],
+                              int]] = {
+    "client-serial": bench_client_serial,
+    "client-bulk": bench_client_bulk,
+    "authenticator": bench_authenticator,
+}
+
+
+def _plugin_config(**values) -> argparse.Namespace:
+    """
+    Build a certbot config with the defaults of all plugin options.
+    """
+    prefix = PLUGIN_NAME.replace("-", "_") + "_"
+    config = argparse.Namespace(work_dir=None)
+
+    def add(arg_name_no_prefix, default=None, **kwargs):
+        setattr(config, prefix + arg_name_no_prefix.replace("-", "_"),
+                default)
+
+    Authenticator.add_parser_arguments(add)
+    for name, value in values.items():
+        setattr(config, prefix + name, value)
+    return config
+
+
+def run_scenario(
+    name: str, n: int, server: StubDDNSServer, args
+) -> Dict:
+    """
+    Run one scenario for N domains.
+
+    :return: the result entry of the report
+    """
+    requests_before = server.requests
+    with LatencyRecorder().installed() as recorder:
+        started = time.perf_counter()
+        failed = SCENARIOS[name](server, n, args)
+        seconds = time.perf_counter() - started
+    operations = 2 * n
+    ordered = sorted(recorder.samples)
+    return {
+        "scenario": name,
+        "domains": n,
+        "operations": operations,
+        "failed_operations": failed,
+        "http_requests": server.requests - requests_before,
+        "seconds": round(seconds, 6),
+        "ops_per_sec": round(operations / seconds, 2) if seconds else None,
+        "latency_ms": {
+            f"p{p}": round(percentile(ordered, p) * 1000, 3) if ordered
+            else 0.0
+            for p in (50, 95, 99)
+        },
+    }
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sizes", default="1,10,100,1000",
+        type=lambda sizes: [int(n) for n in sizes.split(",")],
+        help="comma separated numbers of domains (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--scenarios", default=",".join(SCENARIOS),
+        type=lambda names: names.split(","),
+        help="comma separated scenarios (default: %(default)s)"
+    )
+    parser.add_argument("--latency", type=float, default=0.005,
+                        help="stub server latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="share of requests failing with 503")
+    parser.add_argument("--tls", action="store_true",
+                        help="serve HTTPS with a self-signed certificate")
+    parser.add_argument("--pool-size", type=int, default=10)
+    parser.add_argument("--max-workers", type=int, default=10)
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--output", default=DEFAULT_OUTPUT,
+                        help="JSON report path (default: %(default)s)")
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main(argv: List[str] = None) -> int:
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    display_obj.set_display(display_obj.NoninteractiveDisplay(
+        open(os.devnull, "w")
+    ))
+    results = []
+    with StubDDNSServer(args.latency, args.error_rate, args.tls) as server:
+        with _trusted_certificate(server.cert_path):
+            for name in args.scenarios:
+                for n in args.sizes:
+                    result = run_scenario(name, n, server, args)
+                    results.append(result)
+                    print(f"{name:>14} n={n:<5} "
+                          f"{result['ops_per_sec']:>10} ops/s  "
+                          f"p50={result['latency_ms']['p50']}ms  "
+                          f"p95={result['latency_ms']['p95']}ms  "
+                          f"p99={result['latency_ms']['p99']}ms")
+
+    report = {
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            "latency": args.latency, "error_rate": args.error_rate,
+            "tls": args.tls, "pool_size": args.pool_size,
+            "max_workers": args.max_workers, "retries": args.retries,
+        },
+        "results": results,
+    }
+    output = pathlib.Path(args.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2) + "\n")
+    print(f"Report written to {output}")
+    return 0
+
+
+@contextlib.contextmanager
+def _trusted_certificate(cert_path):
+    """
+    Let requests trust the self-signed certificate of the stub server.
+    """
+    if cert_path is None:
+        yield
+        return
+    previous = os.environ.get("REQUESTS_CA_BUNDLE")
+    os.environ["REQUESTS_CA_BUNDLE"] = cert_path
+    try:
+        yield
+    finally:
+        if previous is None:
+            del os.environ["REQUESTS_CA_BUNDLE"]
+        else:
+            os.environ["REQUESTS_CA_BUNDLE"] = previous
+
+
+if __name__ == "__main__":
+    sys.exit(main())
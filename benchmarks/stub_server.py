@@ -0,0 +1,160 @@
+"""Local stub of the ISPConfig DDNS update script, for benchmarks."""
+import datetime
+import os
+import random
+import ssl
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+DDNS_SCRIPT_PATH = "/ddns/update.php"
+
+
+class StubDDNSServer(ThreadingHTTPServer):
+    """
+    Answers /ddns/update.php requests after a configurable latency, failing
+    a configurable share of them with 503.
+    """
+    daemon_threads = True
+    # keep up with many parallel keep-alive connections
+    request_queue_size = 1024
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        tls: bool = False,
+    ) -> None:
+        """
+        :param latency: seconds to wait before answering a request
+        :param error_rate: share of requests answered with 503 (0 to 1)
+        :param tls: serve HTTPS with a generated self-signed certificate
+        """
+        super(StubDDNSServer, self).__init__(("127.0.0.1", 0), _Handler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.cert_path: Optional[str] = None
+        self.records = set()
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        if tls:
+            self.cert_path = _self_signed_certificate()
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(self.cert_path)
+            self.socket = context.wrap_socket(self.socket, server_side=True)
+
+    @property
+    def endpoint(self) -> str:
+        scheme = "https" if self.cert_path else "http"
+        return f"{scheme}://localhost:{self.server_address[1]}"
+
+    def __enter__(self) -> "StubDDNSServer":
+        self._thread = threading.Thread(
+            target=self.serve_forever, kwargs={"poll_interval": 0.05},
+            daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.shutdown()
+        self.server_close()
+        if self.cert_path:
+            os.unlink(self.cert_path)
+
+    def handle_update(self, method: str, query: dict) -> Tuple[int, str]:
+        """
+        Apply an update request to the in-memory records.
+
+        :return: the status code and body of the response
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+            if random.random() < self.error_rate:
+                return 503, "busy"
+            record = (query.get("record", [""])[0], query.get("data", [""])[0])
+            action = query.get("action", [""])[0]
+            if method == "POST" and action == "add":
+                self.records.add(record)
+            elif method == "DELETE" and action == "delete":
+                self.records.discard(record)
+            else:
+                return 400, "invalid action"
+        return 200, "OK"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, avoid delayed ACK stalls
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self._update()
+
+    def do_DELETE(self):
+        self._update()
+
+    def log_message(self, *args):
+        pass
+
+    def _update(self):
+        url = urlparse(self.path)
+        if url.path != DDNS_SCRIPT_PATH:
+            status, body = 404, "not found"
+        elif not self.headers.get("Authorization", "").startswith("Basic "):
+            status, body = 401, "unauthorized"
+        else:
+            status, body = self.server.handle_update(
+                self.command, parse_qs(url.query)
+            )
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def _self_signed_certificate() -> str:
+    """
+    Generate a self-signed certificate for localhost.
+
+    :return: the path of a PEM file with the key and certificate
+    """
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(
+            x509.SubjectAlternativeName([x509.DNSName("localhost")]),
+            critical=False
+        )
+        .sign(key, hashes.SHA256())
+    )
+    fd, path = tempfile.mkstemp(suffix=".pem", prefix="stub-ddns-")
+    with os.fdopen(fd, "wb") as pem_file:
+        pem_file.write(key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()
+        ))
+        pem_file.write(certificate.public_bytes(serialization.Encoding.PEM))
+    return path
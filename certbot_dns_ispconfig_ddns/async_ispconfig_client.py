@@ -0,0 +1,156 @@
+"""Asyncio client for the ISPConfig DDNS module API."""
+import asyncio
+import base64
+from typing import Iterable, List, Optional, Tuple
+
+import aiohttp
+
+from certbot_dns_ispconfig_ddns.ispconfig_client import DDNS_SCRIPT_PATH, \
+    DEFAULT_POOL_MAXSIZE, ISPConfigClientError, build_query_params
+
+DEFAULT_CONCURRENCY = 10
+
+_METHODS = {
+    "add": "POST",
+    "delete": "DELETE",
+}
+
+
+class AsyncISPConfigClient:
+    """
+    Encapsulates all communication with the ISPConfig DDNS module API,
+    using asyncio and aiohttp.
+
+    The aiohttp session is created on first use, so the client must be used
+    from within the event loop that runs its requests.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        token: str,
+        pool_maxsize: int = DEFAULT_POOL_MAXSIZE,
+    ) -> None:
+        """
+        Creates a new AsyncISPConfigClient object.
+
+        :param endpoint: the URL of the ISPConfig installation
+        :param token: the ISPConfig DDNS module token used for API calls
+        :param pool_maxsize: the maximum number of connections to keep
+                             open to the endpoint
+        :raise ISPConfigClientError: if the endpoint or token are missing
+        """
+        if endpoint is None or len(endpoint) == 0:
+            raise ISPConfigClientError(f"Missing endpoint: {endpoint}")
+        if token is None or len(token) == 0:
+            raise ISPConfigClientError(f"Missing token: {token}")
+        self._endpoint = endpoint.rstrip("/")
+        self._token = token.strip()
+        self._pool_maxsize = pool_maxsize
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def __aenter__(self) -> "AsyncISPConfigClient":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        """
+        Close the underlying session and all pooled connections.
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def set_txt_record(
+        self, record_fqdn: str, record_content: str
+    ) -> None:
+        """
+        Add a TXT record using the supplied information.
+
+        :param str record_fqdn: the validation record including domain name
+                                (typically beginning with '_acme-challenge.')
+        :param str record_content: The record TXT content that should be set
+        :raises ISPConfigClientError: if an error occurs
+        :raises aiohttp.ClientResponseError: if the endpoint returns an
+                                             error status
+        """
+        await self._send("add", record_fqdn, record_content)
+
+    async def del_txt_record(
+        self, record_fqdn: str, record_content: str
+    ) -> None:
+        """
+        Delete a TXT record using the supplied information.
+
+        :param str record_fqdn: the validation record including domain name
+                                (typically beginning with '_acme-challenge.')
+        :param str record_content: The record TXT content that should be set
+        :raises ISPConfigClientError: if an error occurs
+        :raises aiohttp.ClientResponseError: if the endpoint returns an
+                                             error status
+        """
+        await self._send("delete", record_fqdn, record_content)
+
+    async def gather(
+        self,
+        operations: Iterable[Tuple[str, str, str]],
+        concurrency: int = DEFAULT_CONCURRENCY,
+    ) -> List[Optional[BaseException]]:
+        """
+        Run many record updates with at most `concurrency` in flight.
+
+        Like asyncio.gather(return_exceptions=True), a failing update does
+        not cancel the others; its exception is returned in its place.
+
+        :param operations: (action, record_fqdn, record_content) tuples,
+                           where action is 'add' or 'delete'
+        :param concurrency: the maximum number of requests in flight
+        :return: None or the raised exception, per operation and in order
+        """
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def run(action: str, record_fqdn: str, record_content: str):
+            async with semaphore:
+                await self._send(action, record_fqdn, record_content)
+
+        return await asyncio.gather(
+            *(run(*operation) for operation in operations),
+            return_exceptions=True
+        )
+
+    async def _send(
+        self, action: str, record_fqdn: str, record_content: str
+    ) -> None:
+        """
+        Send a single request to the DDNS update script.
+
+        :param str action: the DDNS action ('add' or 'delete')
+        :param str record_fqdn: the validation record including domain name
+        :param str record_content: the record TXT content
+        :raises ISPConfigClientError: if the action is unknown or the TXT
+                                      content is too big
+        :raises aiohttp.ClientResponseError: if the endpoint returns an
+                                             error status
+        """
+        if action not in _METHODS:
+            raise ISPConfigClientError(f"Unknown action: {action}")
+        query_params = build_query_params(action, record_fqdn, record_content)
+        async with self._get_session().request(
+            _METHODS[action],
+            f"{self._endpoint}{DDNS_SCRIPT_PATH}",
+            params=query_params,
+        ) as response:
+            response.raise_for_status()
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            credentials = base64.b64encode(
+                f"anonymous:{self._token}".encode()
+            ).decode()
+            self._session = aiohttp.ClientSession(
+                headers={"Authorization": f"Basic {credentials}"},
+                connector=aiohttp.TCPConnector(limit=self._pool_maxsize),
+            )
+        return self._session
@@ -1,11 +1,85 @@
-from typing import Callable
+import atexit
+import contextlib
+import logging
+import math
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from time import sleep
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, \
+    Optional, Tuple
 
-from certbot import errors
+from acme import challenges
+from certbot import achallenges, errors
+from certbot.display import util as display_util
 from certbot.plugins import dns_common
 
-from certbot_dns_ispconfig_ddns.ispconfig_client import ISPConfigClient
+from certbot_dns_ispconfig_ddns.journal import DEFAULT_STATE_TTL, \
+    HISTORY_FILE_NAME, JOURNAL_FILE_NAME, STATE_FILE_NAME, CleanupJournal, \
+    DeferredCleanup, PropagationHistory, RecordStateCache
+from certbot_dns_ispconfig_ddns.metrics import Metrics
+from certbot_dns_ispconfig_ddns.retry import DEFAULT_RETRIES, \
+    AdaptiveLimiter, CircuitBreaker, Deadline, RetryPolicy
+from certbot_dns_ispconfig_ddns.zones import Route, ZoneIndex, \
+    load_zone_routes
+
+if TYPE_CHECKING:  # pragma: no cover
+    # certbot loads every plugin on startup, the client is imported lazily
+    from certbot_dns_ispconfig_ddns.cassette import Cassette, \
+        CassetteAdapter
+    from certbot_dns_ispconfig_ddns.ispconfig_client import ISPConfigClient
+    from certbot_dns_ispconfig_ddns.spool import SpoolCoordinator
+
+logger = logging.getLogger(__name__)
 
 DEFAULT_PROPAGATION_SECONDS = 60
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_WORKERS = 10
+# mirror the ispconfig_client defaults, which is only imported when used
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_READ_TIMEOUT = 30.0
+# without polling, learned waits poll the records from this many seconds on,
+# and record the first time they are visible
+MIN_LEARNED_PROPAGATION_SECONDS = 2.0
+DEFAULT_SPOOL_WINDOW = 0.5
+# the connection warm-up of prepare may take this many seconds at most, so a
+# run that certbot aborts before perform is not held open by it
+WARM_UP_TIMEOUT = 5.0
+
+Validation = Tuple[str, str, str]
+
+
+def _achall_domain(achall: achallenges.AnnotatedChallenge) -> str:
+    """
+    Get the domain of a challenge, on all supported certbot versions.
+
+    :param achall: the annotated challenge
+    :return: the domain being validated
+    """
+    identifier = getattr(achall, "identifier", None)
+    if identifier is not None:
+        return identifier.value
+    return achall.domain  # pragma: no cover
+
+
+def _validations(
+    achalls: List[achallenges.AnnotatedChallenge]
+) -> List[Validation]:
+    """
+    Get the domain, validation name and validation of each challenge.
+
+    :param achalls: the annotated challenges
+    :return: a (domain, validation_name, validation) tuple per challenge
+    """
+    validations = []
+    for achall in achalls:
+        domain = _achall_domain(achall)
+        validations.append((
+            domain,
+            achall.validation_domain_name(domain),
+            achall.validation(achall.account_key)
+        ))
+    return validations
 
 
 class Authenticator(dns_common.DNSAuthenticator):
@@ -20,6 +94,21 @@ class Authenticator(dns_common.DNSAuthenticator):
 
     def __init__(self, *args, **kwargs) -> None:
         super(Authenticator, self).__init__(*args, **kwargs)
+        self.credentials: Optional[dns_common.CredentialsConfiguration] = None
+        self._zone_routes: ZoneIndex[Route] = ZoneIndex()
+        self._ispconfig_clients: Dict[Route, "ISPConfigClient"] = {}
+        # the clients of all tokens share one limiter and one breaker per
+        # endpoint URL
+        self._limiters: Dict[str, AdaptiveLimiter] = {}
+        self._circuit_breakers: Dict[str, CircuitBreaker] = {}
+        self._deferred_cleanup: Optional[DeferredCleanup] = None
+        self._metrics = Metrics()
+        self._state_cache: Optional[RecordStateCache] = None
+        self._token_checks: Dict[Route, Future] = {}
+        self._propagation_history: Optional[PropagationHistory] = None
+        self._propagation_samples: Dict[str, float] = {}
+        self._spool: Optional["SpoolCoordinator"] = None
+        self._cassette: Optional["Cassette"] = None
 
     @classmethod
     def add_parser_arguments(
@@ -45,6 +134,146 @@ class Authenticator(dns_common.DNSAuthenticator):
             help="ISPConfig endpoint (overwrites credentials file)"
         )
         add("token", help="ISPConfig DDNS token (overwrites credentials file)")
+        add(
+            "connect-timeout",
+            type=float,
+            help="Seconds to wait for a connection to the ISPConfig "
+                 "endpoint (overwrites credentials file, default: "
+                 f"{DEFAULT_CONNECT_TIMEOUT:g})."
+        )
+        add(
+            "read-timeout",
+            type=float,
+            help="Seconds to wait for a response of the ISPConfig endpoint "
+                 "(overwrites credentials file, default: "
+                 f"{DEFAULT_READ_TIMEOUT:g})."
+        )
+        add(
+            "deadline",
+            type=float,
+            help="Total seconds to spend on adding, and on deleting, the TXT "
+                 "records including retries; outstanding requests are "
+                 "cancelled once it is used up (overwrites credentials "
+                 "file, default: no deadline)."
+        )
+        add(
+            "pool-size",
+            type=int,
+            default=DEFAULT_POOL_SIZE,
+            help="Maximum number of keep-alive connections to the ISPConfig "
+                 "endpoint."
+        )
+        add(
+            "max-workers",
+            type=int,
+            default=DEFAULT_MAX_WORKERS,
+            help="Maximum number of TXT records to add or delete in parallel."
+        )
+        add(
+            "retries",
+            type=int,
+            default=DEFAULT_RETRIES,
+            help="Number of retries with exponential backoff for failed "
+                 "DDNS requests (connection errors, 5xx and 429 responses)."
+        )
+        add(
+            "deferred-cleanup",
+            action="store_true",
+            default=False,
+            help="Delete the TXT records in the background after validation "
+                 "instead of blocking certbot. Pending deletions are kept in "
+                 "a journal and retried by the next run."
+        )
+        add(
+            "journal",
+            help="Path of the journal of TXT records to delete (default: "
+                 f"{JOURNAL_FILE_NAME} in the certbot work directory)."
+        )
+        add(
+            "daemon-socket",
+            help="Send the DDNS updates to the certbot-dns-ispconfig-ddns-"
+                 "daemon listening on this Unix socket, which keeps its "
+                 "connections to the endpoints open between runs."
+        )
+        add(
+            "cassette",
+            help="Record the DDNS exchanges to this cassette file (token "
+                 "redacted), or replay them from it without network "
+                 "access, e.g. for end-to-end tests."
+        )
+        add(
+            "cassette-mode",
+            choices=("record", "replay"),
+            default="replay",
+            help="Whether to record to or replay from the cassette."
+        )
+        add(
+            "spool-dir",
+            help="Coalesce the DDNS updates of concurrent certbot processes "
+                 "through this spool directory: one process at a time "
+                 "sends the queued updates of all of them."
+        )
+        add(
+            "spool-window",
+            type=float,
+            default=DEFAULT_SPOOL_WINDOW,
+            help="Seconds the sending process waits for the updates of "
+                 "other processes."
+        )
+        add(
+            "state-cache",
+            action="store_true",
+            default=False,
+            help="Remember which TXT records were added or deleted, and skip "
+                 "adding records that are still present or deleting records "
+                 "that are already gone."
+        )
+        add(
+            "state-file",
+            help="Path of the TXT record state cache (default: "
+                 f"{STATE_FILE_NAME} in the certbot work directory)."
+        )
+        add(
+            "state-ttl",
+            type=int,
+            default=DEFAULT_STATE_TTL,
+            help="Seconds after which a cached TXT record state expires."
+        )
+        add(
+            "propagation-polling",
+            action="store_true",
+            default=False,
+            help="Poll the authoritative nameservers until the TXT records "
+                 "are visible instead of always waiting the full "
+                 "propagation seconds, which become an upper bound. "
+                 "Requires dnspython."
+        )
+        add(
+            "propagation-nameservers",
+            help="Comma separated IP addresses of the nameservers to poll "
+                 "(default: the authoritative nameservers of each record)."
+        )
+        add(
+            "propagation-learning",
+            action="store_true",
+            default=False,
+            help="Record how long the TXT records of each zone needed to "
+                 "propagate, and wait a high percentile of that history "
+                 "instead of the full propagation seconds, which become "
+                 "an upper bound. A failed validation resets the history "
+                 "of its zone. Requires dnspython."
+        )
+        add(
+            "propagation-history-file",
+            help="Path of the propagation history (default: "
+                 f"{HISTORY_FILE_NAME} in the certbot work directory)."
+        )
+        add(
+            "metrics-file",
+            help="Write request timings, status counters and phase "
+                 "durations to this file after each run, as a node_exporter "
+                 "textfile if it ends with .prom and as JSON otherwise."
+        )
 
     def more_info(self) -> str:
         """
@@ -56,6 +285,55 @@ class Authenticator(dns_common.DNSAuthenticator):
         return ("This plugin configures a DNS TXT record to respond to a "
                 "dns-01 challenge using the ISPConfig DDNS module API.")
 
+    def prepare(self) -> None:
+        """
+        Connect to the ISPConfig endpoints of the requested domains and check
+        their tokens in the background, while certbot sets up the ACME order.
+
+        The first update then does not pay for the DNS lookup and the TCP
+        and TLS handshake, and a rejected token fails perform before any
+        record is sent. Nothing is done unless the credentials are given,
+        as prepare must not prompt for them. The clients are closed at exit
+        if certbot aborts before cleanup.
+        """
+        if self.conf("daemon-socket") or self.conf("spool-dir") or not (
+            self.conf("credentials")
+            or (self.conf("endpoint") and self.conf("token"))
+        ):
+            return
+        try:
+            self._setup_credentials()
+        except errors.Error as e:
+            # perform sets up the credentials again and reports the error
+            logger.debug("Skipping the connection warm-up: %s", e)
+            return
+        routes = set()
+        for domain in self.config.domains or []:
+            route = self._find_route(
+                "_acme-challenge." + domain[len("*."):]
+                if domain.startswith("*.") else "_acme-challenge." + domain
+            )
+            if route is not None:
+                routes.add(route)
+        if not routes and self._get_default_route() is not None:
+            routes.add(self._get_default_route())
+        if not routes:
+            return
+        atexit.register(self._end_warm_up)
+        executor = ThreadPoolExecutor(max_workers=len(routes))
+        for route in routes:
+            future = executor.submit(
+                self._get_ispconfig_client(route).check_token,
+                WARM_UP_TIMEOUT
+            )
+            future.add_done_callback(
+                lambda f, endpoint=route.endpoint: _log_token_check(
+                    endpoint, f
+                )
+            )
+            self._token_checks[route] = future
+        executor.shutdown(wait=False)
+
     def _setup_credentials(self):
         # If endpoint and token cli params are provided,
         # we do not need a credentials file
@@ -68,10 +346,497 @@ class Authenticator(dns_common.DNSAuthenticator):
         self.credentials = self._configure_credentials(
             "credentials",
             "ISPConfig DDNS credentials INI file",
-            {
+            validator=self._validate_credentials,
+        )
+        self._zone_routes = load_zone_routes(
+            self.credentials.confobj, self._get_endpoint()
+        )
+
+    def _validate_credentials(
+        self, credentials: dns_common.CredentialsConfiguration
+    ) -> None:
+        """
+        Check that the credentials file configures a default endpoint and
+        token, or at least one zone section.
+
+        :param credentials: the parsed credentials file
+        :raise PluginError: if the credentials are incomplete
+        """
+        zone_routes = load_zone_routes(
+            credentials.confobj,
+            self.conf("endpoint") or credentials.conf("endpoint")
+        )
+        if not zone_routes:
+            credentials.require({
                 "endpoint": "URL of the ISPConfig Installation.",
                 "token": "The generated DDNS module token.",
-            },
+            })
+
+    def perform(
+        self, achalls: List[achallenges.AnnotatedChallenge]
+    ) -> List[challenges.ChallengeResponse]:
+        """
+        Add the TXT records of all challenges in one bulk update and wait for
+        them to propagate.
+
+        :param achalls: the annotated challenges to perform
+        :return: the challenge responses, in the order of achalls
+        :raise PluginError: if adding any TXT record fails
+        """
+        self._setup_credentials()
+        self._attempt_cleanup = True
+
+        if self.conf("deferred-cleanup"):
+            self._start_deferred_cleanup(achalls)
+        with self._timed("add"):
+            self._update_records("add", achalls)
+        with self._timed("propagation"):
+            self._wait_for_propagation(achalls)
+
+        return [achall.response(achall.account_key) for achall in achalls]
+
+    def cleanup(
+        self, achalls: List[achallenges.AnnotatedChallenge]
+    ) -> None:
+        """
+        Delete all TXT records in one bulk update and close the shared
+        ISPConfigClient.
+
+        :param achalls: the annotated challenges to clean up
+        :raise PluginError: if deleting any TXT record fails
+        """
+        self._record_propagation()
+        if self._attempt_cleanup and self._deferred_cleanup is not None:
+            self._finish_deferred_cleanup(achalls)
+            return
+        try:
+            if self._attempt_cleanup:
+                with self._timed("delete"):
+                    self._update_records("delete", achalls)
+        finally:
+            self._close_ispconfig_clients()
+            self._write_metrics()
+
+    def _start_deferred_cleanup(
+        self, achalls: List[achallenges.AnnotatedChallenge]
+    ) -> None:
+        """
+        Journal the records of this run before they are created, and start
+        deleting the records left over by previous runs in the background.
+
+        Records of this run, e.g. of a reused pending authorization, are no
+        leftovers even if a previous run journaled them.
+
+        :param achalls: the annotated challenges to perform
+        """
+        journal = CleanupJournal(
+            self.conf("journal")
+            or os.path.join(self.config.work_dir, JOURNAL_FILE_NAME)
+        )
+        current = self._group_by_route(_validations(achalls))
+        own = {(route.endpoint, fqdn, content)
+               for route, validations in current.items()
+               for fqdn, content in _records(validations)}
+        leftovers: Dict[Route, List[Tuple[str, str]]] = {}
+        for endpoint, fqdn, content, _ in journal.leftovers():
+            route = self._find_route(fqdn, endpoint)
+            if route is not None and (endpoint, fqdn, content) not in own:
+                leftovers.setdefault(route, []).append((fqdn, content))
+        for route, validations in current.items():
+            journal.add(route.endpoint, _records(validations))
+        self._deferred_cleanup = DeferredCleanup(
+            journal, self.conf("max-workers"), self._get_state_cache()
+        )
+        for route, route_leftovers in leftovers.items():
+            logger.info("Deleting %d TXT record(s) left over by previous "
+                        "runs in the background", len(route_leftovers))
+            self._deferred_cleanup.submit(
+                self._get_ispconfig_client(route), route.endpoint,
+                route_leftovers
+            )
+
+    def _finish_deferred_cleanup(
+        self, achalls: List[achallenges.AnnotatedChallenge]
+    ) -> None:
+        """
+        Hand the records of this run and the shared ISPConfigClients over to
+        the background cleanup, which closes the clients and the spool, and
+        saves the cassette, when it is done.
+
+        :param achalls: the annotated challenges to clean up
+        """
+        for route, validations in self._group_by_route(
+            _validations(achalls)
+        ).items():
+            self._deferred_cleanup.submit(
+                self._get_ispconfig_client(route), route.endpoint,
+                _records(validations)
+            )
+        spool, self._spool = self._spool, None
+        cassette = self._cassette
+        self._deferred_cleanup.close(
+            list(self._ispconfig_clients.values()),
+            on_done=lambda: self._end_deferred_cleanup(spool, cassette)
+        )
+        self._deferred_cleanup = None
+        self._ispconfig_clients = {}
+
+    def _end_deferred_cleanup(
+        self,
+        spool: Optional["SpoolCoordinator"],
+        cassette: Optional["Cassette"],
+    ) -> None:
+        """
+        Close the spool and save the cassette once the background cleanup
+        deleted its records, and write the metrics of the run.
+
+        :param spool: the spool of the run, if any
+        :param cassette: the cassette of the run, if any
+        """
+        if spool is not None:
+            spool.close()
+        if cassette is not None:
+            cassette.save()
+        self._write_metrics()
+
+    def _update_records(
+        self, action: str, achalls: List[achallenges.AnnotatedChallenge]
+    ) -> None:
+        """
+        Add or delete the TXT records of all challenges with bulk calls.
+
+        The records are grouped by the route (endpoint and token) of their
+        zone, all routes are updated in parallel. All records are processed
+        even if some of them fail, the failures are then reported together,
+        per domain.
+
+        :param action: 'add' or 'delete'
+        :param achalls: the annotated challenges to process
+        :raise PluginError: if the update failed for any domain
+        """
+        validations = _validations(achalls)
+        groups = self._group_by_route(validations)
+        deadline = Deadline(self._get_setting("deadline"))
+        failures: Dict[Tuple[str, str], Exception] = {}
+        # split the workers between the routes, which run in parallel
+        workers = max(1, min(self.conf("max-workers"), len(groups)))
+        route_workers = max(1, self.conf("max-workers") // workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(
+                lambda group: self._update_route(
+                    action, group[0], group[1], route_workers, deadline
+                ),
+                groups.items()
+            )
+            for route_failures in results:
+                failures.update(route_failures)
+        if failures:
+            failed = [(domain, failures[(name, value)])
+                      for domain, name, value in validations
+                      if (name, value) in failures]
+            raise errors.PluginError(
+                f"Failed to {action} TXT record for "
+                f"{len(failed)} of {len(validations)} domain(s): "
+                + "; ".join(f"{domain}: {error}" for domain, error in failed)
+            )
+
+    def _update_route(
+        self,
+        action: str,
+        route: Route,
+        validations: List[Validation],
+        max_workers: int,
+        deadline: Optional[Deadline] = None,
+    ) -> Dict[Tuple[str, str], Exception]:
+        """
+        Add or delete the TXT records of one route with one bulk call.
+
+        :param action: 'add' or 'delete'
+        :param route: the endpoint and token of the records
+        :param validations: the validations of the route
+        :param max_workers: the maximum number of requests in parallel
+        :param deadline: the time budget of the update
+        :return: the error per failed (record_fqdn, record_content) pair
+        """
+        from certbot_dns_ispconfig_ddns.ispconfig_client import \
+            ISPConfigBulkError, is_not_applied
+
+        records = _records(validations)
+        state_cache = self._get_state_cache()
+        target = (RecordStateCache.PRESENT if action == "add"
+                  else RecordStateCache.ABSENT)
+        if state_cache is not None:
+            known = state_cache.known(route.endpoint, records)
+            records = [r for r in records if known.get(r) != target]
+            if len(records) < len(validations):
+                logger.info("Skipping %s of %d TXT record(s) already %s",
+                            action, len(validations) - len(records), target)
+            if not records:
+                return {}
+        client = self._get_ispconfig_client(route)
+        update = (client.set_txt_records if action == "add"
+                  else client.del_txt_records)
+        try:
+            self._raise_rejected_token(route)
+            update(records, max_workers=max_workers, deadline=deadline)
+            failures = {}
+        except ISPConfigBulkError as e:
+            failures = e.failures
+        except Exception as e:
+            failures = {record: e for record in records}
+        if state_cache is not None:
+            state_cache.mark(
+                route.endpoint,
+                [r for r in records if r not in failures], target
+            )
+        if state_cache is not None and action == "add":
+            # a delete that was not applied leaves the record present
+            state_cache.mark(
+                route.endpoint,
+                [r for r, e in failures.items() if is_not_applied(e)],
+                RecordStateCache.ABSENT
+            )
+        return failures
+
+    def _raise_rejected_token(self, route: Route) -> None:
+        """
+        Fail fast if the warm-up found that the token of a route is rejected,
+        without waiting for a check that is still running.
+
+        :raise TokenRejectedError: if the endpoint rejected the token
+        """
+        from certbot_dns_ispconfig_ddns.ispconfig_client import \
+            TokenRejectedError
+
+        check = self._token_checks.get(route)
+        if check is not None and check.done() and \
+                isinstance(check.exception(), TokenRejectedError):
+            raise check.exception()
+
+    def _get_state_cache(self) -> Optional[RecordStateCache]:
+        """
+        Get the TXT record state cache of this run, if it is enabled.
+
+        :return: the shared RecordStateCache object, or None
+        """
+        if self._state_cache is None and self.conf("state-cache"):
+            self._state_cache = RecordStateCache(
+                self.conf("state-file")
+                or os.path.join(self.config.work_dir, STATE_FILE_NAME),
+                ttl=self.conf("state-ttl")
+            )
+        return self._state_cache
+
+    def _wait_for_propagation(
+        self, achalls: List[achallenges.AnnotatedChallenge]
+    ) -> None:
+        """
+        Wait for the TXT records to propagate.
+
+        Without propagation polling, this sleeps for the configured
+        propagation seconds, or at most the learned propagation time of the
+        zones. With polling, it returns as soon as all authoritative
+        nameservers serve the records, the propagation seconds are only the
+        upper bound.
+
+        :param achalls: the annotated challenges that were performed
+        :raise PluginError: if polling or learning is enabled but dnspython
+                            is missing
+        """
+        validations = _validations(achalls)
+        if self.conf("propagation-polling"):
+            self._poll_propagation(validations)
+            return
+        seconds = self._learned_propagation_seconds(validations)
+        if self._get_propagation_history() is None:
+            display_util.notify(
+                "Waiting %d seconds for DNS changes to propagate" % seconds
+            )
+            sleep(seconds)
+        else:
+            display_util.notify(
+                "Waiting up to %d seconds for DNS changes to propagate"
+                % seconds
+            )
+            self._check_propagation(validations, seconds)
+
+    def _poll_propagation(self, validations: List[Validation]) -> None:
+        """
+        Poll the nameservers until the records propagated, and remember the
+        propagation time of every zone to be recorded if validation
+        succeeds.
+
+        :param validations: the validations that were performed
+        """
+        seconds = self.conf("propagation-seconds")
+        checker = self._get_propagation_checker()
+        display_util.notify(
+            "Waiting up to %d seconds for DNS changes to propagate" % seconds
+        )
+        started = time.monotonic()
+        times: Dict[str, float] = {}
+        try:
+            propagated = checker.wait_for(
+                _records(validations), seconds, times=times
+            )
+        except Exception as e:
+            logger.warning("DNS propagation polling failed, waiting the "
+                           "remaining propagation seconds instead: %s", e)
+            sleep(max(0.0, seconds - (time.monotonic() - started)))
+            return
+        if not propagated:
+            logger.warning("DNS changes did not propagate to all "
+                           "authoritative nameservers within %d seconds",
+                           seconds)
+        if self._get_propagation_history() is not None:
+            self._propagation_samples = _zone_samples(
+                [(self._zone_of(domain, name), name)
+                 for domain, name, _ in validations], times
+            )
+
+    def _check_propagation(
+        self, validations: List[Validation], seconds: float
+    ) -> None:
+        """
+        Wait at most the learned propagation time, polling the records after
+        a short floor. The first time all nameservers serve a record is
+        remembered to be recorded, so the learned waits follow the real
+        propagation time of every zone.
+
+        :param validations: the validations that were performed
+        :param seconds: the learned seconds to wait
+        """
+        checker = self._get_propagation_checker()
+        floor = min(seconds, MIN_LEARNED_PROPAGATION_SECONDS)
+        sleep(floor)
+        started = time.monotonic()
+        times: Dict[str, float] = {}
+        try:
+            checker.wait_for(_records(validations), seconds - floor,
+                             times=times)
+        except Exception as e:
+            logger.warning("DNS propagation polling failed, waiting the "
+                           "remaining learned propagation time instead: %s",
+                           e)
+            sleep(max(0.0, seconds - floor - (time.monotonic() - started)))
+        self._propagation_samples = _zone_samples(
+            [(self._zone_of(domain, name), name)
+             for domain, name, _ in validations],
+            {name: floor + elapsed for name, elapsed in times.items()}
+        )
+
+    def _learned_propagation_seconds(
+        self, validations: List[Validation]
+    ) -> float:
+        """
+        Get the time to wait for the zones of the validations.
+
+        With propagation learning, every zone waits a high percentile of its
+        history, capped by the propagation seconds. The longest wait of all
+        zones is used.
+
+        :param validations: the validations that were performed
+        :return: the seconds to wait
+        """
+        seconds = self.conf("propagation-seconds")
+        history = self._get_propagation_history()
+        if history is None:
+            return seconds
+        zones = {self._zone_of(domain, name)
+                 for domain, name, _ in validations}
+        learned = history.estimate(zones)
+        wait = max((min(seconds, math.ceil(learned.get(zone, seconds)))
+                    for zone in zones), default=seconds)
+        if wait < seconds:
+            logger.info("Waiting the learned propagation time of %d instead "
+                        "of %d seconds", wait, seconds)
+        return wait
+
+    def auth_hint(
+        self, failed_achalls: List[achallenges.AnnotatedChallenge]
+    ) -> str:
+        """
+        Forget the propagation history of the zones of failed challenges, so
+        they wait the full propagation seconds again, and get the hint for
+        the user.
+
+        :param failed_achalls: the challenges that failed validation
+        :return: the hint
+        """
+        zones = set()
+        for achall in failed_achalls:
+            domain = _achall_domain(achall)
+            zones.add(
+                self._zone_of(domain, achall.validation_domain_name(domain))
+            )
+        for zone in zones:
+            self._propagation_samples.pop(zone, None)
+        history = self._get_propagation_history()
+        if history is not None:
+            history.reset(zones)
+        return super(Authenticator, self).auth_hint(failed_achalls)
+
+    def _record_propagation(self) -> None:
+        """
+        Add the propagation times of this run to the history. Challenges
+        that failed validation were removed by auth_hint before. Failing
+        to write the history does not fail the cleanup.
+        """
+        samples, self._propagation_samples = self._propagation_samples, {}
+        history = self._get_propagation_history()
+        if history is None or not samples:
+            return
+        try:
+            history.record(samples)
+        except OSError as e:
+            logger.warning("Failed to record the propagation times to %s: "
+                           "%s", history.path, e)
+
+    def _get_propagation_history(self) -> Optional[PropagationHistory]:
+        """
+        Get the propagation history, if propagation learning is enabled.
+
+        :return: the shared PropagationHistory object, or None
+        """
+        if self._propagation_history is None and \
+                self.conf("propagation-learning"):
+            self._propagation_history = PropagationHistory(
+                self.conf("propagation-history-file")
+                or os.path.join(self.config.work_dir, HISTORY_FILE_NAME)
+            )
+        return self._propagation_history
+
+    def _zone_of(self, domain: str, validation_name: str) -> str:
+        """
+        Get the zone a validation record is learned for: its zone section
+        of the credentials file, or else the domain.
+        """
+        zone_route = self._zone_routes.lookup(validation_name)
+        return zone_route[0] if zone_route else domain
+
+    def _get_propagation_checker(self):
+        """
+        Create the PropagationChecker used for propagation polling and
+        learning.
+
+        :return: the created PropagationChecker object
+        :raise PluginError: if dnspython is not installed
+        """
+        try:
+            from certbot_dns_ispconfig_ddns.propagation import \
+                PropagationChecker
+        except ImportError as e:
+            raise errors.PluginError(
+                "Propagation polling and learning require dnspython, "
+                "install it with "
+                "'pip install certbot-dns-ispconfig-ddns[polling]' "
+                f"({e})"
+            )
+        nameservers = self.conf("propagation-nameservers")
+        return PropagationChecker(
+            nameservers=([ns.strip() for ns in nameservers.split(",")]
+                         if nameservers else None),
+            max_workers=self.conf("max-workers")
         )
 
     def _perform(
@@ -86,9 +851,9 @@ class Authenticator(dns_common.DNSAuthenticator):
         :raise PluginError: if creating the TXT record produces any error
         """
         try:
-            self._get_ispconfig_client().set_txt_record(
-                validation_name, validation
-            )
+            self._get_ispconfig_client(
+                self._get_route(validation_name)
+            ).set_txt_record(validation_name, validation)
         except Exception as e:
             raise errors.PluginError(e)
 
@@ -104,21 +869,311 @@ class Authenticator(dns_common.DNSAuthenticator):
         :raise PluginError: if removing the TXT record produces any error
         """
         try:
-            self._get_ispconfig_client().del_txt_record(
-                validation_name, validation
-            )
+            self._get_ispconfig_client(
+                self._get_route(validation_name)
+            ).del_txt_record(validation_name, validation)
         except Exception as e:
             raise errors.PluginError(e)
 
-    def _get_ispconfig_client(self) -> ISPConfigClient:
+    def _get_ispconfig_client(
+        self, route: Optional[Route] = None
+    ) -> "ISPConfigClient":
         """
-        Create a new ISPConfigClient instance with the provided credentials.
+        Get the ISPConfigClient instance of a route for this authenticator
+        run.
+
+        The client is created on first use and shared by all following calls
+        for the same endpoint and token, so its pooled connections are reused
+        until cleanup closes it. With a daemon socket, a DaemonClient
+        forwarding to the daemon's warm clients is used instead, and with a
+        spool directory a SpoolClient coalescing the updates of concurrent
+        processes.
 
-        :return: the created ISPConfigClient object
+        :param route: the endpoint and token, defaults to the default route
+        :return: the shared ISPConfigClient object
+        :raise PluginError: if no default endpoint and token are configured
         """
-        endpoint = self.conf("endpoint") or self.credentials.conf("endpoint")
-        token = self.conf("token") or self.credentials.conf("token")
+        if route is None:
+            route = self._get_default_route()
+            if route is None:
+                raise errors.PluginError(
+                    "No default ISPConfig DDNS endpoint and token configured"
+                )
+        if route not in self._ispconfig_clients and \
+                self.conf("daemon-socket"):
+            from certbot_dns_ispconfig_ddns.daemon import DaemonClient
+            self._ispconfig_clients[route] = DaemonClient(
+                self.conf("daemon-socket"), route.endpoint, route.token
+            )
+        if route not in self._ispconfig_clients and self.conf("spool-dir"):
+            from certbot_dns_ispconfig_ddns.spool import SpoolClient
+            self._ispconfig_clients[route] = SpoolClient(
+                self._get_spool(), route
+            )
+        if route not in self._ispconfig_clients:
+            self._ispconfig_clients[route] = \
+                self._create_ispconfig_client(route)
+        return self._ispconfig_clients[route]
+
+    def _create_ispconfig_client(self, route: Route) -> "ISPConfigClient":
+        """
+        Create a client sending the updates of a route to its endpoint.
+
+        :param route: the endpoint and token
+        :return: the new ISPConfigClient object
+        """
+        from certbot_dns_ispconfig_ddns.ispconfig_client import \
+            ISPConfigClient
+
         return ISPConfigClient(
-            endpoint=endpoint,
-            token=token
+            endpoint=route.endpoint,
+            token=route.token,
+            pool_maxsize=self.conf("pool-size"),
+            retry_policy=RetryPolicy(retries=self.conf("retries")),
+            circuit_breakers=self._circuit_breakers,
+            metrics=self._metrics,
+            limiters=self._limiters,
+            connect_timeout=self._get_setting(
+                "connect-timeout", DEFAULT_CONNECT_TIMEOUT
+            ),
+            read_timeout=self._get_setting(
+                "read-timeout", DEFAULT_READ_TIMEOUT
+            ),
+            transport=self._get_transport()
         )
+
+    def _get_transport(self) -> Optional["CassetteAdapter"]:
+        """
+        Get the adapter of a new client, which records to or replays from
+        the cassette.
+
+        :return: a new CassetteAdapter, or None without cassette
+        :raise PluginError: if the cassette cannot be read
+        """
+        if not self.conf("cassette"):
+            return None
+        from certbot_dns_ispconfig_ddns.cassette import Cassette, \
+            CassetteAdapter, CassetteError
+
+        if self._cassette is None:
+            try:
+                self._cassette = Cassette(self.conf("cassette"),
+                                          self.conf("cassette-mode"))
+            except CassetteError as e:
+                raise errors.PluginError(str(e))
+        return CassetteAdapter(self._cassette,
+                               pool_maxsize=self.conf("pool-size"))
+
+    def _get_spool(self) -> "SpoolCoordinator":
+        """
+        Get the coordinator of the spool directory, which sends the queued
+        updates of all processes with clients of this authenticator.
+
+        :return: the shared SpoolCoordinator object
+        """
+        if self._spool is None:
+            from certbot_dns_ispconfig_ddns.spool import SpoolCoordinator
+            self._spool = SpoolCoordinator(
+                self.conf("spool-dir"), self._create_ispconfig_client,
+                window=self.conf("spool-window"),
+                max_workers=self.conf("max-workers")
+            )
+        return self._spool
+
+    def _get_route(self, validation_name: str) -> Route:
+        """
+        Get the endpoint and token for a validation record.
+
+        The most specific zone section of the credentials file wins, records
+        outside of all zones use the default endpoint and token.
+
+        :param validation_name: the validation record including domain name
+        :return: the route of the record
+        :raise PluginError: if no credentials are configured for the record
+        """
+        route = self._find_route(validation_name)
+        if route is None:
+            raise errors.PluginError(
+                "No ISPConfig DDNS credentials configured for the zone of "
+                f"{validation_name}"
+            )
+        return route
+
+    def _find_route(
+        self, validation_name: str, endpoint: Optional[str] = None
+    ) -> Optional[Route]:
+        """
+        Find the endpoint and token for a validation record.
+
+        :param validation_name: the validation record including domain name
+        :param endpoint: only return a route with this endpoint
+        :return: the route of the record, or None if there is none
+        """
+        zone_route = self._zone_routes.lookup(validation_name)
+        route = zone_route[1] if zone_route else self._get_default_route()
+        if route is None or endpoint not in (None, route.endpoint):
+            return None
+        return route
+
+    def _group_by_route(
+        self, validations
+    ) -> Dict[Route, List[Validation]]:
+        """
+        Group validations by the route of their validation record.
+
+        :param validations: (domain, validation_name, validation) tuples
+        :return: the validations by route
+        :raise PluginError: if no credentials are configured for a record
+        """
+        groups: Dict[Route, List[Validation]] = {}
+        for validation in validations:
+            route = self._get_route(validation[1])
+            groups.setdefault(route, []).append(validation)
+        return groups
+
+    def _get_default_route(self) -> Optional[Route]:
+        """
+        Get the default endpoint and token from the cli or credentials file.
+
+        :return: the default route, or None if it is not configured
+        """
+        endpoint = self._get_endpoint()
+        token = self.conf("token") or (
+            self.credentials.conf("token") if self.credentials else None
+        )
+        if not endpoint or not token:
+            return None
+        return Route(endpoint, token)
+
+    def _get_endpoint(self) -> Optional[str]:
+        """
+        Get the configured default ISPConfig endpoint.
+
+        :return: the endpoint URL, without trailing slash
+        """
+        endpoint = self.conf("endpoint") or (
+            self.credentials.conf("endpoint") if self.credentials else None
+        )
+        return endpoint.rstrip("/") if endpoint else endpoint
+
+    def _get_setting(
+        self, name: str, default: Optional[float] = None
+    ) -> Optional[float]:
+        """
+        Get a number of seconds from the cli or credentials file.
+
+        :param name: the name of the setting
+        :param default: the value if the setting is not configured
+        :return: the configured seconds, or the default
+        :raise PluginError: if the setting is not a positive number
+        """
+        value = self.conf(name)
+        if value is None and self.credentials:
+            value = self.credentials.conf(name)
+        if value is None:
+            return default
+        try:
+            seconds = float(value)
+        except ValueError:
+            seconds = 0.0
+        if not seconds > 0:
+            raise errors.PluginError(
+                f"Invalid {name}: {value}, expected a positive number of "
+                "seconds"
+            )
+        return seconds
+
+    @contextlib.contextmanager
+    def _timed(self, phase: str) -> Iterator[None]:
+        """
+        Record the duration of a phase in the metrics of this run.
+
+        :param phase: the name of the phase
+        """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._metrics.observe_phase(phase, time.monotonic() - started)
+
+    def _write_metrics(self) -> None:
+        """
+        Write the metrics of this run to the metrics file, if configured.
+        Failing to write them does not fail the run.
+        """
+        path = self.conf("metrics-file")
+        if not path:
+            return
+        try:
+            self._metrics.write(path)
+        except OSError as e:
+            logger.warning("Failed to write metrics to %s: %s", path, e)
+
+    def _end_warm_up(self) -> None:
+        """
+        Wait for the connection warm-up at most WARM_UP_TIMEOUT seconds,
+        cancel the token checks that are left, and close the clients that
+        cleanup did not close.
+        """
+        checks = list(self._token_checks.values())
+        if checks:
+            wait(checks, timeout=WARM_UP_TIMEOUT)
+            for check in checks:
+                check.cancel()
+        self._close_ispconfig_clients()
+
+    def _close_ispconfig_clients(self) -> None:
+        """
+        Close all shared ISPConfigClients, and those of the spool, and save
+        the cassette.
+        """
+        clients, self._ispconfig_clients = self._ispconfig_clients, {}
+        for client in clients.values():
+            client.close()
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        if self._cassette is not None:
+            # the exchanges of all phases are recorded to the same file
+            self._cassette.save()
+
+
+def _log_token_check(endpoint: str, check: Future) -> None:
+    error = check.exception()
+    if error is None:
+        logger.debug("Connected to ISPConfig endpoint %s", endpoint)
+    else:
+        logger.warning("Connection warm-up to ISPConfig endpoint %s "
+                       "failed: %s", endpoint, error)
+
+
+def _zone_samples(
+    names: List[Tuple[str, str]], times: Dict[str, float]
+) -> Dict[str, float]:
+    """
+    Get the propagation time per zone, from the time per record name.
+
+    :param names: (zone, validation_name) pairs
+    :param times: the seconds until each name propagated
+    :return: the seconds until all names of a zone propagated, for the zones
+             whose names all propagated
+    """
+    samples: Dict[str, float] = {}
+    missing = set()
+    for zone, name in names:
+        if name not in times:
+            missing.add(zone)
+        else:
+            samples[zone] = max(samples.get(zone, 0.0), times[name])
+    return {zone: seconds for zone, seconds in samples.items()
+            if zone not in missing}
+
+
+def _records(validations: List[Validation]) -> List[Tuple[str, str]]:
+    """
+    Get the (record_fqdn, record_content) pairs of validations.
+
+    :param validations: (domain, validation_name, validation) tuples
+    :return: the records to add or delete
+    """
+    return [(name, value) for _, name, value in validations]
@@ -0,0 +1,195 @@
+"""
+Recording and replaying of the HTTP exchanges of ISPConfigClient, for fast
+and repeatable tests of complete issuance flows without an ISPConfig panel.
+
+A cassette is a JSON file listing the exchanges in the order they happened.
+The token is sent in the Authorization header, which is never written, and
+token query parameters are redacted. Requests are matched on their method
+and URL without the TXT content, since the ACME validations differ between
+runs.
+"""
+import json
+import os
+import tempfile
+import threading
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+RECORD = "record"
+REPLAY = "replay"
+MODES = (RECORD, REPLAY)
+CASSETTE_VERSION = 1
+REDACTED = "REDACTED"
+# query parameters replaced by REDACTED in the cassette
+REDACTED_PARAMS = ("token",)
+# query parameters ignored when matching a request
+IGNORED_PARAMS = ("data",)
+# response headers kept in the cassette
+RECORDED_HEADERS = ("Content-Type", "Retry-After")
+
+
+class CassetteError(requests.exceptions.RequestException):
+    """
+    The cassette has no exchange for a request, or could not be read.
+    """
+    pass
+
+
+class Cassette:
+    """
+    The exchanges of a cassette file, shared by the adapters of all clients.
+
+    In record mode, the exchanges are written when the cassette is saved
+    (or closed as a context manager). In replay mode, every request gets the
+    next recorded response of its method and URL; the last one is repeated
+    when they are used up, e.g. for extra health probes.
+    """
+
+    def __init__(self, path: str, mode: str = REPLAY) -> None:
+        """
+        Creates a new Cassette object.
+
+        :param path: the path of the cassette file
+        :param mode: 'record' or 'replay'
+        :raise CassetteError: if the mode is unknown, or the file of a
+                              replay cannot be read
+        """
+        if mode not in MODES:
+            raise CassetteError(f"Unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._interactions: List[Dict] = []
+        self._replayed: Dict[Tuple[str, str], int] = {}
+        if mode == REPLAY:
+            self._interactions = self._load()
+
+    def __enter__(self) -> "Cassette":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.save()
+
+    def record(self, request: requests.PreparedRequest,
+               response: requests.Response) -> None:
+        """
+        Append an exchange to the cassette.
+        """
+        headers = {name: response.headers[name] for name in RECORDED_HEADERS
+                   if name in response.headers}
+        with self._lock:
+            self._interactions.append({
+                "method": request.method,
+                "url": redact_url(request.url),
+                "status": response.status_code,
+                "headers": headers,
+                "body": response.text,
+            })
+
+    def replay(self, request: requests.PreparedRequest) -> requests.Response:
+        """
+        Build the recorded response to a request.
+
+        :raise CassetteError: if no exchange matches the request
+        """
+        key = (request.method, _match_url(request.url))
+        with self._lock:
+            matches = [interaction for interaction in self._interactions
+                       if (interaction["method"],
+                           _match_url(interaction["url"])) == key]
+            if not matches:
+                raise CassetteError(
+                    f"No recorded exchange for {request.method} "
+                    f"{redact_url(request.url)} in {self.path}",
+                    request=request
+                )
+            index = self._replayed.get(key, 0)
+            self._replayed[key] = index + 1
+            interaction = matches[min(index, len(matches) - 1)]
+        response = requests.Response()
+        response.status_code = interaction["status"]
+        response.headers = CaseInsensitiveDict(interaction["headers"])
+        response._content = interaction["body"].encode("utf-8")
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def save(self) -> None:
+        """
+        Write the recorded exchanges, if recording.
+        """
+        if self.mode != RECORD:
+            return
+        with self._lock:
+            content = {"version": CASSETTE_VERSION,
+                       "interactions": list(self._interactions)}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".cassette-")
+        try:
+            with os.fdopen(fd, "w") as tmp_file:
+                json.dump(content, tmp_file, indent=1)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _load(self) -> List[Dict]:
+        try:
+            with open(self.path) as cassette_file:
+                content = json.load(cassette_file)
+        except (OSError, ValueError) as e:
+            raise CassetteError(f"Cannot read cassette {self.path}: {e}")
+        if content.get("version") != CASSETTE_VERSION:
+            raise CassetteError(
+                f"Unsupported cassette version in {self.path}"
+            )
+        return content["interactions"]
+
+
+class CassetteAdapter(HTTPAdapter):
+    """
+    A transport adapter recording the exchanges of a session to a cassette,
+    or answering them from it without any network access.
+    """
+
+    def __init__(self, cassette: Cassette, **kwargs) -> None:
+        """
+        :param cassette: the cassette to record to or replay from
+        :param kwargs: the pool options of HTTPAdapter, used for recording
+        """
+        super(CassetteAdapter, self).__init__(**kwargs)
+        self.cassette = cassette
+
+    def send(self, request: requests.PreparedRequest, **kwargs):
+        if self.cassette.mode == REPLAY:
+            return self.cassette.replay(request)
+        response = super(CassetteAdapter, self).send(request, **kwargs)
+        self.cassette.record(request, response)
+        return response
+
+
+def redact_url(url: str) -> str:
+    """
+    Replace the values of token query parameters.
+
+    :param url: the URL of a request
+    :return: the URL without secrets
+    """
+    parts = urlsplit(url)
+    query = [(name, REDACTED if name.lower() in REDACTED_PARAMS else value)
+             for name, value in parse_qsl(parts.query,
+                                          keep_blank_values=True)]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def _match_url(url: str) -> str:
+    parts = urlsplit(redact_url(url))
+    query = [(name, value) for name, value
+             in parse_qsl(parts.query, keep_blank_values=True)
+             if name not in IGNORED_PARAMS]
+    return urlunsplit(parts._replace(query=urlencode(query)))
@@ -0,0 +1,454 @@
+"""
+A long-running daemon holding warm ISPConfigClients, and the clients and
+manual hook shim forwarding DDNS updates to it over a Unix socket.
+
+The daemon speaks JSON lines: every request is one object with the action
+('add' or 'delete'), the endpoint, the token and the (record_fqdn,
+record_content) pairs, every response is one object with 'ok' and, on
+errors, the 'error' and the 'failures' per record. A failure is a
+[record_fqdn, record_content, error, not_applied] list, where not_applied
+tells whether the record certainly stayed unchanged. An optional 'deadline'
+gives the seconds left in the time budget of the request.
+"""
+import argparse
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import stat
+import sys
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from certbot_dns_ispconfig_ddns.ispconfig_client import DEFAULT_MAX_WORKERS, \
+    DEFAULT_POOL_MAXSIZE, ISPConfigBulkError, ISPConfigClient, \
+    ISPConfigClientError, is_not_applied
+from certbot_dns_ispconfig_ddns.retry import DEFAULT_RETRIES, \
+    AdaptiveLimiter, CircuitBreaker, Deadline, RetryPolicy
+from certbot_dns_ispconfig_ddns.zones import Route
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET_PATH = "/run/certbot-dns-ispconfig-ddns.sock"
+DEFAULT_HOOK_PROPAGATION_SECONDS = 60
+MAX_MESSAGE_SIZE = 1 << 20
+# time the daemon gets to answer after the deadline of a request expired
+DEADLINE_GRACE_SECONDS = 1.0
+ACTIONS = ("add", "delete")
+
+
+class DDNSDaemon(socketserver.ThreadingMixIn,
+                 socketserver.UnixStreamServer):
+    """
+    Serves DDNS updates over a Unix socket with one shared ISPConfigClient
+    per endpoint and token, so the connection pools stay warm across all
+    certbot processes.
+
+    Requests from several connections run concurrently on the shared
+    clients. The socket is only accessible by the owner, as the requests
+    contain the tokens.
+    """
+    daemon_threads = True
+
+    def __init__(
+        self,
+        socket_path: str,
+        pool_size: int = DEFAULT_POOL_MAXSIZE,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        retries: int = DEFAULT_RETRIES,
+    ) -> None:
+        """
+        Creates a new DDNSDaemon and binds its socket.
+
+        :param socket_path: the path of the Unix socket
+        :param pool_size: the connections to keep open per endpoint
+        :param max_workers: the maximum number of records updated in
+                            parallel per request
+        :param retries: the retries of failed DDNS requests
+        :raise ISPConfigClientError: if another daemon uses the socket
+        """
+        _remove_stale_socket(socket_path)
+        self.pool_size = pool_size
+        self.max_workers = max_workers
+        self.retries = retries
+        self._clients: Dict[Route, ISPConfigClient] = {}
+        # the clients of all tokens share one limiter and one circuit
+        # breaker per endpoint URL
+        self._limiters: Dict[str, AdaptiveLimiter] = {}
+        self._circuit_breakers: Dict[str, CircuitBreaker] = {}
+        self._clients_lock = threading.Lock()
+        previous_umask = os.umask(0o177)
+        try:
+            super(DDNSDaemon, self).__init__(socket_path, _Handler)
+        finally:
+            os.umask(previous_umask)
+
+    def server_close(self) -> None:
+        super(DDNSDaemon, self).server_close()
+        with self._clients_lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients = {}
+        try:
+            os.unlink(self.server_address)
+        except FileNotFoundError:
+            pass
+
+    def update(
+        self,
+        action: str,
+        endpoint: str,
+        token: str,
+        records: List[Tuple[str, str]],
+        deadline: Optional[Deadline] = None,
+    ) -> None:
+        """
+        Add or delete records with the shared client of the route.
+
+        :param action: 'add' or 'delete'
+        :param endpoint: the ISPConfig endpoint
+        :param token: the DDNS token
+        :param records: the (record_fqdn, record_content) pairs
+        :param deadline: the time budget of the update
+        :raise ISPConfigBulkError: if some records failed
+        :raise ISPConfigClientError: if the request is invalid
+        """
+        if action not in ACTIONS:
+            raise ISPConfigClientError(f"Unknown action: {action}")
+        client = self._get_client(Route(endpoint.rstrip("/"), token))
+        update = (client.set_txt_records if action == "add"
+                  else client.del_txt_records)
+        update(records, max_workers=self.max_workers, deadline=deadline)
+
+    def _get_client(self, route: Route) -> ISPConfigClient:
+        with self._clients_lock:
+            if route not in self._clients:
+                self._clients[route] = ISPConfigClient(
+                    endpoint=route.endpoint,
+                    token=route.token,
+                    pool_maxsize=self.pool_size,
+                    retry_policy=RetryPolicy(retries=self.retries),
+                    circuit_breakers=self._circuit_breakers,
+                    limiters=self._limiters
+                )
+            return self._clients[route]
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in iter(lambda: self.rfile.readline(MAX_MESSAGE_SIZE), b""):
+            response = self._dispatch(line)
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+
+    def _dispatch(self, line: bytes) -> Dict:
+        try:
+            request = json.loads(line)
+            action, endpoint, token = (request["action"], request["endpoint"],
+                                       request["token"])
+            records = [(fqdn, content) for fqdn, content in request["records"]]
+            deadline = Deadline(
+                None if request.get("deadline") is None
+                else float(request["deadline"])
+            )
+        except (ValueError, KeyError, TypeError) as e:
+            return error_response(
+                ISPConfigClientError(f"Invalid request: {e!r}"), {}
+            )
+        try:
+            self.server.update(action, endpoint, token, records, deadline)
+        except ISPConfigBulkError as e:
+            return error_response(e, e.failures)
+        except Exception as e:
+            return error_response(e, {record: e for record in records})
+        return {"ok": True}
+
+
+def error_response(
+    error: Exception, failures: Dict[Tuple[str, str], Exception]
+) -> Dict:
+    """
+    Build the response to a failed update.
+
+    :param error: the error of the update
+    :param failures: the error per failed (record_fqdn, record_content) pair
+    :return: the response object
+    """
+    return {
+        "ok": False,
+        "error": str(error),
+        "failures": [[fqdn, content, str(e), is_not_applied(e)]
+                     for (fqdn, content), e in failures.items()],
+    }
+
+
+def _remove_stale_socket(socket_path: str) -> None:
+    """
+    Remove the socket of a daemon that is no longer running.
+
+    :raise ISPConfigClientError: if a daemon is listening on the socket
+    """
+    try:
+        if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            raise ISPConfigClientError(f"Not a socket: {socket_path}")
+    except FileNotFoundError:
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(socket_path)
+        except OSError:
+            os.unlink(socket_path)
+            return
+    raise ISPConfigClientError(f"A daemon is already running on {socket_path}")
+
+
+class DaemonClient:
+    """
+    Forwards the updates of one endpoint and token to a DDNSDaemon.
+
+    It offers the update methods of ISPConfigClient, so it can be used in
+    its place.
+    """
+
+    def __init__(
+        self,
+        socket_path: str,
+        endpoint: str,
+        token: str,
+        timeout: Optional[float] = None,
+    ) -> None:
+        """
+        Creates a new DaemonClient object.
+
+        :param socket_path: the path of the daemon's Unix socket
+        :param endpoint: the URL of the ISPConfig installation
+        :param token: the ISPConfig DDNS module token
+        :param timeout: the socket timeout in seconds, None to wait forever
+        """
+        self.socket_path = socket_path
+        self._endpoint = endpoint
+        self._token = token
+        self._timeout = timeout
+
+    def __enter__(self) -> "DaemonClient":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Nothing to close, every update uses its own connection.
+        """
+
+    def set_txt_record(self, record_fqdn: str, record_content: str) -> None:
+        self._send("add", [(record_fqdn, record_content)])
+
+    def del_txt_record(self, record_fqdn: str, record_content: str) -> None:
+        self._send("delete", [(record_fqdn, record_content)])
+
+    def set_txt_records(
+        self,
+        records: Iterable[Tuple[str, str]],
+        max_workers: int = None,
+        deadline: Optional[Deadline] = None,
+    ) -> None:
+        """
+        Add TXT records through the daemon.
+
+        :param records: the (record_fqdn, record_content) pairs
+        :param max_workers: ignored, the daemon limits the parallelism
+        :param deadline: the time budget, passed on to the daemon
+        :raises ISPConfigBulkError: if adding any record failed
+        """
+        self._send("add", list(records), deadline)
+
+    def del_txt_records(
+        self,
+        records: Iterable[Tuple[str, str]],
+        max_workers: int = None,
+        deadline: Optional[Deadline] = None,
+    ) -> None:
+        """
+        Delete TXT records through the daemon.
+
+        :param records: the (record_fqdn, record_content) pairs
+        :param max_workers: ignored, the daemon limits the parallelism
+        :param deadline: the time budget, passed on to the daemon
+        :raises ISPConfigBulkError: if deleting any record failed
+        """
+        self._send("delete", list(records), deadline)
+
+    def _send(
+        self,
+        action: str,
+        records: List[Tuple[str, str]],
+        deadline: Optional[Deadline] = None,
+    ) -> None:
+        """
+        Send one request to the daemon and wait for its response.
+
+        With a deadline, the daemon stops sending requests once it expired
+        and the socket waits at most a grace period longer for the response.
+
+        :raises ISPConfigBulkError: if the daemon reports failed records
+        :raises ISPConfigClientError: if the daemon rejected the request
+        :raises OSError: if the daemon is not reachable
+        """
+        if not records:
+            return
+        message = {"action": action, "endpoint": self._endpoint,
+                   "token": self._token, "records": records}
+        timeout = self._timeout
+        remaining = deadline.remaining() if deadline is not None else None
+        if remaining is not None:
+            message["deadline"] = remaining
+            timeout = remaining + DEADLINE_GRACE_SECONDS if timeout is None \
+                else min(timeout, remaining + DEADLINE_GRACE_SECONDS)
+        request = json.dumps(message)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(self.socket_path)
+            sock.sendall(request.encode() + b"\n")
+            with sock.makefile("rb") as stream:
+                line = stream.readline(MAX_MESSAGE_SIZE)
+        if not line:
+            raise ISPConfigClientError(
+                f"No response from the daemon on {self.socket_path}"
+            )
+        raise_for_response(action, json.loads(line))
+
+
+def raise_for_response(action: str, response: Dict) -> None:
+    """
+    Raise the errors of the response to an update, if it failed.
+
+    :param action: the DDNS action of the update ('add' or 'delete')
+    :param response: the response object
+    :raises ISPConfigBulkError: if the response reports failed records
+    :raises ISPConfigClientError: if the update was rejected
+    """
+    if response["ok"]:
+        return
+    if response["failures"]:
+        raise ISPConfigBulkError(action, {
+            (failure[0], failure[1]): _failure_error(failure)
+            for failure in response["failures"]
+        })
+    raise ISPConfigClientError(response["error"])
+
+
+def _failure_error(failure: List) -> ISPConfigClientError:
+    """
+    Rebuild the error of a failed record, which may have been applied
+    unless the response says otherwise.
+    """
+    error = ISPConfigClientError(failure[2])
+    error.attempted = not (len(failure) > 3 and failure[3])
+    return error
+
+
+def main(argv: List[str] = None) -> int:
+    """
+    Run the daemon until it is interrupted or terminated.
+    """
+    parser = argparse.ArgumentParser(
+        description="Keep ISPConfig DDNS clients warm and serve TXT record "
+                    "updates over a Unix socket."
+    )
+    parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH,
+                        help="path of the Unix socket (default: %(default)s)")
+    parser.add_argument("--pool-size", type=int, default=DEFAULT_POOL_MAXSIZE,
+                        help="keep-alive connections per endpoint")
+    parser.add_argument("--max-workers", type=int,
+                        default=DEFAULT_MAX_WORKERS,
+                        help="records updated in parallel per request")
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES,
+                        help="retries of failed DDNS requests")
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+
+    server = DDNSDaemon(args.socket, pool_size=args.pool_size,
+                        max_workers=args.max_workers, retries=args.retries)
+    signal.signal(
+        signal.SIGTERM,
+        lambda *_: threading.Thread(target=server.shutdown).start()
+    )
+    logger.info("Listening on %s", args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+def hook_main(argv: List[str] = None) -> int:
+    """
+    Add or delete the TXT record of a certbot manual hook invocation.
+
+    The domain and validation are read from the CERTBOT_DOMAIN and
+    CERTBOT_VALIDATION environment variables. The update is sent to the
+    daemon, or directly to the endpoint if the daemon is not running.
+    """
+    parser = argparse.ArgumentParser(
+        description="certbot --manual-auth-hook / --manual-cleanup-hook "
+                    "forwarding to the ISPConfig DDNS daemon."
+    )
+    parser.add_argument("action", choices=ACTIONS)
+    parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH,
+                        help="path of the daemon socket (default: "
+                             "%(default)s)")
+    parser.add_argument("--endpoint",
+                        default=os.environ.get("ISPCONFIG_DDNS_ENDPOINT"),
+                        help="ISPConfig endpoint (default: "
+                             "$ISPCONFIG_DDNS_ENDPOINT)")
+    parser.add_argument("--token",
+                        default=os.environ.get("ISPCONFIG_DDNS_TOKEN"),
+                        help="ISPConfig DDNS token (default: "
+                             "$ISPCONFIG_DDNS_TOKEN)")
+    parser.add_argument("--propagation-seconds", type=int,
+                        default=DEFAULT_HOOK_PROPAGATION_SECONDS,
+                        help="seconds to wait after adding the record "
+                             "(default: %(default)s)")
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    domain = os.environ.get("CERTBOT_DOMAIN")
+    validation = os.environ.get("CERTBOT_VALIDATION")
+    if not domain or not validation:
+        parser.error("CERTBOT_DOMAIN and CERTBOT_VALIDATION must be set")
+    if not args.endpoint or not args.token:
+        parser.error("an endpoint and a token are required")
+
+    record = ("_acme-challenge." + domain, validation)
+    try:
+        _hook_update(args, record)
+    except Exception as e:
+        print(f"Failed to {args.action} TXT record {record[0]}: {e}",
+              file=sys.stderr)
+        return 1
+    if args.action == "add":
+        time.sleep(args.propagation_seconds)
+    return 0
+
+
+def _hook_update(args: argparse.Namespace, record: Tuple[str, str]) -> None:
+    try:
+        client = DaemonClient(args.socket, args.endpoint, args.token)
+        if args.action == "add":
+            client.set_txt_records([record])
+        else:
+            client.del_txt_records([record])
+        return
+    except (FileNotFoundError, ConnectionRefusedError):
+        logger.info("No daemon on %s, updating the record directly",
+                    args.socket)
+    with ISPConfigClient(args.endpoint, args.token) as client:
+        if args.action == "add":
+            client.set_txt_record(*record)
+        else:
+            client.del_txt_record(*record)
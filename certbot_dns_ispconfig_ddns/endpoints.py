@@ -0,0 +1,205 @@
+"""Selection of the fastest healthy endpoint of a multi-server setup."""
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Mapping, Optional, Sequence, Union
+
+from certbot_dns_ispconfig_ddns.retry import CircuitBreaker
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROBE_INTERVAL = 30.0
+# weight of the newest latency sample in the moving average
+DEFAULT_SMOOTHING = 0.3
+
+
+def parse_endpoints(endpoints: Union[str, Sequence[str], None]) -> List[str]:
+    """
+    Parse the endpoints of a route, e.g. 'https://a:8080, https://b:8080'.
+
+    :param endpoints: comma separated endpoint URLs, or a list of them
+    :return: the endpoint URLs without trailing slash, in the given order
+    """
+    if not endpoints:
+        return []
+    if isinstance(endpoints, str):
+        endpoints = endpoints.split(",")
+    parsed: List[str] = []
+    for endpoint in endpoints:
+        endpoint = endpoint.strip().rstrip("/")
+        if endpoint and endpoint not in parsed:
+            parsed.append(endpoint)
+    return parsed
+
+
+class EndpointSelector:
+    """
+    Chooses the endpoint with the lowest latency among the healthy ones, for
+    ISPConfig multi-server setups where several panels serve the DDNS script.
+
+    The latency of every endpoint is a moving average of its responses,
+    including background probes, so a node that became slow is left as
+    soon as another one answers faster. A failed request or probe marks the
+    endpoint as down until a probe succeeds again. If all endpoints are
+    down, the fastest one is used anyway.
+
+    Every endpoint has its own circuit breaker, so repeated failures of one
+    node do not stop the requests to the others.
+    """
+
+    def __init__(
+        self,
+        endpoints: Sequence[str],
+        probe: Callable[[str], None],
+        probe_interval: Optional[float] = DEFAULT_PROBE_INTERVAL,
+        smoothing: float = DEFAULT_SMOOTHING,
+        circuit_breakers: Optional[Mapping[str, CircuitBreaker]] = None,
+    ) -> None:
+        """
+        Creates a new EndpointSelector object.
+
+        :param endpoints: the endpoint URLs, in order of preference while
+                          their latency is unknown
+        :param probe: checks one endpoint, raises an exception if it is down
+        :param probe_interval: the seconds between the probes of an
+                               endpoint, None for no background probes
+        :param smoothing: the weight of a new latency sample, 0 to 1
+        :param circuit_breakers: the circuit breakers by endpoint, a new
+                                 CircuitBreaker() for every endpoint without
+                                 one
+        """
+        if not endpoints:
+            raise ValueError("No endpoints to select from")
+        self.endpoints = list(endpoints)
+        self.probe_interval = probe_interval
+        self._probe = probe
+        self._smoothing = smoothing
+        self._circuit_breakers = {
+            endpoint: (circuit_breakers or {}).get(endpoint)
+            or CircuitBreaker()
+            for endpoint in self.endpoints
+        }
+        self._latency: Dict[str, float] = {}
+        self._down = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def start(self) -> None:
+        """
+        Start probing every endpoint in the background.
+        """
+        if self.probe_interval is None or self._threads:
+            return
+        for endpoint in self.endpoints:
+            thread = threading.Thread(
+                target=self._run, args=(endpoint,), daemon=True,
+                name=f"ispconfig-ddns-probe-{endpoint}"
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self) -> None:
+        """
+        Stop the background probes.
+        """
+        self._stopped.set()
+
+    def choose(self) -> str:
+        """
+        Get the endpoint to send the next request to.
+
+        :return: the healthy endpoint with the lowest latency
+        """
+        with self._lock:
+            candidates = [endpoint for endpoint in self.endpoints
+                          if endpoint not in self._down] or self.endpoints
+            return min(candidates, key=self._rank)
+
+    def choose_allowed(self) -> Optional[str]:
+        """
+        Get the endpoint to send the next request to, skipping endpoints
+        whose circuit breaker is open.
+
+        :return: the endpoint with the lowest latency, healthy ones first,
+                 whose circuit lets the request through; None if all
+                 circuits are open
+        """
+        with self._lock:
+            ranked = sorted(self.endpoints, key=lambda endpoint: (
+                endpoint in self._down, self._rank(endpoint)
+            ))
+        for endpoint in ranked:
+            if self._circuit_breakers[endpoint].allow():
+                return endpoint
+        return None
+
+    def has_healthy(self) -> bool:
+        """
+        Check whether any endpoint is believed to be up.
+        """
+        with self._lock:
+            return len(self._down) < len(self.endpoints)
+
+    def latency(self, endpoint: str) -> Optional[float]:
+        """
+        Get the average latency of an endpoint.
+
+        :return: the latency in seconds, None if it is not known yet
+        """
+        with self._lock:
+            return self._latency.get(endpoint)
+
+    def record_success(self, endpoint: str, seconds: float) -> None:
+        """
+        Record a response of an endpoint.
+
+        :param endpoint: the endpoint that responded
+        :param seconds: the time until the response
+        """
+        with self._lock:
+            previous = self._latency.get(endpoint)
+            self._latency[endpoint] = seconds if previous is None else \
+                previous + self._smoothing * (seconds - previous)
+            if endpoint in self._down:
+                logger.info("ISPConfig endpoint %s is up again", endpoint)
+                self._down.discard(endpoint)
+
+    def record_failure(self, endpoint: str) -> None:
+        """
+        Record a failed request to an endpoint and avoid it until it recovers.
+
+        :param endpoint: the endpoint that failed
+        """
+        with self._lock:
+            if endpoint not in self._down and len(self.endpoints) > 1:
+                logger.warning("ISPConfig endpoint %s is down, failing over",
+                               endpoint)
+            self._down.add(endpoint)
+
+    def probe(self, endpoint: str) -> bool:
+        """
+        Probe one endpoint and record the outcome.
+
+        :param endpoint: the endpoint to probe
+        :return: whether the endpoint is up
+        """
+        started = time.monotonic()
+        try:
+            self._probe(endpoint)
+        except Exception as e:
+            logger.debug("Probe of %s failed: %s", endpoint, e)
+            self.record_failure(endpoint)
+            return False
+        self.record_success(endpoint, time.monotonic() - started)
+        return True
+
+    def _rank(self, endpoint: str):
+        latency = self._latency.get(endpoint)
+        return (latency is None, latency or 0.0,
+                self.endpoints.index(endpoint))
+
+    def _run(self, endpoint: str) -> None:
+        while not self._stopped.is_set():
+            self.probe(endpoint)
+            self._stopped.wait(self.probe_interval)
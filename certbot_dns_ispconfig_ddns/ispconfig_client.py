@@ -1,40 +1,283 @@
 """DNS Authenticator for ISPConfig."""
+import itertools
 import logging
+from concurrent.futures import ThreadPoolExecutor
+import time
+from time import sleep
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from certbot_dns_ispconfig_ddns.endpoints import DEFAULT_PROBE_INTERVAL, \
+    EndpointSelector, parse_endpoints
+from certbot_dns_ispconfig_ddns.metrics import Metrics
+from certbot_dns_ispconfig_ddns.retry import AdaptiveLimiter, \
+    CircuitBreaker, Deadline, RetryPolicy
 
 # prevent urllib3 to log request with the api token
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
+logger = logging.getLogger(__name__)
+
 TXT_MAX_LEN = 255
 DDNS_SCRIPT_PATH = "/ddns/update.php"
+DEFAULT_POOL_CONNECTIONS = 1
+DEFAULT_POOL_MAXSIZE = 10
+DEFAULT_MAX_WORKERS = 10
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_READ_TIMEOUT = 30.0
 
 
 class ISPConfigClientError(Exception):
     """
     Errors directly from ISPConfigClient.
     """
+    # whether an earlier attempt of the request reached the endpoint, e.g.
+    # before the deadline expired or the circuit breaker opened
+    attempted = False
+
+
+class CircuitOpenError(ISPConfigClientError):
+    """
+    The circuit breaker of the endpoint is open, no request was sent.
+    """
     pass
 
 
+class DeadlineExceededError(ISPConfigClientError):
+    """
+    The time budget of the update ran out, the request was not (re)sent.
+    """
+    pass
+
+
+class TokenRejectedError(ISPConfigClientError):
+    """
+    The endpoint rejected the DDNS token.
+    """
+    pass
+
+
+class ISPConfigBulkError(ISPConfigClientError):
+    """
+    Some records of a bulk update failed.
+    """
+
+    def __init__(
+        self, action: str, failures: Dict[Tuple[str, str], Exception]
+    ) -> None:
+        """
+        :param action: the DDNS action ('add' or 'delete')
+        :param failures: the error per (record_fqdn, record_content) pair
+        """
+        super(ISPConfigBulkError, self).__init__(
+            f"Failed to {action} {len(failures)} TXT record(s): "
+            + "; ".join(f"{fqdn}: {error}"
+                        for (fqdn, _), error in failures.items())
+        )
+        self.action = action
+        self.failures = failures
+
+
+def _deadline_message(deadline: Deadline) -> str:
+    return f"Deadline of {deadline.seconds:g} seconds exceeded"
+
+
+def is_not_applied(error: Exception) -> bool:
+    """
+    Check whether a failed update certainly left the record unchanged.
+
+    :param error: the error of the update
+    :return: True if the request was never sent, or the endpoint rejected
+             it with a client error status
+    """
+    if isinstance(error, ISPConfigClientError):
+        return not error.attempted
+    if isinstance(error, requests.exceptions.HTTPError) \
+            and error.response is not None:
+        return 400 <= error.response.status_code < 500
+    return False
+
+
+def group_records(
+    records: Iterable[Tuple[str, str]]
+) -> Dict[str, List[str]]:
+    """
+    Deduplicate (record_fqdn, record_content) pairs and group them by name.
+
+    :param records: the (record_fqdn, record_content) pairs
+    :return: the unique record contents by record name, in input order
+    """
+    groups: Dict[str, List[str]] = {}
+    for record_fqdn, record_content in records:
+        values = groups.setdefault(record_fqdn, [])
+        if record_content not in values:
+            values.append(record_content)
+    return groups
+
+
+def build_query_params(
+    action: str, record_fqdn: str, record_content: str
+) -> Dict[str, str]:
+    """
+    Build the query parameters of a DDNS update request.
+
+    :param str action: the DDNS action ('add' or 'delete')
+    :param str record_fqdn: the validation record including domain name
+    :param str record_content: the record TXT content
+    :return: the query parameters
+    :raises ISPConfigClientError: if the TXT content is too big
+    """
+    if len(record_content) > TXT_MAX_LEN:
+        raise ISPConfigClientError(
+            f"TXT record is too big, max {TXT_MAX_LEN} chars allowed"
+        )
+    return {
+        "action": action,
+        "type": "TXT",
+        "record": record_fqdn,
+        "data": record_content,
+    }
+
+
 class ISPConfigClient:
     """
     Encapsulates all communication with the ISPConfig Remote REST API.
     """
 
-    def __init__(self, endpoint: str, token: str) -> None:
+    def __init__(
+        self,
+        endpoint: Union[str, Sequence[str]],
+        token: str,
+        pool_connections: int = DEFAULT_POOL_CONNECTIONS,
+        pool_maxsize: int = DEFAULT_POOL_MAXSIZE,
+        retry_policy: Optional[RetryPolicy] = None,
+        circuit_breakers: Optional[Dict[str, CircuitBreaker]] = None,
+        metrics: Optional[Metrics] = None,
+        limiters: Optional[Dict[str, AdaptiveLimiter]] = None,
+        connect_timeout: Optional[float] = DEFAULT_CONNECT_TIMEOUT,
+        read_timeout: Optional[float] = DEFAULT_READ_TIMEOUT,
+        probe_interval: Optional[float] = DEFAULT_PROBE_INTERVAL,
+        transport: Optional[HTTPAdapter] = None,
+    ) -> None:
         """
         Creates a new ISPConfigClient object.
 
+        All requests share one keep-alive session, so the TCP and TLS
+        handshake to the endpoint is only paid once per pooled connection.
+        Call close() (or use the client as a context manager) when done.
+
+        Connection errors, server errors and 429 responses are retried
+        according to the retry policy. Repeated failures open the circuit
+        breaker of an endpoint, after which requests fail fast with
+        CircuitOpenError.
+
+        With several endpoints serving the same zones, each request goes to
+        the healthy endpoint with the lowest latency, and failed requests
+        are retried on another endpoint right away, or go there while the
+        circuit of an endpoint is open. The endpoints are probed in the
+        background until the client is closed.
+
+        :param endpoint: the URL of the ISPConfig installation, or several
+                         comma separated URLs of a multi-server setup
         :param token: the ISPConfig DDNS module token used for API calls
+        :param pool_connections: the number of connection pools to cache
+        :param pool_maxsize: the maximum number of connections to keep
+                             open to the endpoint
+        :param retry_policy: the retry policy, defaults to RetryPolicy()
+        :param circuit_breakers: the circuit breakers by endpoint URL,
+                                 shared with the clients of other tokens;
+                                 a CircuitBreaker() is added for every
+                                 endpoint without one
+        :param metrics: the metrics to record every request in
+        :param limiters: the limiters of the requests in flight by
+                         endpoint URL, shared with the clients of other
+                         tokens; an AdaptiveLimiter up to pool_maxsize is
+                         added for every endpoint without one
+        :param connect_timeout: the seconds to wait for a connection, None
+                                to wait forever
+        :param read_timeout: the seconds to wait for a response, None to
+                             wait forever
+        :param probe_interval: the seconds between the health probes of
+                               several endpoints, None to not probe
+        :param transport: the adapter sending the requests, e.g. a
+                          CassetteAdapter, defaults to a pooled HTTPAdapter
         :raise ISPConfigClientError: if the endpoint or token are missing
         """
-        if endpoint is None or len(endpoint) == 0:
+        endpoints = parse_endpoints(endpoint)
+        if not endpoints:
             raise ISPConfigClientError(f"Missing endpoint: {endpoint}")
         if token is None or len(token) == 0:
             raise ISPConfigClientError(f"Missing token: {token}")
-        self._endpoint = endpoint.rstrip("/")
+        self._endpoint = ", ".join(endpoints)
         self._token = token.strip()
+        self._session = requests.Session()
+        self._session.auth = ('anonymous', self._token)
+        adapter = transport or HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._retry_policy = retry_policy or RetryPolicy()
+        self._circuit_breakers = {} if circuit_breakers is None \
+            else circuit_breakers
+        for url in endpoints:
+            self._circuit_breakers.setdefault(url, CircuitBreaker())
+        self._metrics = metrics
+        self._limiters = {} if limiters is None else limiters
+        for url in endpoints:
+            self._limiters.setdefault(
+                url, AdaptiveLimiter(max_limit=pool_maxsize)
+            )
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._selector: Optional[EndpointSelector] = None
+        if len(endpoints) > 1:
+            self._selector = EndpointSelector(
+                endpoints, self._probe, probe_interval,
+                circuit_breakers=self._circuit_breakers
+            )
+            self._selector.start()
+
+    def __enter__(self) -> "ISPConfigClient":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Close the underlying session and all pooled connections, and stop
+        probing the endpoints.
+        """
+        if self._selector is not None:
+            self._selector.close()
+        self._session.close()
+
+    def check_token(self, timeout: Optional[float] = None) -> None:
+        """
+        Connect to the endpoint and check that it accepts the token, without
+        changing any record.
+
+        The connection stays in the pool, so the first update does not pay
+        for the DNS lookup and the TCP and TLS handshake.
+
+        :param timeout: seconds the check may take at most, on top of the
+                        connect and read timeouts
+        :raises TokenRejectedError: if the endpoint rejects the token
+        :raises ISPConfigClientError: if the endpoint returns a server error
+        :raises requests.exceptions.RequestException: if the endpoint could
+                                                      not be reached in time
+        """
+        endpoint = self._selector.choose() if self._selector is not None \
+            else self._endpoint
+        response = self._probe(endpoint, timeout)
+        if response.status_code in (401, 403):
+            raise TokenRejectedError(
+                f"Token rejected by {endpoint} ({response.status_code})"
+            )
 
     def set_txt_record(self, record_fqdn: str, record_content: str) -> None:
         """
@@ -45,23 +288,7 @@ class ISPConfigClient:
         :param str record_content: The record TXT content that should be set
         :raises ISPConfigClientError: if an error occurs
         """
-        if len(record_content) > TXT_MAX_LEN:
-            raise ISPConfigClientError(
-                f"TXT record is too big, max {TXT_MAX_LEN} chars allowed"
-            )
-        update_url = f"{self._endpoint}{DDNS_SCRIPT_PATH}"
-        query_params = {
-            "action": "add",
-            "type": "TXT",
-            "record": record_fqdn,
-            "data": record_content,
-        }
-        response: requests.Response = requests.post(
-            url=update_url,
-            params=query_params,
-            auth=('anonymous', self._token)
-        )
-        response.raise_for_status()
+        self._send("POST", "add", record_fqdn, record_content)
 
     def del_txt_record(self, record_fqdn: str, record_content: str) -> None:
         """
@@ -72,20 +299,332 @@ class ISPConfigClient:
         :param str record_content: The record TXT content that should be set
         :raises ISPConfigClientError: if an error occurs
         """
-        if len(record_content) > TXT_MAX_LEN:
+        self._send("DELETE", "delete", record_fqdn, record_content)
+
+    def set_txt_records(
+        self,
+        records: Iterable[Tuple[str, str]],
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        deadline: Optional[Deadline] = None,
+    ) -> None:
+        """
+        Add many TXT records, e.g. all records of an ACME order.
+
+        Duplicate records are only sent once. Records with the same name are
+        sent one after another, different names in parallel.
+
+        :param records: the (record_fqdn, record_content) pairs to add
+        :param max_workers: the maximum number of requests in parallel
+        :param deadline: the time budget of the whole update
+        :raises ISPConfigBulkError: if any record could not be added, after
+                                    all other records were sent
+        """
+        self._send_bulk("POST", "add", records, max_workers, deadline)
+
+    def del_txt_records(
+        self,
+        records: Iterable[Tuple[str, str]],
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        deadline: Optional[Deadline] = None,
+    ) -> None:
+        """
+        Delete many TXT records, e.g. all records of an ACME order.
+
+        Duplicate records are only sent once. Records with the same name are
+        sent one after another, different names in parallel.
+
+        :param records: the (record_fqdn, record_content) pairs to delete
+        :param max_workers: the maximum number of requests in parallel
+        :param deadline: the time budget of the whole update
+        :raises ISPConfigBulkError: if any record could not be deleted, after
+                                    all other records were sent
+        """
+        self._send_bulk("DELETE", "delete", records, max_workers, deadline)
+
+    def _send_bulk(
+        self,
+        method: str,
+        action: str,
+        records: Iterable[Tuple[str, str]],
+        max_workers: int,
+        deadline: Optional[Deadline] = None,
+    ) -> None:
+        """
+        Send the requests of a bulk update through a bounded worker pool.
+
+        Once the deadline expired, the requests still waiting for a worker
+        fail with DeadlineExceededError without being sent.
+
+        :param str method: the HTTP method to use
+        :param str action: the DDNS action ('add' or 'delete')
+        :param records: the (record_fqdn, record_content) pairs
+        :param max_workers: the maximum number of requests in parallel
+        :param deadline: the time budget of the whole bulk update
+        :raises ISPConfigBulkError: if any record failed
+        """
+        groups = group_records(records)
+        if not groups:
+            return
+        failures: Dict[Tuple[str, str], Exception] = {}
+        workers = max(1, min(max_workers, len(groups)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(
+                lambda group: self._send_group(
+                    method, action, *group, deadline=deadline
+                ),
+                groups.items()
+            )
+            for group_failures in results:
+                failures.update(group_failures)
+        if failures:
+            raise ISPConfigBulkError(action, failures)
+
+    def _send_group(
+        self,
+        method: str,
+        action: str,
+        record_fqdn: str,
+        contents: List[str],
+        deadline: Optional[Deadline] = None,
+    ) -> Dict[Tuple[str, str], Exception]:
+        """
+        Send the requests for all contents of one record name in order.
+
+        :return: the error per failed (record_fqdn, record_content) pair
+        """
+        failures: Dict[Tuple[str, str], Exception] = {}
+        for record_content in contents:
+            try:
+                self._send(method, action, record_fqdn, record_content,
+                           deadline)
+            except Exception as e:
+                failures[(record_fqdn, record_content)] = e
+        return failures
+
+    def _send(
+        self,
+        method: str,
+        action: str,
+        record_fqdn: str,
+        record_content: str,
+        deadline: Optional[Deadline] = None,
+    ) -> None:
+        """
+        Send a single request to the DDNS update script, with retries.
+
+        :param str method: the HTTP method to use
+        :param str action: the DDNS action ('add' or 'delete')
+        :param str record_fqdn: the validation record including domain name
+        :param str record_content: the record TXT content
+        :param deadline: the time budget of the request and its retries
+        :raises ISPConfigClientError: if the TXT content is too big
+        :raises CircuitOpenError: if the circuit breaker is open
+        :raises DeadlineExceededError: if the deadline expired
+        :raises requests.exceptions.HTTPError: if the endpoint returns an
+                                               error status
+        :raises requests.exceptions.ConnectionError: if the endpoint is not
+                                                     reachable
+        """
+        query_params = build_query_params(action, record_fqdn, record_content)
+        for attempt in itertools.count():
+            final = attempt >= self._retry_policy.retries
+            try:
+                done, retry_after = self._request(
+                    method, query_params, final, deadline
+                )
+            except ISPConfigClientError as e:
+                e.attempted = attempt > 0
+                raise
+            if done:
+                return
+            delay = self._retry_policy.delay(attempt, retry_after)
+            if self._selector is not None and self._selector.has_healthy():
+                delay = 0.0  # fail over to another endpoint right away
+            remaining = deadline.remaining() if deadline is not None else None
+            if remaining is not None and delay >= remaining:
+                error = DeadlineExceededError(_deadline_message(deadline))
+                error.attempted = True
+                raise error
+            logger.debug("Retrying %s of %s in %.2f seconds (retry %d/%d)",
+                         action, record_fqdn, delay, attempt + 1,
+                         self._retry_policy.retries)
+            if self._metrics is not None:
+                self._metrics.observe_retry(self._endpoint, action, delay)
+            sleep(delay)
+
+    def _request(
+        self,
+        method: str,
+        params: Dict[str, str],
+        final: bool,
+        deadline: Optional[Deadline] = None,
+    ) -> Tuple[bool, Optional[str]]:
+        """
+        Send one attempt of a request and decide whether to retry it.
+
+        :param str method: the HTTP method to use
+        :param dict params: the query parameters
+        :param bool final: whether this is the last allowed attempt
+        :param deadline: the time budget of the request
+        :return: whether the request is done, and the Retry-After header of
+                 the response if it should be retried
+        :raises DeadlineExceededError: if the deadline expired
+        :raises: the error of the request, if it is final or not retryable
+        """
+        remaining = deadline.remaining() if deadline is not None else None
+        if remaining == 0.0:
+            raise DeadlineExceededError(_deadline_message(deadline))
+        endpoint = self._choose_endpoint()
+        try:
+            with self._limiters[endpoint].slot(timeout=remaining) as slot:
+                response = self._attempt(
+                    slot, endpoint, method, params, remaining
+                )
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout):
+            if final:
+                raise
+            return False, None
+        except TimeoutError:
+            breaker = self._circuit_breakers[endpoint]
+            if breaker.state == CircuitBreaker.HALF_OPEN:
+                # the trial of the half-open circuit was never sent
+                breaker.record_failure()
+            raise DeadlineExceededError(_deadline_message(deadline))
+        if not self._retry_policy.is_retryable_status(response.status_code):
+            response.raise_for_status()
+            return True, None
+        if final:
+            response.raise_for_status()
+        return False, response.headers.get("Retry-After")
+
+    def _choose_endpoint(self) -> str:
+        """
+        Get the endpoint to send the next attempt of a request to.
+
+        :return: the endpoint URL
+        :raises CircuitOpenError: if the circuit breakers of all endpoints
+                                  are open
+        """
+        if self._selector is not None:
+            endpoint = self._selector.choose_allowed()
+        elif self._circuit_breakers[self._endpoint].allow():
+            endpoint = self._endpoint
+        else:
+            endpoint = None
+        if endpoint is None:
+            raise CircuitOpenError(
+                f"Circuit breaker open for {self._endpoint}, "
+                "too many consecutive failures"
+            )
+        return endpoint
+
+    def _attempt(
+        self,
+        slot,
+        endpoint: str,
+        method: str,
+        params: Dict[str, str],
+        remaining: Optional[float],
+    ) -> requests.Response:
+        """
+        Send one attempt of a request while holding a limiter slot of the
+        endpoint.
+
+        :param slot: the slot of the adaptive limiter of the endpoint
+        :param endpoint: the endpoint URL
+        :param remaining: the remaining seconds of the deadline, if any
+        :return: the response
+        :raises requests.exceptions.RequestException: if the endpoint could
+                                                      not be reached in time
+        """
+        breaker = self._circuit_breakers[endpoint]
+        started = time.monotonic()
+        try:
+            response: requests.Response = self._session.request(
+                method=method,
+                url=f"{endpoint}{DDNS_SCRIPT_PATH}",
+                params=params,
+                timeout=self._timeout(remaining)
+            )
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            slot.failure()
+            self._observe(endpoint, params, "timeout" if isinstance(
+                e, requests.exceptions.Timeout
+            ) else "connection_error", started, failed=True)
+            breaker.record_failure()
+            raise
+        except Exception:
+            # a trial of a half-open circuit must not leave it half-open
+            breaker.record_failure()
+            raise
+        failed = self._retry_policy.is_retryable_status(response.status_code)
+        self._observe(endpoint, params, str(response.status_code), started,
+                      failed)
+        if failed:
+            slot.failure()
+            breaker.record_failure()
+        else:
+            slot.success()
+            breaker.record_success()
+        return response
+
+    def _timeout(
+        self, remaining: Optional[float]
+    ) -> Tuple[Optional[float], Optional[float]]:
+        """
+        Get the connect and read timeouts, capped by the deadline.
+        """
+        connect, read = self._connect_timeout, self._read_timeout
+        if remaining is not None:
+            connect = remaining if connect is None else min(connect, remaining)
+            read = remaining if read is None else min(read, remaining)
+        return connect, read
+
+    def _probe(
+        self, endpoint: str, timeout: Optional[float] = None
+    ) -> requests.Response:
+        """
+        Check that an endpoint serves the DDNS update script.
+
+        The script authenticates the token before it validates the
+        parameters, so a request without parameters changes nothing.
+
+        :param endpoint: the endpoint to check
+        :param timeout: seconds the check may take at most
+        :return: the response of the endpoint
+        :raises ISPConfigClientError: if the endpoint returns a server error
+        :raises requests.exceptions.RequestException: if the endpoint could
+                                                      not be reached in time
+        """
+        response = self._session.head(f"{endpoint}{DDNS_SCRIPT_PATH}",
+                                      timeout=self._timeout(timeout))
+        if response.status_code >= 500:
             raise ISPConfigClientError(
-                f"TXT record is too big, max {TXT_MAX_LEN} chars allowed"
+                f"Endpoint {endpoint} returned {response.status_code}"
             )
-        update_url = f"{self._endpoint}{DDNS_SCRIPT_PATH}"
-        query_params = {
-            "action": "delete",
-            "type": "TXT",
-            "record": record_fqdn,
-            "data": record_content,
-        }
-        response: requests.Response = requests.delete(
-            url=update_url,
-            params=query_params,
-            auth=('anonymous', self._token)
-        )
-        response.raise_for_status()
+        return response
+
+    def _observe(
+        self,
+        endpoint: str,
+        params: Dict[str, str],
+        status: str,
+        started: float,
+        failed: bool,
+    ) -> None:
+        """
+        Record one attempt in the metrics and the endpoint selector.
+        """
+        seconds = time.monotonic() - started
+        if self._metrics is not None:
+            self._metrics.observe_request(
+                endpoint, params["action"], status, seconds
+            )
+        if self._selector is None:
+            return
+        if failed:
+            self._selector.record_failure(endpoint)
+        else:
+            self._selector.record_success(endpoint, seconds)
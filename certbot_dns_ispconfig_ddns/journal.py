@@ -0,0 +1,423 @@
+"""
+Persistent state of TXT records: the cleanup journal, the state cache and
+the propagation history.
+"""
+import contextlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, \
+    Tuple
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover (windows)
+    fcntl = None
+
+from certbot_dns_ispconfig_ddns.metrics import percentile
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_FILE_NAME = "ispconfig-ddns-journal.json"
+STATE_FILE_NAME = "ispconfig-ddns-state.json"
+DEFAULT_STATE_TTL = 300
+# journal entries of running processes are younger, see CleanupJournal
+DEFAULT_LEFTOVER_AGE = 3600
+HISTORY_FILE_NAME = "ispconfig-ddns-propagation.json"
+DEFAULT_HISTORY_SAMPLES = 20
+DEFAULT_HISTORY_MIN_SAMPLES = 3
+DEFAULT_HISTORY_PERCENTILE = 95
+
+
+class _JSONFile:
+    """
+    A JSON list of entries, rewritten atomically and guarded by a lock file,
+    so several certbot processes can share it.
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        :param path: the path of the file
+        """
+        self.path = path
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _entries(self) -> Iterator[List[Dict]]:
+        """
+        Lock the file, yield its entries and write back any changes.
+        """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        with self._lock, open(f"{self.path}.lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            entries = self._read()
+            original = list(entries)
+            yield entries
+            if entries != original:
+                self._write(directory, entries)
+
+    def _read(self) -> List[Dict]:
+        try:
+            with open(self.path) as json_file:
+                return json.load(json_file)
+        except FileNotFoundError:
+            return []
+        except ValueError:
+            # a truncated file must not block the plugin
+            return []
+
+    def _write(self, directory: str, entries: List[Dict]) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".journal-")
+        try:
+            with os.fdopen(fd, "w") as tmp_file:
+                json.dump(entries, tmp_file, indent=1)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+class CleanupJournal(_JSONFile):
+    """
+    A JSON file listing the TXT records created by the plugin which were
+    not deleted yet.
+
+    Records are added before they are created and removed once they were
+    deleted, so a crashed or killed run leaves a journal that can be
+    replayed. Every entry names the process that added it, as the records of
+    concurrent runs which are still validating must not be replayed.
+    """
+
+    def __init__(
+        self, path: str, clock: Callable[[], float] = time.time
+    ) -> None:
+        """
+        :param path: the path of the file
+        :param clock: the wall clock, for testing
+        """
+        super(CleanupJournal, self).__init__(path)
+        self._clock = clock
+
+    def add(self, endpoint: str, records: Iterable[Tuple[str, str]]) -> None:
+        """
+        Add records to the journal. Records already in the journal are taken
+        over by this process.
+
+        :param endpoint: the endpoint the records are created with
+        :param records: the (record_fqdn, record_content) pairs
+        """
+        now = int(self._clock())
+        with self._entries() as entries:
+            known = {_key(entry): index for index, entry in enumerate(entries)}
+            for record_fqdn, record_content in records:
+                entry = {"endpoint": endpoint, "record": record_fqdn,
+                         "data": record_content, "created": now,
+                         "pid": os.getpid()}
+                if _key(entry) in known:
+                    entries[known[_key(entry)]] = entry
+                else:
+                    known[_key(entry)] = len(entries)
+                    entries.append(entry)
+
+    def remove(
+        self, endpoint: str, records: Iterable[Tuple[str, str]]
+    ) -> None:
+        """
+        Remove deleted records from the journal.
+
+        :param endpoint: the endpoint the records were deleted with
+        :param records: the (record_fqdn, record_content) pairs
+        """
+        removed = {(endpoint, fqdn, content) for fqdn, content in records}
+        with self._entries() as entries:
+            entries[:] = [e for e in entries if _key(e) not in removed]
+
+    def pending(
+        self, endpoint: Optional[str] = None
+    ) -> List[Tuple[str, str, str]]:
+        """
+        Get the records that still have to be deleted.
+
+        :param endpoint: only return the records of this endpoint
+        :return: (endpoint, record_fqdn, record_content) tuples
+        """
+        with self._entries() as entries:
+            return [_key(entry) for entry in entries
+                    if endpoint is None or entry["endpoint"] == endpoint]
+
+    def leftovers(
+        self, min_age: float = DEFAULT_LEFTOVER_AGE
+    ) -> List[Tuple[str, str, str, float]]:
+        """
+        Get the records left over by runs that ended without cleanup: those
+        of processes that are no longer running, and all older than min_age.
+
+        :param min_age: the seconds after which a record is left over even
+                        if its process seems to run, e.g. as its pid was
+                        reused or it runs on another host
+        :return: (endpoint, record_fqdn, record_content, age) tuples
+        """
+        now = self._clock()
+        with self._entries() as entries:
+            return [(*_key(entry), now - entry.get("created", 0))
+                    for entry in entries
+                    if now - entry.get("created", 0) >= min_age
+                    or not _is_running(entry.get("pid"))]
+
+
+def _key(entry: Dict) -> Tuple[str, str, str]:
+    return entry["endpoint"], entry["record"], entry["data"]
+
+
+def _is_running(pid: Optional[int]) -> bool:
+    """
+    Check whether a process is running. Entries without pid are assumed to
+    belong to a running process, so only their age counts.
+    """
+    if pid is None or pid == os.getpid() or os.name == "nt":
+        # signal 0 would terminate the process on windows
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # e.g. owned by another user, or no signals on windows
+        return True
+    return True
+
+
+class RecordStateCache(_JSONFile):
+    """
+    A JSON file remembering whether TXT records were last added (present)
+    or deleted (absent) by the plugin, keyed by endpoint, name and value.
+
+    Adding a present or deleting an absent record is a no-op for the DDNS
+    API, so such calls can be skipped. The state expires after a TTL, as the
+    records may be changed outside of the plugin.
+    """
+    PRESENT = "present"
+    ABSENT = "absent"
+
+    def __init__(
+        self,
+        path: str,
+        ttl: float = DEFAULT_STATE_TTL,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        """
+        Creates a new RecordStateCache object.
+
+        :param path: the path of the state file
+        :param ttl: the seconds after which a state expires
+        :param clock: the wall clock, for testing
+        """
+        super(RecordStateCache, self).__init__(path)
+        self.ttl = ttl
+        self._clock = clock
+
+    def known(
+        self, endpoint: str, records: Iterable[Tuple[str, str]]
+    ) -> Dict[Tuple[str, str], str]:
+        """
+        Get the unexpired state of records.
+
+        :param endpoint: the endpoint of the records
+        :param records: the (record_fqdn, record_content) pairs
+        :return: the state per record with a known state
+        """
+        wanted = {(endpoint, fqdn, content) for fqdn, content in records}
+        now = self._clock()
+        known = {}
+        with self._entries() as entries:
+            for entry in entries:
+                key = _key(entry)
+                if key in wanted and now - entry["updated"] < self.ttl:
+                    known[key[1:]] = entry["state"]
+        return known
+
+    def mark(
+        self, endpoint: str, records: Iterable[Tuple[str, str]], state: str
+    ) -> None:
+        """
+        Set the state of records, and drop all expired states.
+
+        :param endpoint: the endpoint of the records
+        :param records: the (record_fqdn, record_content) pairs
+        :param state: PRESENT or ABSENT
+        """
+        now = self._clock()
+        updated = {(endpoint, fqdn, content): {
+            "endpoint": endpoint, "record": fqdn, "data": content,
+            "state": state, "updated": now,
+        } for fqdn, content in records}
+        if not updated:
+            return
+        with self._entries() as entries:
+            entries[:] = [entry for entry in entries
+                          if _key(entry) not in updated
+                          and now - entry["updated"] < self.ttl]
+            entries.extend(updated.values())
+
+
+class PropagationHistory(_JSONFile):
+    """
+    A JSON file with the recent propagation times of each zone, to wait
+    as long as a zone really needs instead of the global propagation
+    seconds.
+
+    Only the newest samples of a zone are kept, so the estimate follows
+    changes of the nameserver setup.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_samples: int = DEFAULT_HISTORY_SAMPLES,
+        min_samples: int = DEFAULT_HISTORY_MIN_SAMPLES,
+        percent: int = DEFAULT_HISTORY_PERCENTILE,
+    ) -> None:
+        """
+        Creates a new PropagationHistory object.
+
+        :param path: the path of the history file
+        :param max_samples: the samples to keep per zone
+        :param min_samples: the samples a zone needs for an estimate
+        :param percent: the percentile of the samples to estimate with
+        """
+        super(PropagationHistory, self).__init__(path)
+        self.max_samples = max_samples
+        self.min_samples = min_samples
+        self.percent = percent
+
+    def estimate(self, zones: Iterable[str]) -> Dict[str, float]:
+        """
+        Estimate the propagation time of zones from their history.
+
+        :param zones: the zone names
+        :return: the seconds per zone with enough samples
+        """
+        wanted = set(zones)
+        with self._entries() as entries:
+            return {
+                entry["zone"]: percentile(sorted(entry["samples"]),
+                                          self.percent)
+                for entry in entries
+                if entry["zone"] in wanted
+                and len(entry["samples"]) >= self.min_samples
+            }
+
+    def record(self, samples: Dict[str, float]) -> None:
+        """
+        Add a propagation time sample per zone.
+
+        :param samples: the seconds per zone
+        """
+        if not samples:
+            return
+        with self._entries() as entries:
+            history = {entry["zone"]: entry["samples"] for entry in entries}
+            for zone, seconds in samples.items():
+                history[zone] = (history.get(zone, [])
+                                 + [round(seconds, 3)])[-self.max_samples:]
+            entries[:] = [{"zone": zone, "samples": values}
+                          for zone, values in history.items()]
+
+    def reset(self, zones: Iterable[str]) -> None:
+        """
+        Forget the history of zones, e.g. after a failed validation.
+
+        :param zones: the zone names
+        """
+        forgotten = set(zones)
+        with self._entries() as entries:
+            entries[:] = [entry for entry in entries
+                          if entry["zone"] not in forgotten]
+
+
+class DeferredCleanup:
+    """
+    Deletes journaled TXT records on a background worker, so cleanup does
+    not block certbot.
+
+    The worker thread is joined when the interpreter exits, records that
+    could not be deleted stay in the journal for the next run.
+    """
+
+    def __init__(
+        self,
+        journal: CleanupJournal,
+        max_workers: int,
+        state: Optional[RecordStateCache] = None,
+    ) -> None:
+        """
+        Creates a new DeferredCleanup object.
+
+        :param journal: the journal of the records to delete
+        :param max_workers: the maximum number of deletions in parallel
+        :param state: the state cache to mark deleted records as absent in
+        """
+        self.journal = journal
+        self.state = state
+        self._max_workers = max_workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="ispconfig-ddns-cleanup"
+        )
+
+    def submit(
+        self, client, endpoint: str, records: List[Tuple[str, str]]
+    ) -> Future:
+        """
+        Delete records in the background and remove them from the journal.
+
+        :param client: the ISPConfigClient to delete the records with
+        :param endpoint: the endpoint of the client, as used in the journal
+        :param records: the (record_fqdn, record_content) pairs to delete
+        :return: the future of the deletion
+        """
+        return self._executor.submit(self._drain, client, endpoint, records)
+
+    def close(
+        self, clients: Iterable, on_done: Optional[Callable[[], None]] = None
+    ) -> None:
+        """
+        Close the clients once all submitted deletions are done, and stop the
+        worker thread after that.
+
+        :param clients: the ISPConfigClients to close
+        :param on_done: called after the clients were closed
+        """
+        for client in clients:
+            self._executor.submit(client.close)
+        if on_done is not None:
+            self._executor.submit(on_done)
+        self._executor.shutdown(wait=False)
+
+    def _drain(
+        self, client, endpoint: str, records: List[Tuple[str, str]]
+    ) -> None:
+        from certbot_dns_ispconfig_ddns.ispconfig_client import \
+            ISPConfigBulkError
+
+        if not records:
+            return
+        try:
+            client.del_txt_records(records, max_workers=self._max_workers)
+            deleted = records
+        except ISPConfigBulkError as e:
+            logger.warning("Deferred cleanup failed, kept in journal %s: %s",
+                           self.journal.path, e)
+            deleted = [r for r in records if r not in e.failures]
+        except Exception as e:
+            logger.warning("Deferred cleanup failed, kept in journal %s: %s",
+                           self.journal.path, e)
+            deleted = []
+        self.journal.remove(endpoint, deleted)
+        if self.state is not None:
+            self.state.mark(endpoint, deleted, RecordStateCache.ABSENT)
@@ -0,0 +1,219 @@
+"""Timing and counters of ISPConfig DDNS calls, exported per run."""
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Tuple
+
+# upper bounds of the request duration histogram, in seconds
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PROMETHEUS_SUFFIX = ".prom"
+METRIC_PREFIX = "ispconfig_ddns"
+
+
+class Metrics:
+    """
+    Collects the duration and status of every DDNS request, the retries and
+    the duration of each phase of a run.
+
+    Requests are labelled with the endpoint and the DDNS action only, the
+    token is never part of the metrics. All methods are thread-safe.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._requests: Counter = Counter()
+        self._durations: Dict[Tuple[str, str], List[float]] = \
+            defaultdict(list)
+        self._retries: Counter = Counter()
+        self._retry_wait: Dict[Tuple[str, str], float] = defaultdict(float)
+        self._phases: Dict[str, float] = {}
+
+    def observe_request(
+        self, endpoint: str, action: str, status: str, seconds: float
+    ) -> None:
+        """
+        Record one attempt of a DDNS request.
+
+        :param endpoint: the endpoint the request was sent to
+        :param action: the DDNS action ('add' or 'delete')
+        :param status: the HTTP status code, or 'connection_error'
+        :param seconds: the duration of the request
+        """
+        with self._lock:
+            self._requests[(endpoint, action, status)] += 1
+            self._durations[(endpoint, action)].append(seconds)
+
+    def observe_retry(self, endpoint: str, action: str, delay: float) -> None:
+        """
+        Record a retry of a DDNS request.
+
+        :param endpoint: the endpoint of the request
+        :param action: the DDNS action ('add' or 'delete')
+        :param delay: the backoff before the retry, in seconds
+        """
+        with self._lock:
+            self._retries[(endpoint, action)] += 1
+            self._retry_wait[(endpoint, action)] += delay
+
+    def observe_phase(self, phase: str, seconds: float) -> None:
+        """
+        Record the duration of a phase of the run, e.g. 'propagation'.
+
+        :param phase: the name of the phase
+        :param seconds: the duration of the phase
+        """
+        with self._lock:
+            self._phases[phase] = self._phases.get(phase, 0.0) + seconds
+
+    def snapshot(self) -> Dict:
+        """
+        Get all metrics as a JSON serializable dict.
+
+        :return: the requests by status, the request durations with
+                 percentiles, the retries and the phase durations
+        """
+        with self._lock:
+            return self._snapshot()
+
+    def _snapshot(self) -> Dict:
+        return {
+            "timestamp": time.time(),
+            "requests": [
+                {"endpoint": endpoint, "action": action,
+                 "status": status, "count": count}
+                for (endpoint, action, status), count
+                in sorted(self._requests.items())
+            ],
+            "request_duration_seconds": [
+                _summary(endpoint, action, samples)
+                for (endpoint, action), samples
+                in sorted(self._durations.items())
+            ],
+            "retries": [
+                {"endpoint": endpoint, "action": action, "count": count,
+                 "wait_seconds": self._retry_wait[(endpoint, action)]}
+                for (endpoint, action), count
+                in sorted(self._retries.items())
+            ],
+            "phase_duration_seconds": dict(sorted(self._phases.items())),
+        }
+
+    def to_prometheus(self) -> str:
+        """
+        Render all metrics in the Prometheus text exposition format, as read
+        by the node_exporter textfile collector.
+
+        :return: the metrics text
+        """
+        with self._lock:
+            snapshot = self._snapshot()
+            durations = {key: list(samples)
+                         for key, samples in self._durations.items()}
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} {kind}")
+            for suffix, labels, value in samples:
+                lines.append(f"{METRIC_PREFIX}_{name}{suffix}"
+                             f"{_labels(labels)} {_number(value)}")
+
+        metric("requests_total", "counter",
+               "DDNS requests by endpoint, action and status.",
+               [("", {"endpoint": r["endpoint"], "action": r["action"],
+                      "status": r["status"]}, r["count"])
+                for r in snapshot["requests"]])
+        metric("request_duration_seconds", "histogram",
+               "Duration of DDNS requests.",
+               [sample for summary in snapshot["request_duration_seconds"]
+                for sample in _histogram(summary, durations)])
+        metric("retries_total", "counter",
+               "Retried DDNS requests.",
+               [("", {"endpoint": r["endpoint"], "action": r["action"]},
+                 r["count"]) for r in snapshot["retries"]])
+        metric("retry_wait_seconds_total", "counter",
+               "Backoff time before retried DDNS requests.",
+               [("", {"endpoint": r["endpoint"], "action": r["action"]},
+                 r["wait_seconds"]) for r in snapshot["retries"]])
+        metric("phase_duration_seconds", "gauge",
+               "Duration of the phases of the last run.",
+               [("", {"phase": phase}, seconds) for phase, seconds
+                in snapshot["phase_duration_seconds"].items()])
+        metric("last_run_timestamp_seconds", "gauge",
+               "Time the metrics were written.",
+               [("", {}, snapshot["timestamp"])])
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """
+        Write the metrics atomically, as a node_exporter textfile if the path
+        ends with '.prom' and as JSON otherwise.
+
+        :param path: the path of the metrics file
+        """
+        if path.endswith(PROMETHEUS_SUFFIX):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.snapshot(), indent=1) + "\n"
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".metrics-")
+        try:
+            with os.fdopen(fd, "w") as tmp_file:
+                tmp_file.write(content)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+def _summary(endpoint: str, action: str, samples: List[float]) -> Dict:
+    ordered = sorted(samples)
+    return {
+        "endpoint": endpoint,
+        "action": action,
+        "count": len(ordered),
+        "sum": sum(ordered),
+        "max": ordered[-1],
+        **{f"p{p}": percentile(ordered, p) for p in (50, 95, 99)},
+    }
+
+
+def percentile(ordered: List[float], percent: int) -> float:
+    """
+    Get a percentile of sorted samples with the nearest-rank method.
+    """
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[rank - 1]
+
+
+def _histogram(
+    summary: Dict, durations: Dict[Tuple[str, str], List[float]]
+):
+    labels = {"endpoint": summary["endpoint"], "action": summary["action"]}
+    samples = durations[(summary["endpoint"], summary["action"])]
+    for bound in DURATION_BUCKETS:
+        count = sum(1 for sample in samples if sample <= bound)
+        yield "_bucket", {**labels, "le": _number(bound)}, count
+    yield "_bucket", {**labels, "le": "+Inf"}, summary["count"]
+    yield "_sum", labels, summary["sum"]
+    yield "_count", labels, summary["count"]
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        f'{name}="' + str(value).replace("\\", "\\\\").replace('"', '\\"')
+        .replace("\n", "\\n") + '"'
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
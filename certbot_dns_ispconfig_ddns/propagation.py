@@ -0,0 +1,163 @@
+"""Active DNS propagation checks for the challenge TXT records."""
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.query
+import dns.rdatatype
+import dns.resolver
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_QUERY_TIMEOUT = 2.0
+DEFAULT_POLL_INTERVAL = 1.0
+DEFAULT_MAX_WORKERS = 10
+
+
+class PropagationChecker:
+    """
+    Polls the authoritative nameservers of the validation records until all
+    expected TXT values are visible, or the timeout expires.
+    """
+
+    def __init__(
+        self,
+        nameservers: Optional[List[str]] = None,
+        port: int = 53,
+        query_timeout: float = DEFAULT_QUERY_TIMEOUT,
+        poll_interval: float = DEFAULT_POLL_INTERVAL,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+    ) -> None:
+        """
+        Creates a new PropagationChecker object.
+
+        :param nameservers: IP addresses of the nameservers to query, instead
+                            of looking up the authoritative nameservers of
+                            each validation record
+        :param port: the port the nameservers listen on
+        :param query_timeout: the timeout of a single DNS query in seconds
+        :param poll_interval: the time to wait between two polling rounds
+        :param max_workers: the maximum number of DNS queries in parallel
+        """
+        self._nameservers = nameservers
+        self._port = port
+        self._query_timeout = query_timeout
+        self._poll_interval = poll_interval
+        self._max_workers = max_workers
+
+    def wait_for(
+        self,
+        records: Iterable[Tuple[str, str]],
+        timeout: float,
+        times: Optional[Dict[str, float]] = None,
+    ) -> bool:
+        """
+        Wait until every nameserver serves all expected TXT values.
+
+        :param records: the (validation_name, validation) pairs to wait for
+        :param timeout: the maximum time to wait in seconds
+        :param times: filled with the seconds until each record name was
+                      served by all nameservers, if given
+        :return: True if all records propagated, False if the timeout expired
+        :raise dns.exception.DNSException: if the nameserver lookup fails
+        """
+        started = time.monotonic()
+        deadline = started + timeout
+        pending = {
+            (nameserver, name): values
+            for name, values in _group_records(records).items()
+            for nameserver in self.nameservers_for(name)
+        }
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            while pending:
+                keys = list(pending)
+                found = executor.map(lambda key: self.query_txt(*key), keys)
+                for key, values in zip(keys, found):
+                    if pending[key] <= values:
+                        del pending[key]
+                if times is not None:
+                    done = {name for _, name in keys} - \
+                        {name for _, name in pending}
+                    times.update((name, time.monotonic() - started)
+                                 for name in done if name not in times)
+                remaining = deadline - time.monotonic()
+                if not pending or remaining <= 0:
+                    break
+                time.sleep(min(self._poll_interval, remaining))
+        if pending:
+            logger.debug("TXT records not yet propagated: %s",
+                         sorted(name for _, name in pending))
+        return not pending
+
+    def nameservers_for(self, name: str) -> List[str]:
+        """
+        Find the IP addresses of the authoritative nameservers of a record.
+
+        :param name: the record name
+        :return: the nameserver IP addresses
+        :raise dns.exception.DNSException: if the lookup fails
+        """
+        if self._nameservers:
+            return list(self._nameservers)
+        zone = dns.resolver.zone_for_name(name)
+        addresses = []
+        for ns in dns.resolver.resolve(zone, dns.rdatatype.NS):
+            addresses.extend(self._addresses(ns.target))
+        logger.debug("Authoritative nameservers of %s (zone %s): %s",
+                     name, zone, addresses)
+        return addresses
+
+    def query_txt(self, nameserver: str, name: str) -> Set[str]:
+        """
+        Query one nameserver for the TXT values of a record.
+
+        Query errors are logged and treated as 'not yet propagated'.
+
+        :param nameserver: the IP address of the nameserver
+        :param name: the record name
+        :return: the TXT values served for the record
+        """
+        query = dns.message.make_query(name, dns.rdatatype.TXT)
+        try:
+            response = dns.query.udp(query, nameserver,
+                                     timeout=self._query_timeout,
+                                     port=self._port)
+            if response.flags & dns.flags.TC:
+                response = dns.query.tcp(query, nameserver,
+                                         timeout=self._query_timeout,
+                                         port=self._port)
+        except (dns.exception.DNSException, OSError) as e:
+            logger.debug("TXT query for %s at %s failed: %s",
+                         name, nameserver, e)
+            return set()
+        return set(_txt_values(response.answer))
+
+    @staticmethod
+    def _addresses(host: "dns.name.Name") -> Iterable[str]:
+        for rdtype in (dns.rdatatype.A, dns.rdatatype.AAAA):
+            try:
+                for address in dns.resolver.resolve(host, rdtype):
+                    yield address.to_text()
+            except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
+                continue
+
+
+def _txt_values(answer: Iterable["dns.rrset.RRset"]) -> Iterable[str]:
+    for rrset in answer:
+        if rrset.rdtype != dns.rdatatype.TXT:
+            continue
+        for rdata in rrset:
+            yield b"".join(rdata.strings).decode()
+
+
+def _group_records(
+    records: Iterable[Tuple[str, str]]
+) -> Dict[str, Set[str]]:
+    grouped: Dict[str, Set[str]] = {}
+    for name, value in records:
+        grouped.setdefault(name, set()).add(value)
+    return grouped
@@ -0,0 +1,278 @@
+"""
+A maintenance command deleting stale `_acme-challenge` TXT records, e.g.
+those left behind by crashed or killed runs whose cleanup never ran.
+
+The records are read from a file of 'fqdn value' lines, or from the cleanup
+journal of the plugin. Journal entries are only purged once they are old
+enough that their run cannot still be waiting for the validation, or their
+process is gone. They are deleted in parallel, with a limit on the requests
+per second, and every deleted record is removed from the journal.
+"""
+import argparse
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+import configobj
+from certbot import errors
+
+from certbot_dns_ispconfig_ddns.ispconfig_client import DEFAULT_MAX_WORKERS, \
+    ISPConfigClient
+from certbot_dns_ispconfig_ddns.journal import DEFAULT_LEFTOVER_AGE, \
+    CleanupJournal
+from certbot_dns_ispconfig_ddns.retry import RateLimiter
+from certbot_dns_ispconfig_ddns.zones import Route, ZoneIndex, \
+    load_zone_routes
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RATE = 10.0
+CREDENTIALS_PREFIX = "dns_ispconfig_ddns_"
+
+# (endpoint or None, record_fqdn, record_content)
+Record = Tuple[Optional[str], str, str]
+# (route, record_fqdn, record_content)
+Deletion = Tuple[Route, str, str]
+
+
+def read_records(lines: Iterable[str]) -> List[Record]:
+    """
+    Parse records from 'fqdn value' lines. Empty lines and comments starting
+    with '#' are skipped.
+
+    :param lines: the lines to parse
+    :return: the records, without endpoint
+    :raise ValueError: if a line has no value
+    """
+    records: List[Record] = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        fields = line.split(None, 1)
+        if len(fields) != 2:
+            raise ValueError(f"Line {number}: expected 'fqdn value'")
+        records.append((None, fields[0], fields[1].strip('"')))
+    return records
+
+
+def plan(
+    records: Iterable[Record],
+    zone_routes: ZoneIndex[Route],
+    default_route: Optional[Route],
+) -> Tuple[List[Deletion], List[Record]]:
+    """
+    Find the endpoint and token of every record.
+
+    :param records: the records to delete; a record with an endpoint is only
+                    deleted with a route of that endpoint
+    :param zone_routes: the routes of the configured zones
+    :param default_route: the route of records outside all zones
+    :return: the deletions, and the records without credentials
+    """
+    deletions: List[Deletion] = []
+    unroutable: List[Record] = []
+    for endpoint, fqdn, content in records:
+        zone_route = zone_routes.lookup(fqdn)
+        route = zone_route[1] if zone_route else default_route
+        if route is None or endpoint not in (None, route.endpoint):
+            unroutable.append((endpoint, fqdn, content))
+        else:
+            deletions.append((route, fqdn, content))
+    return deletions, unroutable
+
+
+def purge(
+    deletions: List[Deletion],
+    get_client: Callable[[Route], ISPConfigClient],
+    workers: int = DEFAULT_MAX_WORKERS,
+    rate: float = DEFAULT_RATE,
+) -> Dict[Deletion, Exception]:
+    """
+    Delete records in parallel.
+
+    :param deletions: the records and their routes
+    :param get_client: gets the client of a route
+    :param workers: the maximum number of deletions at once
+    :param rate: the maximum number of deletions per second, 0 or less for
+                 no limit
+    :return: the error of every deletion that failed
+    """
+    limiter = RateLimiter(rate)
+
+    def delete(deletion: Deletion) -> Optional[Exception]:
+        route, fqdn, content = deletion
+        limiter.acquire()
+        try:
+            get_client(route).del_txt_record(fqdn, content)
+        except Exception as e:
+            logger.debug("Deleting %s failed", fqdn, exc_info=True)
+            return e
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        errors = list(executor.map(delete, deletions))
+    return {deletion: error for deletion, error in zip(deletions, errors)
+            if error is not None}
+
+
+def load_credentials(
+    args: argparse.Namespace,
+) -> Tuple[ZoneIndex[Route], Optional[Route]]:
+    """
+    Load the routes of the credentials file and the command line, which
+    takes precedence for the default route.
+
+    :return: the routes of the zones, and the default route
+    :raise OSError: if the credentials file does not exist
+    :raise configobj.ConfigObjError: if the credentials file is malformed
+    :raise PluginError: if a zone section is invalid
+    """
+    confobj = configobj.ConfigObj(args.credentials, file_error=True) \
+        if args.credentials else {}
+    endpoint = args.endpoint or confobj.get(CREDENTIALS_PREFIX + "endpoint")
+    token = args.token or confobj.get(CREDENTIALS_PREFIX + "token")
+    default_route = Route(endpoint.rstrip("/"), token) \
+        if endpoint and token else None
+    return load_zone_routes(confobj, endpoint), default_route
+
+
+def main(argv: List[str] = None) -> int:
+    """
+    Delete the stale TXT records of a file or of the cleanup journal.
+    """
+    parser = argparse.ArgumentParser(
+        description="Delete stale _acme-challenge TXT records through the "
+                    "ISPConfig DDNS module."
+    )
+    parser.add_argument("--records",
+                        help="file with one 'fqdn value' pair per line, '-' "
+                             "for stdin")
+    parser.add_argument("--journal",
+                        help="cleanup journal of the plugin to replay")
+    parser.add_argument("--min-age", type=float,
+                        default=DEFAULT_LEFTOVER_AGE,
+                        help="seconds since a journal entry was written "
+                             "before it is purged, unless its process is "
+                             "gone (default: %(default)s)")
+    parser.add_argument("--credentials",
+                        help="credentials INI file of the plugin")
+    parser.add_argument("--endpoint",
+                        default=os.environ.get("ISPCONFIG_DDNS_ENDPOINT"),
+                        help="ISPConfig endpoint (default: "
+                             "$ISPCONFIG_DDNS_ENDPOINT)")
+    parser.add_argument("--token",
+                        default=os.environ.get("ISPCONFIG_DDNS_TOKEN"),
+                        help="ISPConfig DDNS token (default: "
+                             "$ISPCONFIG_DDNS_TOKEN)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_MAX_WORKERS,
+                        help="records deleted at once (default: "
+                             "%(default)s)")
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE,
+                        help="records deleted per second, 0 for no limit "
+                             "(default: %(default)s)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only report the records that would be deleted")
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    if not args.records and not args.journal:
+        parser.error("--records or --journal is required")
+    logging.basicConfig(level=logging.WARNING,
+                        format="%(asctime)s %(levelname)s %(message)s")
+
+    try:
+        records, ages = _read_input(args)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    try:
+        zone_routes, default_route = load_credentials(args)
+    except (OSError, configobj.ConfigObjError, errors.PluginError) as e:
+        parser.error(str(e))
+    deletions, unroutable = plan(records, zone_routes, default_route)
+    for endpoint, fqdn, content in unroutable:
+        print(f"skipped  {fqdn} {content}: no credentials"
+              + (f" for {endpoint}" if endpoint else ""))
+    if args.dry_run:
+        for route, fqdn, content in deletions:
+            age = ages.get((route.endpoint, fqdn, content))
+            print(f"would delete  {fqdn} {content} ({route.endpoint}"
+                  + (f", journaled {age:.0f}s ago" if age is not None
+                     else "") + ")")
+        print(f"{len(deletions)} record(s) would be deleted, "
+              f"{len(unroutable)} skipped")
+        return 0
+
+    failures = _purge(deletions, args)
+    _report(deletions, failures)
+    if args.journal:
+        _update_journal(CleanupJournal(args.journal), deletions, failures)
+    print(f"{len(deletions) - len(failures)} record(s) deleted, "
+          f"{len(failures)} failed, {len(unroutable)} skipped")
+    return 1 if failures or unroutable else 0
+
+
+def _report(
+    deletions: List[Deletion], failures: Dict[Deletion, Exception]
+) -> None:
+    for deletion in deletions:
+        _, fqdn, content = deletion
+        if deletion in failures:
+            print(f"failed   {fqdn} {content}: {failures[deletion]}")
+        else:
+            print(f"deleted  {fqdn} {content}")
+
+
+def _update_journal(
+    journal: CleanupJournal,
+    deletions: List[Deletion],
+    failures: Dict[Deletion, Exception],
+) -> None:
+    deleted: Dict[str, List[Tuple[str, str]]] = {}
+    for route, fqdn, content in deletions:
+        if (route, fqdn, content) not in failures:
+            deleted.setdefault(route.endpoint, []).append((fqdn, content))
+    for endpoint, records in deleted.items():
+        journal.remove(endpoint, records)
+
+
+def _read_input(
+    args: argparse.Namespace,
+) -> Tuple[List[Record], Dict[Record, float]]:
+    """
+    Read the records of the file and the journal.
+
+    :return: the records, and the age in seconds of the journal entries
+    """
+    records: List[Record] = []
+    if args.records == "-":
+        records += read_records(sys.stdin)
+    elif args.records:
+        with open(args.records) as records_file:
+            records += read_records(records_file)
+    ages: Dict[Record, float] = {}
+    if args.journal:
+        for endpoint, fqdn, content, age in \
+                CleanupJournal(args.journal).leftovers(args.min_age):
+            records.append((endpoint, fqdn, content))
+            ages[(endpoint, fqdn, content)] = age
+    return records, ages
+
+
+def _purge(
+    deletions: List[Deletion], args: argparse.Namespace
+) -> Dict[Deletion, Exception]:
+    # created before the deletions start, so no lock is needed
+    clients: Dict[Route, ISPConfigClient] = {}
+    for route, _, _ in deletions:
+        if route not in clients:
+            clients[route] = ISPConfigClient(
+                endpoint=route.endpoint, token=route.token,
+                pool_maxsize=args.workers
+            )
+    try:
+        return purge(deletions, clients.__getitem__, workers=args.workers,
+                     rate=args.rate)
+    finally:
+        for client in clients.values():
+            client.close()
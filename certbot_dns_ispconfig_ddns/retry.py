@@ -0,0 +1,380 @@
+"""Retry, circuit breaker, concurrency and rate policies for the DDNS API."""
+import contextlib
+import email.utils
+import random
+import threading
+import time
+from typing import Callable, Iterator, Optional
+
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_BACKOFF_MAX = 30.0
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30.0
+DEFAULT_INITIAL_LIMIT = 2
+DEFAULT_MAX_LIMIT = 10
+DEFAULT_DECREASE_FACTOR = 0.5
+DEFAULT_LATENCY_TOLERANCE = 2.0
+DEFAULT_LATENCY_SLACK = 0.05
+
+
+class RetryPolicy:
+    """
+    Decides which responses are retried and how long to wait in between.
+
+    Waits grow exponentially with the attempt number and use full jitter,
+    a Retry-After header of the response takes precedence.
+    """
+
+    def __init__(
+        self,
+        retries: int = DEFAULT_RETRIES,
+        backoff_factor: float = DEFAULT_BACKOFF_FACTOR,
+        backoff_max: float = DEFAULT_BACKOFF_MAX,
+        jitter: bool = True,
+    ) -> None:
+        """
+        Creates a new RetryPolicy object.
+
+        :param retries: the maximum number of retries after the first attempt
+        :param backoff_factor: the base wait in seconds, doubled per attempt
+        :param backoff_max: the maximum wait in seconds
+        :param jitter: whether to randomize the wait between 0 and the
+                       exponential backoff
+        """
+        self.retries = max(0, retries)
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+
+    @staticmethod
+    def is_retryable_status(status_code: int) -> bool:
+        """
+        Check whether a response status is worth retrying.
+
+        :param status_code: the HTTP status code
+        :return: True for server errors and 429 Too Many Requests
+        """
+        return status_code >= 500 or status_code == 429
+
+    def delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """
+        Get the time to wait before the next attempt.
+
+        :param attempt: the number of the failed attempt, starting at 0
+        :param retry_after: the Retry-After header of the response, if any
+        :return: the time to wait in seconds
+        """
+        if retry_after:
+            seconds = _parse_retry_after(retry_after)
+            if seconds is not None:
+                return min(self.backoff_max, seconds)
+        backoff = min(self.backoff_max, self.backoff_factor * 2 ** attempt)
+        if self.jitter:
+            return random.uniform(0, backoff)
+        return backoff
+
+
+def _parse_retry_after(value: str) -> Optional[float]:
+    """
+    Parse a Retry-After header, given in seconds or as an HTTP date.
+
+    :param value: the header value
+    :return: the seconds to wait, or None if the value is invalid
+    """
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date is None:  # pragma: no cover (python < 3.10)
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to an endpoint after repeated failures.
+
+    After `failure_threshold` consecutive failures the circuit opens and
+    requests fail fast. Once `reset_timeout` has passed, a single trial
+    request is let through: it closes the circuit on success and opens it
+    again on failure.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(
+        self,
+        failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+        reset_timeout: float = DEFAULT_RESET_TIMEOUT,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        """
+        Creates a new CircuitBreaker object.
+
+        :param failure_threshold: consecutive failures that open the circuit
+        :param reset_timeout: seconds until an open circuit lets a trial
+                              request through
+        :param clock: the monotonic clock to use
+        """
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+
+    @property
+    def state(self) -> str:
+        """
+        The current state of the circuit.
+        """
+        return self._state
+
+    def allow(self) -> bool:
+        """
+        Check whether a request may be sent.
+
+        :return: False while the circuit is open
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN and \
+                    self._clock() - self._opened_at >= self.reset_timeout:
+                self._state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self) -> None:
+        """
+        Record a request that reached a healthy endpoint.
+        """
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self) -> None:
+        """
+        Record a failed request, opening the circuit if needed.
+        """
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or \
+                    self._failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = self._clock()
+
+
+class Deadline:
+    """
+    A time budget shared by all requests of a phase, e.g. of perform.
+    """
+
+    def __init__(
+        self,
+        seconds: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        """
+        Creates a new Deadline object.
+
+        :param seconds: the budget in seconds, None for no deadline
+        :param clock: the monotonic clock to use
+        """
+        self.seconds = seconds
+        self._clock = clock
+        self._expires = None if seconds is None else clock() + seconds
+
+    def remaining(self) -> Optional[float]:
+        """
+        Get the remaining budget.
+
+        :return: the remaining seconds, or None without deadline
+        """
+        if self._expires is None:
+            return None
+        return max(0.0, self._expires - self._clock())
+
+    def expired(self) -> bool:
+        """
+        Check whether the budget is used up.
+        """
+        return self.remaining() == 0.0
+
+
+class AdaptiveLimiter:
+    """
+    Limits the requests in flight to an endpoint with AIMD, as TCP does.
+
+    The limit starts low and doubles per round trip (slow start) until the
+    endpoint shows overload, then grows by one per round trip. Failures
+    (connection errors, 5xx and 429 responses) and latencies far above the
+    fastest observed one halve the limit, at most once per round trip.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = DEFAULT_INITIAL_LIMIT,
+        max_limit: int = DEFAULT_MAX_LIMIT,
+        min_limit: int = 1,
+        decrease_factor: float = DEFAULT_DECREASE_FACTOR,
+        latency_tolerance: float = DEFAULT_LATENCY_TOLERANCE,
+        latency_slack: float = DEFAULT_LATENCY_SLACK,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        """
+        Creates a new AdaptiveLimiter object.
+
+        :param initial_limit: the requests in flight at the start
+        :param max_limit: the upper bound of the limit
+        :param min_limit: the lower bound of the limit
+        :param decrease_factor: the factor applied to the limit on overload
+        :param latency_tolerance: latencies above this multiple of the
+                                  fastest observed latency signal overload
+        :param latency_slack: latency increases up to these seconds never
+                              signal overload, to ignore jitter
+        :param clock: the monotonic clock to use
+        """
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.latency_slack = latency_slack
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._limit = float(
+            min(self.max_limit, max(self.min_limit, initial_limit))
+        )
+        self._in_flight = 0
+        self._slow_start = True
+        self._min_latency: Optional[float] = None
+        self._last_decrease = float("-inf")
+
+    @property
+    def limit(self) -> int:
+        """
+        The current number of requests allowed in flight.
+        """
+        return int(self._limit)
+
+    @contextlib.contextmanager
+    def slot(self, timeout: Optional[float] = None) -> Iterator["_Slot"]:
+        """
+        Wait for a free slot and hold it while sending one request.
+
+        Report the outcome with the `success()` or `failure()` method of the
+        yielded slot, a slot without outcome does not change the limit.
+
+        :param timeout: the maximum seconds to wait, None to wait forever
+        :raise TimeoutError: if no slot became free in time
+        """
+        with self._condition:
+            if not self._condition.wait_for(
+                lambda: self._in_flight < self.limit, timeout
+            ):
+                raise TimeoutError("No free request slot")
+            self._in_flight += 1
+        request_slot = _Slot(self, self._clock())
+        try:
+            yield request_slot
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def _on_success(self, started: float) -> None:
+        latency = self._clock() - started
+        with self._condition:
+            if self._min_latency is None or latency < self._min_latency:
+                self._min_latency = latency
+            if latency > self._min_latency * self.latency_tolerance \
+                    + self.latency_slack:
+                self._decrease(started)
+                return
+            # one round trip raises the limit by its current value in slow
+            # start and by one afterwards
+            self._limit = min(
+                float(self.max_limit),
+                self._limit + (1.0 if self._slow_start else 1.0 / self._limit)
+            )
+            self._condition.notify_all()
+
+    def _on_failure(self, started: float) -> None:
+        with self._condition:
+            self._decrease(started)
+
+    def _decrease(self, started: float) -> None:
+        # requests sent before the last decrease saw the old limit
+        if started < self._last_decrease:
+            return
+        self._slow_start = False
+        self._limit = max(float(self.min_limit),
+                          self._limit * self.decrease_factor)
+        self._last_decrease = self._clock()
+
+
+class _Slot:
+    """
+    A request slot of an AdaptiveLimiter.
+    """
+
+    def __init__(self, limiter: AdaptiveLimiter, started: float) -> None:
+        self._limiter = limiter
+        self._started = started
+
+    def success(self) -> None:
+        """
+        Report a response of a healthy endpoint.
+        """
+        self._limiter._on_success(self._started)
+
+    def failure(self) -> None:
+        """
+        Report a failure that signals overload.
+        """
+        self._limiter._on_failure(self._started)
+
+
+class RateLimiter:
+    """
+    Spaces requests evenly, to send at most a given number per second.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        clock: Callable[[], float] = time.monotonic,
+        sleep: Callable[[float], None] = time.sleep,
+    ) -> None:
+        """
+        Creates a new RateLimiter object.
+
+        :param rate: the requests per second, 0 or less for no limit
+        :param clock: the monotonic clock to use
+        :param sleep: sleeps the given seconds
+        """
+        self.rate = rate
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._next = float("-inf")
+
+    def acquire(self) -> None:
+        """
+        Wait until the next request may be sent.
+        """
+        if self.rate <= 0:
+            return
+        with self._lock:
+            now = self._clock()
+            start = max(now, self._next)
+            self._next = start + 1.0 / self.rate
+        if start > now:
+            self._sleep(start - now)
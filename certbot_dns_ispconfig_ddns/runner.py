@@ -0,0 +1,301 @@
+"""
+A runner obtaining or renewing many certificates in parallel with this
+plugin.
+
+certbot locks its config directory, so `certbot renew` handles the lineages
+one after another and every lineage waits its own propagation time. The
+runner starts one certbot process per lineage, each with its own config
+directory below a common root, in a thread pool so their propagation waits
+overlap. All processes forward their updates to one daemon, so they share
+its pooled clients. A summary of the time every lineage took is printed at
+the end.
+
+The config directory of a lineage only holds the lock, the work and the
+logs of its process. Its account and lineage directories are links to a
+base config directory, e.g. /etc/letsencrypt, so all processes use its ACME
+account and renew its lineages in place.
+"""
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+from certbot_dns_ispconfig_ddns.daemon import DDNSDaemon
+from certbot_dns_ispconfig_ddns.ispconfig_client import DEFAULT_MAX_WORKERS, \
+    DEFAULT_POOL_MAXSIZE
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 8
+DEFAULT_BASE_CONFIG_DIR = "/etc/letsencrypt"
+AUTHENTICATOR = "dns-ispconfig-ddns"
+# directories of the base config directory linked into every config
+# directory, so the account and the lineages are shared
+SHARED_DIRS = ("accounts", "renewal", "live", "archive")
+
+
+class Job(NamedTuple):
+    """A lineage to renew, or to obtain for the given domains."""
+    name: str
+    domains: Tuple[str, ...] = ()
+
+
+class JobResult(NamedTuple):
+    """The outcome of the certbot process of a job."""
+    job: Job
+    returncode: int
+    seconds: float
+    output: str
+
+
+def build_command(
+    job: Job,
+    config_root: str,
+    socket_path: str,
+    certbot: str = "certbot",
+    certbot_args: Sequence[str] = (),
+) -> List[str]:
+    """
+    Build the certbot command of a job.
+
+    :param job: the lineage to renew or obtain
+    :param config_root: the directory holding one config directory per
+                        lineage
+    :param socket_path: the socket of the daemon to forward the updates to
+    :param certbot: the certbot executable
+    :param certbot_args: further arguments for every certbot process, e.g.
+                         the credentials
+    :return: the command line
+    """
+    config_dir = os.path.join(config_root, job.name)
+    if job.domains:
+        command = [certbot, "certonly", "--cert-name", job.name]
+        for domain in job.domains:
+            command += ["-d", domain]
+    else:
+        command = [certbot, "renew", "--cert-name", job.name]
+    return command + [
+        "--non-interactive",
+        "--authenticator", AUTHENTICATOR,
+        "--config-dir", config_dir,
+        "--work-dir", os.path.join(config_dir, "work"),
+        "--logs-dir", os.path.join(config_dir, "logs"),
+        f"--{AUTHENTICATOR}-daemon-socket", socket_path,
+    ] + list(certbot_args)
+
+
+def prepare_config_dir(config_dir: str, base_config_dir: str) -> None:
+    """
+    Link the account and lineage directories of the base config directory
+    into the config directory of a job. Existing links are kept.
+
+    :param config_dir: the config directory of the job, created if missing
+    :param base_config_dir: the config directory holding the account and
+                            the lineages
+    :raise ValueError: if the config directory has an own account or
+                       lineage directory
+    """
+    os.makedirs(config_dir, exist_ok=True)
+    for name in SHARED_DIRS:
+        target = os.path.abspath(os.path.join(base_config_dir, name))
+        os.makedirs(target, mode=0o700, exist_ok=True)
+        link = os.path.join(config_dir, name)
+        if os.path.islink(link) and \
+                os.path.realpath(link) == os.path.realpath(target):
+            continue
+        if os.path.lexists(link):
+            raise ValueError(f"{link} is not a link to {target}, move its "
+                             f"content to {base_config_dir}")
+        os.symlink(target, link)
+
+
+def has_account(base_config_dir: str) -> bool:
+    """
+    Check whether an ACME account was registered in a config directory.
+
+    :param base_config_dir: the config directory
+    :return: whether any account file exists
+    """
+    return any(files for _, _, files
+               in os.walk(os.path.join(base_config_dir, "accounts")))
+
+
+def run_jobs(
+    commands: Sequence[Tuple[Job, List[str]]],
+    workers: int = DEFAULT_WORKERS,
+) -> List[JobResult]:
+    """
+    Run the certbot processes of the jobs in parallel.
+
+    :param commands: the jobs and their command lines
+    :param workers: the maximum number of certbot processes at once
+    :return: the results, in the order of the jobs
+    """
+    def run(job: Job, command: List[str]) -> JobResult:
+        logger.info("Starting %s", job.name)
+        started = time.monotonic()
+        try:
+            completed = subprocess.run(
+                command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                universal_newlines=True
+            )
+            returncode, output = completed.returncode, completed.stdout
+        except OSError as e:
+            returncode, output = 1, str(e)
+        result = JobResult(job, returncode, time.monotonic() - started,
+                           output)
+        logger.info("Finished %s in %.1f seconds", job.name, result.seconds)
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return list(executor.map(lambda item: run(*item), commands))
+
+
+def format_summary(results: Sequence[JobResult], seconds: float) -> str:
+    """
+    Format the timings of all jobs.
+
+    :param results: the results of the jobs
+    :param seconds: the wall clock time of the whole run
+    :return: one line per job and a total
+    """
+    width = max([len(result.job.name) for result in results] + [7])
+    lines = [f"{'lineage':<{width}}  status  seconds"]
+    for result in results:
+        status = "ok" if result.returncode == 0 else "failed"
+        lines.append(f"{result.job.name:<{width}}  {status:<6}  "
+                     f"{result.seconds:7.1f}")
+    sequential = sum(result.seconds for result in results)
+    failed = sum(1 for result in results if result.returncode != 0)
+    lines.append(f"{len(results)} lineage(s), {failed} failed, in "
+                 f"{seconds:.1f} seconds ({sequential:.1f} one after "
+                 f"another)")
+    return "\n".join(lines)
+
+
+def parse_jobs(
+    lineages: Sequence[str], domain_sets: Optional[Sequence[str]]
+) -> List[Job]:
+    """
+    Parse the jobs of the command line.
+
+    :param lineages: the names of existing lineages to renew
+    :param domain_sets: comma separated domains of one certificate each,
+                        named after their first domain
+    :return: the jobs
+    """
+    jobs = [Job(name) for name in lineages]
+    for domain_set in domain_sets or ():
+        domains = tuple(domain.strip() for domain in domain_set.split(",")
+                        if domain.strip())
+        if domains:
+            jobs.append(Job(domains[0].replace("*.", "", 1), domains))
+    return jobs
+
+
+def main(argv: List[str] = None) -> int:
+    """
+    Renew or obtain the certificates of the command line in parallel.
+
+    Arguments after '--' are passed on to every certbot process.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    certbot_args: List[str] = []
+    if "--" in argv:
+        index = argv.index("--")
+        argv, certbot_args = argv[:index], argv[index + 1:]
+    parser = argparse.ArgumentParser(
+        description="Renew or obtain many certificates in parallel with the "
+                    "ISPConfig DDNS plugin."
+    )
+    parser.add_argument("lineages", nargs="*",
+                        help="names of lineages to renew")
+    parser.add_argument("-d", "--domains", action="append",
+                        help="comma separated domains of a certificate to "
+                             "obtain, can be repeated")
+    parser.add_argument("--config-root", required=True,
+                        help="directory with one certbot config directory "
+                             "per lineage")
+    parser.add_argument("--base-config-dir", default=DEFAULT_BASE_CONFIG_DIR,
+                        help="certbot config directory with the ACME "
+                             "account and the lineages (default: "
+                             "%(default)s)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                        help="certbot processes at once (default: "
+                             "%(default)s)")
+    parser.add_argument("--certbot", default="certbot",
+                        help="the certbot executable (default: "
+                             "%(default)s)")
+    parser.add_argument("--socket",
+                        help="socket of a running daemon, instead of "
+                             "starting one")
+    parser.add_argument("--pool-size", type=int, default=DEFAULT_POOL_MAXSIZE,
+                        help="keep-alive connections per endpoint of the "
+                             "started daemon")
+    args = parser.parse_args(argv)
+    jobs = parse_jobs(args.lineages, args.domains)
+    if not jobs:
+        parser.error("no lineages or domains given")
+    try:
+        _prepare_config_dirs(jobs, args)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+
+    started = time.monotonic()
+    if args.socket:
+        results = _run(jobs, args, args.socket, certbot_args)
+    else:
+        with tempfile.TemporaryDirectory() as tempdir:
+            socket_path = os.path.join(tempdir, "daemon.sock")
+            server = DDNSDaemon(socket_path, pool_size=args.pool_size,
+                                max_workers=DEFAULT_MAX_WORKERS)
+            thread = threading.Thread(target=server.serve_forever,
+                                      daemon=True)
+            thread.start()
+            try:
+                results = _run(jobs, args, socket_path, certbot_args)
+            finally:
+                server.shutdown()
+                server.server_close()
+
+    for result in results:
+        if result.returncode != 0:
+            print(f"--- {result.job.name} failed:\n{result.output}",
+                  file=sys.stderr)
+    print(format_summary(results, time.monotonic() - started))
+    return 0 if all(result.returncode == 0 for result in results) else 1
+
+
+def _prepare_config_dirs(
+    jobs: List[Job], args: argparse.Namespace
+) -> None:
+    # a missing account would be registered by every process at once
+    if not has_account(args.base_config_dir):
+        raise ValueError(f"no ACME account in {args.base_config_dir}, "
+                         "register one first with 'certbot register "
+                         f"--config-dir {args.base_config_dir}'")
+    for job in jobs:
+        prepare_config_dir(os.path.join(args.config_root, job.name),
+                           args.base_config_dir)
+
+
+def _run(
+    jobs: List[Job],
+    args: argparse.Namespace,
+    socket_path: str,
+    certbot_args: List[str],
+) -> List[JobResult]:
+    commands = [
+        (job, build_command(job, args.config_root, socket_path,
+                            certbot=args.certbot, certbot_args=certbot_args))
+        for job in jobs
+    ]
+    return run_jobs(commands, workers=args.workers)
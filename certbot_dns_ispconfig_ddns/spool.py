@@ -0,0 +1,374 @@
+"""
+Coalescing of the DDNS updates of concurrent certbot processes through a
+spool directory.
+
+Every process writes its updates as request files into the spool directory
+and tries to take the leader lock. The leader waits a short window for the
+requests of the other processes, sends all of them with one bulk update
+per route through its pooled clients, and answers every request with a
+response file. The other processes wait for their responses, and take over
+the lock once it is free, so requests are never left behind.
+
+Requests and responses use the objects of the daemon protocol. The spool
+directory is only accessible by its owner, as the requests contain the
+tokens.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover (windows)
+    fcntl = None
+
+from certbot_dns_ispconfig_ddns.daemon import ACTIONS, \
+    DEADLINE_GRACE_SECONDS, error_response, raise_for_response
+from certbot_dns_ispconfig_ddns.ispconfig_client import DEFAULT_MAX_WORKERS, \
+    ISPConfigBulkError, ISPConfigClient, ISPConfigClientError
+from certbot_dns_ispconfig_ddns.retry import Deadline
+from certbot_dns_ispconfig_ddns.zones import Route
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SPOOL_WINDOW = 0.5
+DEFAULT_SPOOL_TIMEOUT = 300.0
+POLL_INTERVAL = 0.05
+LOCK_FILE_NAME = "leader.lock"
+REQUEST_SUFFIX = ".request"
+RESPONSE_SUFFIX = ".response"
+REQUEST_KEYS = ("action", "endpoint", "token", "records", "created")
+
+
+class SpoolCoordinator:
+    """
+    Queues updates in a spool directory shared by several processes, and
+    sends the queued updates of all processes while holding the leader
+    lock.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        client_factory: Callable[[Route], ISPConfigClient],
+        window: float = DEFAULT_SPOOL_WINDOW,
+        max_workers: int = DEFAULT_MAX_WORKERS,
+        timeout: float = DEFAULT_SPOOL_TIMEOUT,
+        poll_interval: float = POLL_INTERVAL,
+    ) -> None:
+        """
+        Creates a new SpoolCoordinator object.
+
+        :param directory: the spool directory, created if missing
+        :param client_factory: creates the client of a route, when this
+                               process is the leader
+        :param window: the seconds the leader waits for more requests
+        :param max_workers: the maximum number of records updated in
+                            parallel per route
+        :param timeout: the seconds to wait for a response without
+                        deadline; older requests without deadline are
+                        dropped by the leader
+        :param poll_interval: the seconds between checks for a response
+        """
+        self.directory = directory
+        self.window = window
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._client_factory = client_factory
+        self._clients: Dict[Route, ISPConfigClient] = {}
+        self._clients_lock = threading.Lock()
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def close(self) -> None:
+        """
+        Close the clients used as leader.
+        """
+        with self._clients_lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients = {}
+
+    def update(
+        self,
+        action: str,
+        route: Route,
+        records: List[Tuple[str, str]],
+        deadline: Optional[Deadline] = None,
+    ) -> None:
+        """
+        Queue an update and wait until a leader sent it.
+
+        :param action: 'add' or 'delete'
+        :param route: the endpoint and token of the records
+        :param records: the (record_fqdn, record_content) pairs
+        :param deadline: the time budget of the update
+        :raise ISPConfigBulkError: if some records failed
+        :raise ISPConfigClientError: if no leader answered in time
+        """
+        if not records:
+            return
+        remaining = deadline.remaining() if deadline is not None else None
+        request_id = uuid.uuid4().hex
+        self._write(request_id + REQUEST_SUFFIX, {
+            "action": action, "endpoint": route.endpoint,
+            "token": route.token, "records": records,
+            "created": time.time(),
+            "expires": None if remaining is None else time.time() + remaining,
+        })
+        timeout = self.timeout if remaining is None \
+            else remaining + DEADLINE_GRACE_SECONDS
+        raise_for_response(action, self._wait(request_id, timeout))
+
+    def _wait(self, request_id: str, timeout: float) -> Dict:
+        """
+        Wait for the response to a request, leading whenever the lock is
+        free.
+
+        :raise ISPConfigClientError: if no response arrived in time
+        """
+        give_up = time.monotonic() + timeout
+        while True:
+            response = self._take(request_id + RESPONSE_SUFFIX)
+            if response is not None:
+                return response
+            if self._try_lead():
+                continue
+            if time.monotonic() >= give_up:
+                _remove(self._path(request_id + REQUEST_SUFFIX))
+                raise ISPConfigClientError(
+                    f"No response from the spool leader within {timeout:g} "
+                    "seconds"
+                )
+            time.sleep(self.poll_interval)
+
+    def _try_lead(self) -> bool:
+        """
+        Send all queued requests, if no other process is the leader.
+
+        :return: whether this process was the leader
+        """
+        with open(self._path(LOCK_FILE_NAME), "a") as lock_file:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return False
+            time.sleep(self.window)
+            self._flush(self._pending())
+        return True
+
+    def _pending(self) -> Dict[str, Dict]:
+        """
+        Read the queued requests. Requests of a crashed leader are still
+        queued, as they are only removed once they were answered. Requests
+        nobody waits for anymore are answered with an error and dropped.
+
+        :return: the requests by id
+        """
+        requests = {}
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if not name.endswith(REQUEST_SUFFIX):
+                continue
+            request = self._read(name)
+            if request is None:
+                continue  # withdrawn after a timeout
+            request_id = name[:-len(REQUEST_SUFFIX)]
+            if not all(key in request for key in REQUEST_KEYS):
+                logger.warning("Dropping invalid spool request %s", name)
+                _remove(self._path(name))
+            elif self._expired(request, now):
+                logger.warning("Dropping expired spool request %s", name)
+                self._write(request_id + RESPONSE_SUFFIX, error_response(
+                    ISPConfigClientError("Spool request expired"), {}
+                ))
+                _remove(self._path(name))
+            else:
+                requests[request_id] = request
+        return requests
+
+    def _expired(self, request: Dict, now: float) -> bool:
+        """
+        Check whether the process of a request gave up waiting for it: its
+        deadline passed, or it has none and is older than the timeout.
+        """
+        if request.get("expires") is not None:
+            return now > request["expires"] + DEADLINE_GRACE_SECONDS
+        return now - request["created"] > self.timeout
+
+    def _flush(self, requests: Dict[str, Dict]) -> None:
+        """
+        Send the requests with one bulk update per route and action.
+        """
+        batches: Dict[Tuple[Route, str], Dict[str, Dict]] = {}
+        for request_id, request in requests.items():
+            key = (Route(request["endpoint"], request["token"]),
+                   request["action"])
+            batches.setdefault(key, {})[request_id] = request
+        if not batches:
+            return
+        logger.debug("Flushing %d spooled request(s) in %d batch(es)",
+                     len(requests), len(batches))
+        with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+            # raise errors of writing the responses
+            list(executor.map(
+                lambda item: self._flush_batch(*item[0], item[1]),
+                batches.items()
+            ))
+
+    def _flush_batch(
+        self, route: Route, action: str, batch: Dict[str, Dict]
+    ) -> None:
+        """
+        Send the records of all requests of a route and action at once, and
+        answer every request with the failures of its own records.
+        """
+        records = [(fqdn, content) for request in batch.values()
+                   for fqdn, content in request["records"]]
+        try:
+            if action not in ACTIONS:
+                raise ISPConfigClientError(f"Unknown action: {action}")
+            client = self._get_client(route)
+            update = (client.set_txt_records if action == "add"
+                      else client.del_txt_records)
+            update(records, max_workers=self.max_workers,
+                   deadline=_batch_deadline(batch.values()))
+            failures = {}
+        except ISPConfigBulkError as e:
+            failures = e.failures
+        except Exception as e:
+            failures = {record: e for record in records}
+        for request_id, request in batch.items():
+            own = {(fqdn, content): failures[(fqdn, content)]
+                   for fqdn, content in request["records"]
+                   if (fqdn, content) in failures}
+            self._write(request_id + RESPONSE_SUFFIX,
+                        error_response(ISPConfigBulkError(action, own), own)
+                        if own else {"ok": True})
+            _remove(self._path(request_id + REQUEST_SUFFIX))
+
+    def _get_client(self, route: Route) -> ISPConfigClient:
+        with self._clients_lock:
+            if route not in self._clients:
+                self._clients[route] = self._client_factory(route)
+            return self._clients[route]
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _write(self, name: str, content: Dict) -> None:
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".spool-")
+        try:
+            with os.fdopen(fd, "w") as tmp_file:
+                json.dump(content, tmp_file)
+            os.replace(tmp_path, self._path(name))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _read(self, name: str) -> Optional[Dict]:
+        try:
+            with open(self._path(name)) as json_file:
+                return json.load(json_file)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            return {}
+
+    def _take(self, name: str) -> Optional[Dict]:
+        content = self._read(name)
+        if content is not None:
+            _remove(self._path(name))
+        return content
+
+
+class SpoolClient:
+    """
+    Queues the updates of one endpoint and token in a spool directory.
+
+    It offers the update methods of ISPConfigClient, so it can be used in
+    its place.
+    """
+
+    def __init__(self, coordinator: SpoolCoordinator, route: Route) -> None:
+        """
+        :param coordinator: the coordinator of the spool directory
+        :param route: the endpoint and token of the updates
+        """
+        self._coordinator = coordinator
+        self._route = route
+
+    def __enter__(self) -> "SpoolClient":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Nothing to close, the coordinator owns the clients.
+        """
+
+    def set_txt_record(self, record_fqdn: str, record_content: str) -> None:
+        self.set_txt_records([(record_fqdn, record_content)])
+
+    def del_txt_record(self, record_fqdn: str, record_content: str) -> None:
+        self.del_txt_records([(record_fqdn, record_content)])
+
+    def set_txt_records(
+        self,
+        records: Iterable[Tuple[str, str]],
+        max_workers: int = None,
+        deadline: Optional[Deadline] = None,
+    ) -> None:
+        """
+        Add TXT records through the spool.
+
+        :param records: the (record_fqdn, record_content) pairs
+        :param max_workers: ignored, the leader limits the parallelism
+        :param deadline: the time budget, passed on to the leader
+        :raises ISPConfigBulkError: if adding any record failed
+        """
+        self._coordinator.update("add", self._route, list(records), deadline)
+
+    def del_txt_records(
+        self,
+        records: Iterable[Tuple[str, str]],
+        max_workers: int = None,
+        deadline: Optional[Deadline] = None,
+    ) -> None:
+        """
+        Delete TXT records through the spool.
+
+        :param records: the (record_fqdn, record_content) pairs
+        :param max_workers: ignored, the leader limits the parallelism
+        :param deadline: the time budget, passed on to the leader
+        :raises ISPConfigBulkError: if deleting any record failed
+        """
+        self._coordinator.update("delete", self._route, list(records),
+                                 deadline)
+
+
+def _batch_deadline(requests: Iterable[Dict]) -> Deadline:
+    """
+    Get the deadline of a batch: the latest deadline of its requests, or
+    none if any request has none.
+    """
+    expires = [request.get("expires") for request in requests]
+    if not expires or None in expires:
+        return Deadline()
+    return Deadline(max(0.0, max(expires) - time.time()))
+
+
+def _remove(path: str) -> None:
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
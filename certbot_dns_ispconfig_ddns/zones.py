@@ -0,0 +1,116 @@
+"""Routing of validation records to per-zone ISPConfig DDNS credentials."""
+from typing import Any, Dict, Generic, Mapping, NamedTuple, Optional, Tuple, \
+    TypeVar
+
+from certbot import errors
+
+T = TypeVar("T")
+
+_VALUE = ""  # labels are never empty, so this key cannot clash
+
+
+class Route(NamedTuple):
+    """
+    The endpoint and token to update the records of a zone with.
+    """
+    endpoint: str
+    token: str
+
+
+class ZoneIndex(Generic[T]):
+    """
+    Maps DNS names to the value of their longest matching zone suffix.
+
+    The zones are stored in a trie of reversed labels, so a lookup takes
+    O(labels of the name), independent of the number of zones.
+    """
+
+    def __init__(self) -> None:
+        self._root: Dict[str, Any] = {}
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, zone: str, value: T) -> None:
+        """
+        Add a zone, replacing the value if the zone already exists.
+
+        :param zone: the zone name, e.g. 'example.com'
+        :param value: the value of the zone
+        """
+        node = self._root
+        for label in _labels(zone):
+            node = node.setdefault(label, {})
+        if _VALUE not in node:
+            self._size += 1
+        node[_VALUE] = (_normalize(zone), value)
+
+    def lookup(self, name: str) -> Optional[Tuple[str, T]]:
+        """
+        Find the most specific zone containing a name.
+
+        :param name: the DNS name, e.g. '_acme-challenge.www.example.com'
+        :return: the (zone, value) pair, or None if no zone matches
+        """
+        node = self._root
+        found = node.get(_VALUE)
+        for label in _labels(name):
+            node = node.get(label)
+            if node is None:
+                break
+            found = node.get(_VALUE, found)
+        return found
+
+
+def _normalize(name: str) -> str:
+    return name.strip().rstrip(".").lower()
+
+
+def _labels(name: str):
+    normalized = _normalize(name)
+    return reversed(normalized.split(".")) if normalized else ()
+
+
+def load_zone_routes(
+    confobj: Mapping[str, Any], default_endpoint: Optional[str]
+) -> ZoneIndex[Route]:
+    """
+    Build the zone index from the sections of a credentials INI file.
+
+    Every section configures the token (and optionally the endpoint) of one
+    or more zones. The zones are listed in the `zones` key, or given by the
+    section name if there is no such key::
+
+        [example.com]
+        token = <token>
+
+        [customer-a]
+        endpoint = https://panel-b.example.net:8080
+        token = <token>
+        zones = example.org, example.info
+
+    :param confobj: the parsed credentials file
+    :param default_endpoint: the endpoint of sections without endpoint
+    :return: the index of all configured zones
+    :raise PluginError: if a section has no token or no endpoint
+    """
+    index: ZoneIndex[Route] = ZoneIndex()
+    for name, section in confobj.items():
+        if not isinstance(section, Mapping):
+            continue
+        endpoint = section.get("endpoint") or default_endpoint
+        token = section.get("token")
+        if not endpoint or not token:
+            raise errors.PluginError(
+                f"Credentials section [{name}] needs a token and an "
+                "endpoint (or a default endpoint)"
+            )
+        zones = section.get("zones") or name
+        if isinstance(zones, str):
+            zones = zones.split(",")
+        route = Route(endpoint.rstrip("/"), token)
+        for zone in zones:
+            if zone.strip():
+                index.add(zone, route)
+    return index
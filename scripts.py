@@ -1,6 +1,7 @@
 import pathlib
 import shutil
 import subprocess
+import sys
 
 
 def lint():
@@ -71,3 +72,17 @@ def ci_badges():
          '--local']
     )
     exit(tests.returncode + coverage.returncode + lint.returncode)
+
+
+def bench():
+    bench_result: subprocess.CompletedProcess = subprocess.run(
+        ['python', '-m', 'benchmarks.run', *sys.argv[1:]]
+    )
+    exit(bench_result.returncode)
+
+
+def bench_import():
+    bench_result: subprocess.CompletedProcess = subprocess.run(
+        ['python', '-m', 'benchmarks.import_time', *sys.argv[1:]]
+    )
+    exit(bench_result.returncode)
@@ -0,0 +1,130 @@
+"""Tests for certbot_dns_ispconfig_ddns.async_ispconfig_client."""
+import asyncio
+import base64
+import unittest
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from certbot.plugins.dns_test_common import DOMAIN
+
+from certbot_dns_ispconfig_ddns.async_ispconfig_client import \
+    AsyncISPConfigClient
+from certbot_dns_ispconfig_ddns.ispconfig_client import ISPConfigClientError
+
+TEST_TOKEN = "token123"
+
+
+class AsyncISPConfigClientTest(unittest.IsolatedAsyncioTestCase):
+    record_content = "bar"
+
+    async def asyncSetUp(self):
+        self.requests = []
+        self.status = 200
+        self.in_flight = 0
+        self.max_in_flight = 0
+        app = web.Application()
+        app.router.add_route('*', '/ddns/update.php', self._handle)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.endpoint = str(self.server.make_url('')).rstrip('/')
+        self.client = AsyncISPConfigClient(self.endpoint, TEST_TOKEN)
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.server.close()
+
+    async def _handle(self, request):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.01)
+        self.in_flight -= 1
+        self.requests.append(
+            (request.method, dict(request.query),
+             request.headers.get('Authorization'))
+        )
+        status = self.status
+        if callable(status):
+            status = status(request)
+        return web.Response(text='OK' if status == 200 else 'NOP',
+                            status=status)
+
+    def test_missing_endpoint(self):
+        with self.assertRaises(ISPConfigClientError) as err:
+            AsyncISPConfigClient('', TEST_TOKEN)
+        self.assertEqual(err.exception.args[0], "Missing endpoint: ")
+
+    def test_missing_token(self):
+        with self.assertRaises(ISPConfigClientError) as err:
+            AsyncISPConfigClient(self.endpoint, '')
+        self.assertEqual(err.exception.args[0], "Missing token: ")
+
+    async def test_set_txt_record(self):
+        await self.client.set_txt_record(DOMAIN, self.record_content)
+
+        method, query, auth = self.requests[0]
+        self.assertEqual('POST', method)
+        self.assertEqual({'action': 'add', 'type': 'TXT', 'record': DOMAIN,
+                          'data': self.record_content}, query)
+        self.assertEqual(
+            "Basic " + base64.b64encode(b"anonymous:" + TEST_TOKEN.encode())
+            .decode(),
+            auth
+        )
+
+    async def test_del_txt_record(self):
+        await self.client.del_txt_record(DOMAIN, self.record_content)
+
+        method, query, _ = self.requests[0]
+        self.assertEqual('DELETE', method)
+        self.assertEqual('delete', query['action'])
+
+    async def test_set_txt_record_too_big(self):
+        with self.assertRaises(ISPConfigClientError) as err:
+            await self.client.set_txt_record(DOMAIN, 'a' * 256)
+        self.assertEqual(
+            err.exception.args[0],
+            "TXT record is too big, max 255 chars allowed"
+        )
+        self.assertEqual([], self.requests)
+
+    async def test_del_txt_record_permission_denied(self):
+        self.status = 401
+        with self.assertRaises(aiohttp.ClientResponseError) as err:
+            await self.client.del_txt_record(DOMAIN, self.record_content)
+        self.assertEqual(err.exception.status, 401)
+
+    async def test_gather(self):
+        operations = [("add", f"host{i}.{DOMAIN}", self.record_content)
+                      for i in range(20)]
+        operations.append(("delete", DOMAIN, self.record_content))
+        results = await self.client.gather(operations, concurrency=4)
+
+        self.assertEqual([None] * 21, results)
+        self.assertEqual(21, len(self.requests))
+        self.assertLessEqual(self.max_in_flight, 4)
+
+    async def test_gather_returns_exceptions_in_place(self):
+        self.status = (lambda request:
+                       404 if request.query['record'] == DOMAIN else 200)
+        results = await self.client.gather([
+            ("add", "a." + DOMAIN, self.record_content),
+            ("add", DOMAIN, self.record_content),
+            ("update", DOMAIN, self.record_content),
+        ])
+
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], aiohttp.ClientResponseError)
+        self.assertIsInstance(results[2], ISPConfigClientError)
+        self.assertEqual(2, len(self.requests))
+
+    async def test_context_manager_closes_session(self):
+        async with AsyncISPConfigClient(self.endpoint, TEST_TOKEN) as client:
+            await client.set_txt_record(DOMAIN, self.record_content)
+            session = client._session
+        self.assertTrue(session.closed)
+        self.assertIsNone(client._session)
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
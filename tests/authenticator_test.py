@@ -1,18 +1,38 @@
 """Tests for certbot_dns_ispconfig.dns_ispconfig."""
+import json
+import subprocess
+import sys
+import threading
+import time
 import unittest
 
+import configobj
 import mock
+import requests
 from certbot import errors
 from certbot._internal.display import obj as display_obj
-from certbot.compat import os
-from certbot.plugins import dns_test_common
+from certbot.compat import filesystem, os
+from certbot.plugins import dns_common, dns_test_common
 from certbot.plugins.dns_test_common import DOMAIN
 from certbot.tests import util as test_util
 
-from certbot_dns_ispconfig_ddns.authenticator import Authenticator
+from certbot_dns_ispconfig_ddns.authenticator import WARM_UP_TIMEOUT, \
+    Authenticator
+from certbot_dns_ispconfig_ddns.cassette import CassetteAdapter
+from certbot_dns_ispconfig_ddns.daemon import DaemonClient
+from certbot_dns_ispconfig_ddns.ispconfig_client import CircuitOpenError, \
+    ISPConfigBulkError, TokenRejectedError
+from certbot_dns_ispconfig_ddns.journal import JOURNAL_FILE_NAME, \
+    STATE_FILE_NAME, CleanupJournal, PropagationHistory, RecordStateCache
+from certbot_dns_ispconfig_ddns.spool import SpoolClient
+from certbot_dns_ispconfig_ddns.zones import Route
+from tests.util import achall
 
 TEST_ENDPOINT = "http://endpoint"
 TEST_TOKEN = "token123"
+TEST_POOL_SIZE = 4
+TEST_MAX_WORKERS = 3
+TEST_RETRIES = 2
 
 
 class AuthenticatorTest(
@@ -24,7 +44,7 @@ class AuthenticatorTest(
     def setUp(self):
         # manually mock ISPConfigClient class
         patcher = mock.patch(
-            'certbot_dns_ispconfig_ddns.authenticator.ISPConfigClient'
+            'certbot_dns_ispconfig_ddns.ispconfig_client.ISPConfigClient'
         )
         self.addCleanup(patcher.stop)
         self.mock_client = patcher.start()
@@ -49,6 +69,28 @@ class AuthenticatorTest(
             ispconfig_ddns_propagation_seconds=0,  # don't wait during tests
             ispconfig_ddns_endpoint=None,
             ispconfig_ddns_token=None,
+            ispconfig_ddns_pool_size=TEST_POOL_SIZE,
+            ispconfig_ddns_max_workers=TEST_MAX_WORKERS,
+            ispconfig_ddns_retries=TEST_RETRIES,
+            ispconfig_ddns_propagation_polling=False,
+            ispconfig_ddns_propagation_nameservers=None,
+            ispconfig_ddns_deferred_cleanup=False,
+            ispconfig_ddns_journal=None,
+            ispconfig_ddns_metrics_file=None,
+            ispconfig_ddns_state_cache=False,
+            ispconfig_ddns_state_file=None,
+            ispconfig_ddns_state_ttl=300,
+            ispconfig_ddns_daemon_socket=None,
+            ispconfig_ddns_spool_dir=None,
+            ispconfig_ddns_spool_window=0.5,
+            ispconfig_ddns_cassette=None,
+            ispconfig_ddns_cassette_mode="replay",
+            ispconfig_ddns_connect_timeout=None,
+            ispconfig_ddns_read_timeout=None,
+            ispconfig_ddns_deadline=None,
+            ispconfig_ddns_propagation_learning=False,
+            ispconfig_ddns_propagation_history_file=None,
+            work_dir=self.tempdir,
         )
         self.auth = Authenticator(self.config, "ispconfig_ddns")
         self.auth._setup_credentials()
@@ -58,6 +100,28 @@ class AuthenticatorTest(
             ispconfig_ddns_propagation_seconds=0,  # don't wait during tests
             ispconfig_ddns_endpoint=TEST_ENDPOINT,
             ispconfig_ddns_token=TEST_TOKEN,
+            ispconfig_ddns_pool_size=TEST_POOL_SIZE,
+            ispconfig_ddns_max_workers=TEST_MAX_WORKERS,
+            ispconfig_ddns_retries=TEST_RETRIES,
+            ispconfig_ddns_propagation_polling=False,
+            ispconfig_ddns_propagation_nameservers=None,
+            ispconfig_ddns_deferred_cleanup=False,
+            ispconfig_ddns_journal=None,
+            ispconfig_ddns_metrics_file=None,
+            ispconfig_ddns_state_cache=False,
+            ispconfig_ddns_state_file=None,
+            ispconfig_ddns_state_ttl=300,
+            ispconfig_ddns_daemon_socket=None,
+            ispconfig_ddns_spool_dir=None,
+            ispconfig_ddns_spool_window=0.5,
+            ispconfig_ddns_cassette=None,
+            ispconfig_ddns_cassette_mode="replay",
+            ispconfig_ddns_connect_timeout=None,
+            ispconfig_ddns_read_timeout=None,
+            ispconfig_ddns_deadline=None,
+            ispconfig_ddns_propagation_learning=False,
+            ispconfig_ddns_propagation_history_file=None,
+            work_dir=self.tempdir,
         )
         self.auth = Authenticator(self.config, "ispconfig_ddns")
 
@@ -71,11 +135,9 @@ class AuthenticatorTest(
             self.auth._configure_file.mock_calls
         )
         self.assertEqual(
-            [mock.call('credentials', 'ISPConfig DDNS credentials INI file', {
-                "endpoint": "URL of the ISPConfig Installation.",
-                "token": "The generated DDNS module token.",
-            })],
-            self.auth._configure_credentials.mock_calls
+            [mock.call('credentials', 'ISPConfig DDNS credentials INI file',
+                       validator=self.auth._validate_credentials)],
+            self.auth._configure_credentials.call_args_list
         )
 
         self._create_authenticator_with_cli_params()
@@ -86,64 +148,886 @@ class AuthenticatorTest(
         self.assertEqual([], self.auth._configure_file.mock_calls)
         self.assertEqual([], self.auth._configure_credentials.mock_calls)
 
+    def test_client_imported_lazily(self):
+        # certbot imports every plugin on startup, even if it is not used
+        result = subprocess.run(
+            [sys.executable, "-c",
+             "import sys, certbot_dns_ispconfig_ddns.authenticator; "
+             "print('certbot_dns_ispconfig_ddns.ispconfig_client' "
+             "in sys.modules)"],
+            stdout=subprocess.PIPE, text=True, check=True
+        )
+        self.assertEqual("False", result.stdout.strip())
+
     def test_get_ispconfig_client_credentials_file(self):
         client = self.auth._get_ispconfig_client()
 
         expected = [
-            mock.call(endpoint=TEST_ENDPOINT, token=TEST_TOKEN)
+            mock.call(endpoint=TEST_ENDPOINT, token=TEST_TOKEN,
+                      pool_maxsize=TEST_POOL_SIZE, retry_policy=mock.ANY,
+                      circuit_breakers=mock.ANY,
+                      metrics=mock.ANY, limiters=mock.ANY,
+                      connect_timeout=10.0, read_timeout=30.0,
+                      transport=None)
         ]
         self.assertEqual(expected, self.mock_client.mock_calls)
         assert client is self.mock_client.return_value
 
+    def test_get_ispconfig_client_daemon_socket(self):
+        path = os.path.join(self.tempdir, "daemon.sock")
+        self.config.ispconfig_ddns_daemon_socket = path
+        client = self.auth._get_ispconfig_client()
+
+        self.assertIsInstance(client, DaemonClient)
+        self.assertEqual(path, client.socket_path)
+        self.assertEqual([], self.mock_client.mock_calls)
+
+    def test_get_ispconfig_client_spool_dir(self):
+        self.config.ispconfig_ddns_spool_dir = \
+            os.path.join(self.tempdir, "spool")
+        self.config.ispconfig_ddns_spool_window = 0
+        client = self.auth._get_ispconfig_client()
+
+        self.assertIsInstance(client, SpoolClient)
+        self.assertEqual([], self.mock_client.mock_calls)
+
+        # this process is the only one, so it sends its own update
+        client.set_txt_record("_acme-challenge." + DOMAIN, "foo")
+        self.mock_client.return_value.set_txt_records.assert_called_once_with(
+            [("_acme-challenge." + DOMAIN, "foo")],
+            max_workers=TEST_MAX_WORKERS, deadline=mock.ANY
+        )
+        self.auth._close_ispconfig_clients()
+        self.mock_client.return_value.close.assert_called_once_with()
+
+    def test_cassette(self):
+        self.config.ispconfig_ddns_cassette = \
+            os.path.join(self.tempdir, "cassette.json")
+        self.config.ispconfig_ddns_cassette_mode = "record"
+        self.auth._get_ispconfig_client()
+        self.auth._get_ispconfig_client(Route("http://other", TEST_TOKEN))
+
+        transports = [call.kwargs["transport"]
+                      for call in self.mock_client.call_args_list]
+        self.assertIsInstance(transports[0], CassetteAdapter)
+        self.assertIs(transports[0].cassette, transports[1].cassette)
+        self.auth._close_ispconfig_clients()
+        self.assertTrue(os.path.exists(self.config.ispconfig_ddns_cassette))
+
+    def test_missing_cassette(self):
+        self.config.ispconfig_ddns_cassette = \
+            os.path.join(self.tempdir, "cassette.json")
+        with self.assertRaises(errors.PluginError):
+            self.auth._get_ispconfig_client()
+
+    def test_limiter_shared_per_endpoint(self):
+        routes = [Route(TEST_ENDPOINT, "a"), Route(TEST_ENDPOINT, "b"),
+                  Route("http://other", "a")]
+        for route in routes:
+            self.auth._get_ispconfig_client(route)
+
+        # the clients create one limiter and one breaker per endpoint in
+        # the shared dicts
+        for name in ("limiters", "circuit_breakers"):
+            shared = [call.kwargs[name]
+                      for call in self.mock_client.call_args_list]
+            self.assertIs(shared[0], shared[1])
+            self.assertIs(shared[0], shared[2])
+
+    def test_validate_credentials(self):
+        path = os.path.join(self.tempdir, "invalid.ini")
+        dns_test_common.write({"ispconfig_ddns_endpoint": TEST_ENDPOINT},
+                              path)
+        with self.assertRaises(errors.PluginError) as err:
+            self.auth._validate_credentials(
+                dns_common.CredentialsConfiguration(path, self.auth.dest)
+            )
+        self.assertIn('Property "ispconfig_ddns_token" not found',
+                      err.exception.args[0])
+
+    def test_get_ispconfig_client_without_default_route(self):
+        self._create_authenticator_with_zones({
+            "zone-a": {"endpoint": TEST_ENDPOINT, "token": "token-a",
+                       "zones": "example.org"}
+        })
+
+        with self.assertRaises(errors.PluginError):
+            self.auth._get_ispconfig_client()
+
+    def test_zone_section_without_endpoint(self):
+        with self.assertRaises(errors.PluginError) as err:
+            self._create_authenticator_with_zones({
+                "zone-a": {"token": "token-a", "zones": "example.org"}
+            })
+        self.assertEqual(
+            "Credentials section [zone-a] needs a token and an endpoint "
+            "(or a default endpoint)",
+            err.exception.args[0]
+        )
+
+    def _create_authenticator_with_zones(self, sections, **defaults):
+        path = os.path.join(self.tempdir, "zones.ini")
+        config = configobj.ConfigObj()
+        for key, value in defaults.items():
+            config[f"ispconfig_ddns_{key}"] = value
+        for name, section in sections.items():
+            config[name] = section
+        with open(path, "wb") as credentials_file:
+            config.write(outfile=credentials_file)
+        filesystem.chmod(path, 0o600)
+        self.config.ispconfig_ddns_credentials = path
+        self.auth = Authenticator(self.config, "ispconfig_ddns")
+        self.auth._setup_credentials()
+
+    def test_multi_zone_routing(self):
+        self._create_authenticator_with_zones(
+            {
+                "example.org": {"token": "token-org"},
+                "customer": {
+                    "endpoint": "http://panel-b/",
+                    "token": "token-b",
+                    "zones": ["example.net", "sub.example.com"],
+                },
+            },
+            endpoint=TEST_ENDPOINT,
+            token=TEST_TOKEN,
+        )
+        clients = {}
+        self.mock_client.side_effect = (
+            lambda endpoint, token, **kwargs:
+            clients.setdefault(token, mock.MagicMock())
+        )
+        domains = ["example.org", "www.example.org", "example.net",
+                   "a.sub.example.com", DOMAIN, "www." + DOMAIN]
+        self.auth.perform([achall(domain) for domain in domains])
+
+        def sent(token):
+            return [name for name, _ in
+                    clients[token].set_txt_records.call_args.args[0]]
+
+        self.assertEqual(
+            ["_acme-challenge.example.org", "_acme-challenge.www.example.org"],
+            sent("token-org")
+        )
+        self.assertEqual(
+            ["_acme-challenge.example.net",
+             "_acme-challenge.a.sub.example.com"],
+            sent("token-b")
+        )
+        self.assertEqual(
+            ["_acme-challenge." + DOMAIN, "_acme-challenge.www." + DOMAIN],
+            sent(TEST_TOKEN)
+        )
+        self.assertEqual(
+            sorted([mock.call(endpoint=TEST_ENDPOINT, token="token-org",
+                              pool_maxsize=mock.ANY, retry_policy=mock.ANY,
+                              circuit_breakers=mock.ANY,
+                              metrics=mock.ANY, limiters=mock.ANY,
+                              connect_timeout=10.0, read_timeout=30.0,
+                              transport=None),
+                    mock.call(endpoint="http://panel-b", token="token-b",
+                              pool_maxsize=mock.ANY, retry_policy=mock.ANY,
+                              circuit_breakers=mock.ANY,
+                              metrics=mock.ANY, limiters=mock.ANY,
+                              connect_timeout=10.0, read_timeout=30.0,
+                              transport=None),
+                    mock.call(endpoint=TEST_ENDPOINT, token=TEST_TOKEN,
+                              pool_maxsize=mock.ANY, retry_policy=mock.ANY,
+                              circuit_breakers=mock.ANY,
+                              metrics=mock.ANY, limiters=mock.ANY,
+                              connect_timeout=10.0, read_timeout=30.0,
+                              transport=None)],
+                   key=str),
+            sorted(self.mock_client.call_args_list, key=str)
+        )
+
+        self.auth.cleanup([achall(domain) for domain in domains])
+        for client in clients.values():
+            client.close.assert_called_once_with()
+
+    def test_multi_zone_without_default_route(self):
+        self._create_authenticator_with_zones({
+            "zone-a": {"endpoint": TEST_ENDPOINT, "token": "token-a",
+                       "zones": "example.org"}
+        })
+
+        with self.assertRaises(errors.PluginError) as err:
+            self.auth.perform([achall("example.org"), achall(DOMAIN)])
+        self.assertEqual(
+            "No ISPConfig DDNS credentials configured for the zone of "
+            f"_acme-challenge.{DOMAIN}",
+            err.exception.args[0]
+        )
+
+    def test_timeouts_from_credentials_file(self):
+        path = os.path.join(self.tempdir, "file.ini")
+        dns_test_common.write({
+            "ispconfig_ddns_endpoint": TEST_ENDPOINT,
+            "ispconfig_ddns_token": TEST_TOKEN,
+            "ispconfig_ddns_connect_timeout": "2.5",
+            "ispconfig_ddns_read_timeout": "5",
+        }, path)
+        self.auth._setup_credentials()
+        self.config.ispconfig_ddns_read_timeout = 7
+        self.auth._get_ispconfig_client()
+
+        kwargs = self.mock_client.call_args.kwargs
+        self.assertEqual(2.5, kwargs["connect_timeout"])
+        self.assertEqual(7, kwargs["read_timeout"])
+
+    def test_invalid_timeout(self):
+        self.config.ispconfig_ddns_connect_timeout = -1
+        with self.assertRaises(errors.PluginError):
+            self.auth._get_ispconfig_client()
+
+    def test_perform_with_deadline(self):
+        self.config.ispconfig_ddns_deadline = 30
+        self.auth.perform([self.achall])
+
+        deadline = self.mock_client.return_value.set_txt_records \
+            .call_args.kwargs["deadline"]
+        self.assertEqual(30, deadline.seconds)
+        self.assertTrue(0 < deadline.remaining() <= 30)
+
+    def test_get_ispconfig_client_retry_policy(self):
+        self.auth._get_ispconfig_client()
+
+        retry_policy = self.mock_client.call_args.kwargs['retry_policy']
+        self.assertEqual(TEST_RETRIES, retry_policy.retries)
+
     def test_get_ispconfig_client_cli_params(self):
         self._create_authenticator_with_cli_params()
         client = self.auth._get_ispconfig_client()
 
         expected = [
-            mock.call(endpoint=TEST_ENDPOINT, token=TEST_TOKEN)
+            mock.call(endpoint=TEST_ENDPOINT, token=TEST_TOKEN,
+                      pool_maxsize=TEST_POOL_SIZE, retry_policy=mock.ANY,
+                      circuit_breakers=mock.ANY,
+                      metrics=mock.ANY, limiters=mock.ANY,
+                      connect_timeout=10.0, read_timeout=30.0,
+                      transport=None)
         ]
         self.assertEqual(expected, self.mock_client.mock_calls)
         assert client is self.mock_client.return_value
 
+    def _prepare(self, domains, wait=True):
+        self.config.domains = domains
+        with mock.patch("certbot_dns_ispconfig_ddns.authenticator.atexit"
+                        ".register") as self.register_at_exit:
+            self.auth.prepare()
+        for check in self.auth._token_checks.values() if wait else []:
+            check.exception(timeout=5)
+
+    def test_prepare_warms_up_clients(self):
+        self._prepare([DOMAIN, "*.sub." + DOMAIN])
+
+        client = self.mock_client.return_value
+        self.assertEqual(1, self.mock_client.call_count)
+        client.check_token.assert_called_once_with(WARM_UP_TIMEOUT)
+
+        self.auth.perform([self.achall])
+        self.assertEqual(1, self.mock_client.call_count)
+        client.set_txt_records.assert_called_once()
+
+    def test_prepare_rejected_token_fails_perform(self):
+        self.mock_client.return_value.check_token.side_effect = \
+            TokenRejectedError("Token rejected by endpoint (401)")
+        self._prepare([])
+
+        with self.assertRaises(errors.PluginError) as err:
+            self.auth.perform([self.achall])
+        self.assertIn("Token rejected", str(err.exception))
+        self.mock_client.return_value.set_txt_records.assert_not_called()
+
+    def test_prepare_unreachable_endpoint_does_not_fail(self):
+        self.mock_client.return_value.check_token.side_effect = \
+            requests.exceptions.ConnectionError("refused")
+        self._prepare([DOMAIN])
+
+        self.auth.perform([self.achall])
+        self.mock_client.return_value.set_txt_records.assert_called_once()
+
+    def test_prepare_closes_clients_at_exit(self):
+        self._prepare([DOMAIN])
+        self.register_at_exit.assert_called_once_with(self.auth._end_warm_up)
+
+        # certbot aborts before perform
+        self.auth._end_warm_up()
+        self.mock_client.return_value.close.assert_called_once_with()
+
+    def test_prepare_bounds_warm_up_at_exit(self):
+        started, release = threading.Event(), threading.Event()
+
+        def check_token(timeout):
+            started.set()
+            release.wait(5)
+        self.mock_client.return_value.check_token.side_effect = check_token
+        self._prepare([DOMAIN], wait=False)
+        self.assertTrue(started.wait(5))
+
+        with mock.patch("certbot_dns_ispconfig_ddns.authenticator."
+                        "WARM_UP_TIMEOUT", 0.01):
+            self.auth._end_warm_up()
+        # the check is still running, but the clients are closed
+        self.assertFalse(any(check.done()
+                             for check in self.auth._token_checks.values()))
+        self.mock_client.return_value.close.assert_called_once_with()
+        release.set()
+
+    def test_prepare_without_credentials(self):
+        self.config.ispconfig_ddns_credentials = None
+        self._prepare([DOMAIN])
+
+        self.assertEqual([], self.mock_client.mock_calls)
+
+    def test_prepare_with_daemon_socket(self):
+        self.config.ispconfig_ddns_daemon_socket = \
+            os.path.join(self.tempdir, "daemon.sock")
+        self._prepare([DOMAIN])
+
+        self.assertEqual({}, self.auth._token_checks)
+
+    def test_prepare_with_spool_dir(self):
+        self.config.ispconfig_ddns_spool_dir = \
+            os.path.join(self.tempdir, "spool")
+        self._prepare([DOMAIN])
+
+        self.assertEqual({}, self.auth._token_checks)
+
     def test_perform(self):
         self.auth.perform([self.achall])
 
         expected = [
-            mock.call(endpoint=TEST_ENDPOINT, token=TEST_TOKEN),
-            mock.call().set_txt_record("_acme-challenge." + DOMAIN, mock.ANY)
+            mock.call(endpoint=TEST_ENDPOINT, token=TEST_TOKEN,
+                      pool_maxsize=TEST_POOL_SIZE, retry_policy=mock.ANY,
+                      circuit_breakers=mock.ANY,
+                      metrics=mock.ANY, limiters=mock.ANY,
+                      connect_timeout=10.0, read_timeout=30.0,
+                      transport=None),
+            mock.call().set_txt_records(
+                [("_acme-challenge." + DOMAIN, mock.ANY)],
+                max_workers=TEST_MAX_WORKERS, deadline=mock.ANY
+            )
+        ]
+        self.assertEqual(expected, self.mock_client.mock_calls)
+
+    def test_client_shared_between_perform_and_cleanup(self):
+        self.auth.perform([self.achall])
+        self.auth.cleanup([self.achall])
+
+        expected = [
+            mock.call(endpoint=TEST_ENDPOINT, token=TEST_TOKEN,
+                      pool_maxsize=TEST_POOL_SIZE, retry_policy=mock.ANY,
+                      circuit_breakers=mock.ANY,
+                      metrics=mock.ANY, limiters=mock.ANY,
+                      connect_timeout=10.0, read_timeout=30.0,
+                      transport=None),
+            mock.call().set_txt_records(
+                [("_acme-challenge." + DOMAIN, mock.ANY)],
+                max_workers=TEST_MAX_WORKERS, deadline=mock.ANY
+            ),
+            mock.call().del_txt_records(
+                [("_acme-challenge." + DOMAIN, mock.ANY)],
+                max_workers=TEST_MAX_WORKERS, deadline=mock.ANY
+            ),
+            mock.call().close(),
         ]
         self.assertEqual(expected, self.mock_client.mock_calls)
+        self.assertEqual({}, self.auth._ispconfig_clients)
+
+    @mock.patch('certbot_dns_ispconfig_ddns.propagation.PropagationChecker')
+    @mock.patch('certbot_dns_ispconfig_ddns.authenticator.sleep')
+    def test_perform_with_propagation_polling(self, sleep, checker):
+        self.config.ispconfig_ddns_propagation_polling = True
+        self.config.ispconfig_ddns_propagation_seconds = 30
+        self.config.ispconfig_ddns_propagation_nameservers = \
+            "192.0.2.1, 192.0.2.2"
+        checker.return_value.wait_for.return_value = True
+        self.auth.perform([self.achall])
+
+        checker.assert_called_once_with(
+            nameservers=["192.0.2.1", "192.0.2.2"],
+            max_workers=TEST_MAX_WORKERS
+        )
+        checker.return_value.wait_for.assert_called_once_with(
+            [("_acme-challenge." + DOMAIN, mock.ANY)], 30, times={}
+        )
+        sleep.assert_not_called()
+
+    @mock.patch('certbot_dns_ispconfig_ddns.propagation.PropagationChecker')
+    @mock.patch('certbot_dns_ispconfig_ddns.authenticator.sleep')
+    def test_perform_with_propagation_polling_timeout(self, sleep, checker):
+        self.config.ispconfig_ddns_propagation_polling = True
+        checker.return_value.wait_for.return_value = False
+        self.auth.perform([self.achall])
+
+        checker.assert_called_once_with(
+            nameservers=None, max_workers=TEST_MAX_WORKERS
+        )
+        sleep.assert_not_called()
+
+    @mock.patch('certbot_dns_ispconfig_ddns.propagation.PropagationChecker')
+    @mock.patch('certbot_dns_ispconfig_ddns.authenticator.sleep')
+    def test_perform_with_propagation_polling_error(self, sleep, checker):
+        self.config.ispconfig_ddns_propagation_polling = True
+        self.config.ispconfig_ddns_propagation_seconds = 30
+        checker.return_value.wait_for.side_effect = KeyError('lookup')
+        self.auth.perform([self.achall])
+
+        sleep.assert_called_once()
+        self.assertLessEqual(sleep.call_args.args[0], 30)
+
+    def _learn_propagation(self, samples):
+        path = os.path.join(self.tempdir, "history.json")
+        self.config.ispconfig_ddns_propagation_learning = True
+        self.config.ispconfig_ddns_propagation_history_file = path
+        self.config.ispconfig_ddns_propagation_seconds = 60
+        history = PropagationHistory(path)
+        for seconds in samples:
+            history.record({DOMAIN: seconds})
+        return history
+
+    @staticmethod
+    def _propagated_after(checker, seconds):
+        def wait_for(records, timeout, times):
+            times.update((name, seconds) for name, _ in records)
+            return True
+
+        checker.return_value.wait_for.side_effect = wait_for
+
+    @mock.patch('certbot_dns_ispconfig_ddns.propagation.PropagationChecker')
+    @mock.patch('certbot_dns_ispconfig_ddns.authenticator.sleep')
+    def test_propagation_learning(self, sleep, checker):
+        history = self._learn_propagation([5.0, 6.5, 6.0])
+        self._propagated_after(checker, 0.5)
+        self.auth.perform([self.achall])
+
+        sleep.assert_called_once_with(2.0)
+        checker.return_value.wait_for.assert_called_once_with(
+            [("_acme-challenge." + DOMAIN, mock.ANY)], 5.0, times=mock.ANY
+        )
+        self.auth.cleanup([self.achall])
+        with open(history.path) as history_file:
+            self.assertEqual([5.0, 6.5, 6.0, 2.5],
+                             json.load(history_file)[0]["samples"])
+
+    @mock.patch('certbot_dns_ispconfig_ddns.propagation.PropagationChecker')
+    @mock.patch('certbot_dns_ispconfig_ddns.authenticator.sleep')
+    def test_propagation_learning_converges(self, sleep, checker):
+        history = self._learn_propagation([])
+        self._propagated_after(checker, 1.0)
+        for _ in range(3):
+            self.auth.perform([self.achall])
+            self.auth.cleanup([self.achall])
+
+        # the first runs wait at most the propagation seconds, then the
+        # measured 3 seconds
+        self.assertEqual({DOMAIN: 3.0}, history.estimate([DOMAIN]))
+        self.auth.perform([self.achall])
+        self.assertEqual(
+            1.0, checker.return_value.wait_for.call_args.args[1]
+        )
+
+    @mock.patch('certbot_dns_ispconfig_ddns.propagation.PropagationChecker')
+    @mock.patch('certbot_dns_ispconfig_ddns.authenticator.sleep')
+    def test_propagation_learning_not_yet_visible(self, sleep, checker):
+        history = self._learn_propagation([5.0, 6.5, 6.0])
+        checker.return_value.wait_for.return_value = False
+        self.auth.perform([self.achall])
+        self.auth.cleanup([self.achall])
+
+        sleep.assert_called_once_with(2.0)
+        self.assertEqual(5.0,
+                         checker.return_value.wait_for.call_args.args[1])
+        with open(history.path) as history_file:
+            self.assertEqual([5.0, 6.5, 6.0],
+                             json.load(history_file)[0]["samples"])
+
+    @mock.patch('certbot_dns_ispconfig_ddns.propagation.PropagationChecker')
+    @mock.patch('certbot_dns_ispconfig_ddns.authenticator.sleep')
+    def test_propagation_learning_check_error(self, sleep, checker):
+        history = self._learn_propagation([])
+        checker.return_value.wait_for.side_effect = KeyError('lookup')
+        self.auth.perform([self.achall])
+        self.auth.cleanup([self.achall])
+
+        self.assertAlmostEqual(
+            60, sum(call.args[0] for call in sleep.mock_calls), places=2
+        )
+        self.assertEqual({}, history.estimate([DOMAIN]))
+
+    @mock.patch('certbot_dns_ispconfig_ddns.propagation.PropagationChecker')
+    @mock.patch('certbot_dns_ispconfig_ddns.authenticator.sleep')
+    def test_propagation_learning_capped(self, sleep, checker):
+        self._learn_propagation([90.0, 90.0, 90.0])
+        checker.return_value.wait_for.return_value = False
+        self.auth.perform([self.achall])
+
+        sleep.assert_called_once_with(2.0)
+        self.assertEqual(58.0,
+                         checker.return_value.wait_for.call_args.args[1])
+
+    @mock.patch('certbot_dns_ispconfig_ddns.propagation.PropagationChecker')
+    @mock.patch('certbot_dns_ispconfig_ddns.authenticator.sleep')
+    def test_propagation_history_write_error(self, sleep, checker):
+        history = self._learn_propagation([])
+        self._propagated_after(checker, 0.5)
+        self.auth.perform([self.achall])
+        with mock.patch.object(history.__class__, "record",
+                               side_effect=OSError("full")):
+            self.auth.cleanup([self.achall])
+
+        self.assertIn(mock.call().close(), self.mock_client.mock_calls)
+
+    @mock.patch('certbot_dns_ispconfig_ddns.propagation.PropagationChecker')
+    @mock.patch('certbot_dns_ispconfig_ddns.authenticator.sleep')
+    def test_auth_hint_resets_propagation_history(self, sleep, checker):
+        history = self._learn_propagation([5.0, 5.0, 5.0])
+        self.auth.perform([self.achall])
+        hint = self.auth.auth_hint([self.achall])
+        self.auth.cleanup([self.achall])
+
+        self.assertIn("propagation-seconds", hint)
+        self.assertEqual({}, history.estimate([DOMAIN]))
+        with open(history.path) as history_file:
+            self.assertEqual([], json.load(history_file))
+
+    @mock.patch('certbot_dns_ispconfig_ddns.propagation.PropagationChecker')
+    @mock.patch('certbot_dns_ispconfig_ddns.authenticator.sleep')
+    def test_propagation_learning_with_polling(self, sleep, checker):
+        history = self._learn_propagation([])
+        self.config.ispconfig_ddns_propagation_polling = True
+        self._propagated_after(checker, 2.5)
+        self.auth.perform([self.achall])
+        self.auth.cleanup([self.achall])
+
+        with open(history.path) as history_file:
+            self.assertEqual([{"zone": DOMAIN, "samples": [2.5]}],
+                             json.load(history_file))
+
+    def test_perform_with_propagation_polling_without_dnspython(self):
+        self.config.ispconfig_ddns_propagation_polling = True
+        with mock.patch.dict(
+            'sys.modules',
+            {'certbot_dns_ispconfig_ddns.propagation': None}
+        ):
+            with self.assertRaises(errors.PluginError):
+                self.auth.perform([self.achall])
 
     def test_perform_with_exception(self):
         ex = KeyError('foo')
-        self.mock_client().set_txt_record = mock.Mock(
+        self.mock_client().set_txt_records = mock.Mock(
             side_effect=ex
         )
         with self.assertRaises(errors.PluginError) as err:
             self.auth.perform([self.achall])
 
-        self.assertEqual(err.exception.args[0], ex)
+        self.assertEqual(
+            err.exception.args[0],
+            f"Failed to add TXT record for 1 of 1 domain(s): {DOMAIN}: 'foo'"
+        )
+
+    def test_perform_multiple_domains(self):
+        domains = [f"host{i}.{DOMAIN}" for i in range(10)]
+        responses = self.auth.perform([achall(d) for d in domains])
+
+        self.assertEqual(len(responses), len(domains))
+        set_txt_records = self.mock_client.return_value.set_txt_records
+        set_txt_records.assert_called_once()
+        self.assertEqual(
+            [name for name, _ in set_txt_records.call_args.args[0]],
+            ["_acme-challenge." + d for d in domains]
+        )
+        self.assertEqual(1, self.mock_client.call_count)
+
+    def test_perform_reports_failures_per_domain(self):
+        failing = {"_acme-challenge.a." + DOMAIN: KeyError('a'),
+                   "_acme-challenge.c." + DOMAIN: KeyError('c')}
+
+        def set_txt_records(records, max_workers, deadline):
+            raise ISPConfigBulkError("add", {
+                (name, value): failing[name]
+                for name, value in records if name in failing
+            })
+
+        self.mock_client().set_txt_records = mock.Mock(
+            side_effect=set_txt_records
+        )
+        achalls = [achall(d + "." + DOMAIN) for d in ("a", "b", "c")]
+        with self.assertRaises(errors.PluginError) as err:
+            self.auth.perform(achalls)
+
+        self.assertEqual(
+            err.exception.args[0],
+            f"Failed to add TXT record for 2 of 3 domain(s): "
+            f"a.{DOMAIN}: 'a'; c.{DOMAIN}: 'c'"
+        )
+
+    def test_cleanup_multiple_domains(self):
+        self.auth._attempt_cleanup = True
+        domains = [f"host{i}.{DOMAIN}" for i in range(10)]
+        self.auth.cleanup([achall(d) for d in domains])
+
+        del_txt_records = self.mock_client.return_value.del_txt_records
+        del_txt_records.assert_called_once()
+        self.assertEqual(
+            [name for name, _ in del_txt_records.call_args.args[0]],
+            ["_acme-challenge." + d for d in domains]
+        )
+        self.mock_client.return_value.close.assert_called_once_with()
+
+    def test_cleanup_writes_metrics(self):
+        path = os.path.join(self.tempdir, "metrics", "ddns.prom")
+        self.config.ispconfig_ddns_metrics_file = path
+        self.auth.perform([self.achall])
+        self.auth.cleanup([self.achall])
+
+        with open(path) as metrics_file:
+            metrics = metrics_file.read()
+        for phase in ("add", "propagation", "delete"):
+            self.assertIn(
+                f'ispconfig_ddns_phase_duration_seconds{{phase="{phase}"}}',
+                metrics
+            )
+        self.assertNotIn(TEST_TOKEN, metrics)
+
+    def test_cleanup_metrics_write_error(self):
+        self.config.ispconfig_ddns_metrics_file = os.path.join(
+            self.tempdir, "metrics.json"
+        )
+        self.auth._attempt_cleanup = True
+        with mock.patch.object(self.auth._metrics, 'write',
+                               side_effect=OSError('read-only')):
+            self.auth.cleanup([self.achall])
+
+        self.mock_client.return_value.close.assert_called_once_with()
+
+    def test_state_cache_skips_redundant_updates(self):
+        self.config.ispconfig_ddns_state_cache = True
+        client = self.mock_client.return_value
+        self.auth.perform([self.achall])
+        self.auth.perform([self.achall])
+        self.assertEqual(1, client.set_txt_records.call_count)
+
+        self.auth.cleanup([self.achall])
+        self.auth.cleanup([self.achall])
+        self.assertEqual(1, client.del_txt_records.call_count)
+
+    def test_state_cache_skips_delete_of_rejected_add(self):
+        self.config.ispconfig_ddns_state_cache = True
+        response = requests.Response()
+        response.status_code = 403
+        name = "_acme-challenge." + DOMAIN
+        value = self.achall.validation(self.achall.account_key)
+        self.mock_client().set_txt_records = mock.Mock(
+            side_effect=ISPConfigBulkError("add", {
+                (name, value): requests.exceptions.HTTPError(response=response)
+            })
+        )
+        with self.assertRaises(errors.PluginError):
+            self.auth.perform([self.achall])
+        self.auth.cleanup([self.achall])
+
+        self.mock_client().del_txt_records.assert_not_called()
+        state = RecordStateCache(os.path.join(self.tempdir, STATE_FILE_NAME))
+        self.assertEqual({(name, value): "absent"},
+                         state.known(TEST_ENDPOINT, [(name, value)]))
+
+    def test_state_cache_keeps_record_of_unsent_delete(self):
+        self.config.ispconfig_ddns_state_cache = True
+        name = "_acme-challenge." + DOMAIN
+        value = self.achall.validation(self.achall.account_key)
+        client = self.mock_client.return_value
+        self.auth.perform([self.achall])
+        client.del_txt_records.side_effect = ISPConfigBulkError(
+            "delete", {(name, value): CircuitOpenError("open")}
+        )
+        with self.assertRaises(errors.PluginError):
+            self.auth.cleanup([self.achall])
+
+        state = RecordStateCache(os.path.join(self.tempdir, STATE_FILE_NAME))
+        self.assertEqual({(name, value): "present"},
+                         state.known(TEST_ENDPOINT, [(name, value)]))
+        # the next cleanup still deletes the record
+        client.del_txt_records.side_effect = None
+        self.auth.cleanup([self.achall])
+        self.assertEqual(2, client.del_txt_records.call_count)
+
+    def test_perform_single_record(self):
+        self.auth._perform(DOMAIN, "_acme-challenge." + DOMAIN, "foo")
+
+        self.mock_client.return_value.set_txt_record.assert_called_once_with(
+            "_acme-challenge." + DOMAIN, "foo"
+        )
+        self.mock_client().set_txt_record.side_effect = KeyError('foo')
+        with self.assertRaises(errors.PluginError):
+            self.auth._perform(DOMAIN, "_acme-challenge." + DOMAIN, "foo")
+
+    def test_cleanup_single_record(self):
+        self.auth._cleanup(DOMAIN, "_acme-challenge." + DOMAIN, "foo")
+
+        self.mock_client.return_value.del_txt_record.assert_called_once_with(
+            "_acme-challenge." + DOMAIN, "foo"
+        )
+        self.mock_client().del_txt_record.side_effect = KeyError('foo')
+        with self.assertRaises(errors.PluginError):
+            self.auth._cleanup(DOMAIN, "_acme-challenge." + DOMAIN, "foo")
+
+    def _perform_with_deferred_cleanup(self, achalls):
+        self.config.ispconfig_ddns_deferred_cleanup = True
+        self.auth.perform(achalls)
+        return CleanupJournal(os.path.join(self.tempdir, JOURNAL_FILE_NAME))
+
+    def test_deferred_cleanup(self):
+        journal = self._perform_with_deferred_cleanup([self.achall])
+        validation = self.achall.validation(self.achall.account_key)
+        self.assertEqual(
+            [(TEST_ENDPOINT, "_acme-challenge." + DOMAIN, validation)],
+            journal.pending()
+        )
+
+        executor = self.auth._deferred_cleanup._executor
+        self.auth.cleanup([self.achall])
+        executor.shutdown(wait=True)
+
+        client = self.mock_client.return_value
+        client.del_txt_records.assert_called_once_with(
+            [("_acme-challenge." + DOMAIN, validation)],
+            max_workers=TEST_MAX_WORKERS
+        )
+        client.close.assert_called_once_with()
+        self.assertEqual([], journal.pending())
+        self.assertEqual({}, self.auth._ispconfig_clients)
+
+    def test_deferred_cleanup_writes_metrics(self):
+        path = os.path.join(self.tempdir, "metrics.json")
+        self.config.ispconfig_ddns_metrics_file = path
+        self._perform_with_deferred_cleanup([self.achall])
+
+        executor = self.auth._deferred_cleanup._executor
+        self.auth.cleanup([self.achall])
+        executor.shutdown(wait=True)
+
+        self.assertTrue(os.path.exists(path))
+
+    def test_deferred_cleanup_saves_cassette(self):
+        self.config.ispconfig_ddns_cassette = \
+            os.path.join(self.tempdir, "cassette.json")
+        self.config.ispconfig_ddns_cassette_mode = "record"
+        self.config.ispconfig_ddns_spool_dir = \
+            os.path.join(self.tempdir, "spool")
+        self.config.ispconfig_ddns_spool_window = 0
+        self._perform_with_deferred_cleanup([self.achall])
+
+        executor = self.auth._deferred_cleanup._executor
+        self.auth.cleanup([self.achall])
+        executor.shutdown(wait=True)
+
+        self.mock_client.return_value.del_txt_records.assert_called_once_with(
+            [("_acme-challenge." + DOMAIN, mock.ANY)],
+            max_workers=TEST_MAX_WORKERS, deadline=mock.ANY
+        )
+        self.mock_client.return_value.close.assert_called_once_with()
+        self.assertIsNone(self.auth._spool)
+        self.assertTrue(os.path.exists(self.config.ispconfig_ddns_cassette))
+
+    def test_deferred_cleanup_replays_leftovers(self):
+        journal_path = os.path.join(self.tempdir, "journal.json")
+        self.config.ispconfig_ddns_journal = journal_path
+        old = CleanupJournal(journal_path, clock=lambda: time.time() - 7200)
+        old.add(TEST_ENDPOINT, [("_acme-challenge.old." + DOMAIN, "x")])
+        old.add("http://other", [("_acme-challenge." + DOMAIN, "y")])
+        journal = CleanupJournal(journal_path)
+        # journaled a moment ago by a run that is still validating
+        journal.add(TEST_ENDPOINT, [("_acme-challenge.new." + DOMAIN, "z")])
+
+        self._perform_with_deferred_cleanup([self.achall])
+        self.auth._deferred_cleanup._executor.shutdown(wait=True)
+
+        client = self.mock_client.return_value
+        client.del_txt_records.assert_called_once_with(
+            [("_acme-challenge.old." + DOMAIN, "x")],
+            max_workers=TEST_MAX_WORKERS
+        )
+        self.assertEqual(
+            [(TEST_ENDPOINT, "_acme-challenge." + DOMAIN,
+              self.achall.validation(self.achall.account_key)),
+             (TEST_ENDPOINT, "_acme-challenge.new." + DOMAIN, "z"),
+             ("http://other", "_acme-challenge." + DOMAIN, "y")],
+            sorted(journal.pending())
+        )
+
+    def test_deferred_cleanup_keeps_own_leftover(self):
+        journal_path = os.path.join(self.tempdir, "journal.json")
+        self.config.ispconfig_ddns_journal = journal_path
+        record = ("_acme-challenge." + DOMAIN,
+                  self.achall.validation(self.achall.account_key))
+        # a previous run crashed with the authorization this run reuses
+        old = CleanupJournal(journal_path, clock=lambda: time.time() - 7200)
+        old.add(TEST_ENDPOINT, [record])
+
+        self._perform_with_deferred_cleanup([self.achall])
+        self.auth._deferred_cleanup._executor.shutdown(wait=True)
+
+        client = self.mock_client.return_value
+        client.del_txt_records.assert_not_called()
+        journal = CleanupJournal(journal_path)
+        self.assertEqual([(TEST_ENDPOINT, *record)], journal.pending())
+        self.assertEqual([], journal.leftovers())
+
+    def test_deferred_cleanup_keeps_failed_records(self):
+        journal = self._perform_with_deferred_cleanup([self.achall])
+        self.mock_client().del_txt_records.side_effect = KeyError('down')
+
+        executor = self.auth._deferred_cleanup._executor
+        self.auth.cleanup([self.achall])
+        executor.shutdown(wait=True)
+
+        self.assertEqual(1, len(journal.pending()))
+        self.mock_client.return_value.close.assert_called_once_with()
+
+    def test_cleanup_without_perform(self):
+        self.auth.cleanup([self.achall])
+
+        self.assertEqual([], self.mock_client.mock_calls)
 
     def test_cleanup(self):
         self.auth._attempt_cleanup = True
         self.auth.cleanup([self.achall])
 
         expected = [
-            mock.call(endpoint=TEST_ENDPOINT, token=TEST_TOKEN),
-            mock.call().del_txt_record("_acme-challenge." + DOMAIN, mock.ANY)
+            mock.call(endpoint=TEST_ENDPOINT, token=TEST_TOKEN,
+                      pool_maxsize=TEST_POOL_SIZE, retry_policy=mock.ANY,
+                      circuit_breakers=mock.ANY,
+                      metrics=mock.ANY, limiters=mock.ANY,
+                      connect_timeout=10.0, read_timeout=30.0,
+                      transport=None),
+            mock.call().del_txt_records(
+                [("_acme-challenge." + DOMAIN, mock.ANY)],
+                max_workers=TEST_MAX_WORKERS, deadline=mock.ANY
+            ),
+            mock.call().close(),
         ]
         self.assertEqual(expected, self.mock_client.mock_calls)
 
     def test_cleanup_with_exception(self):
         self.auth._attempt_cleanup = True
-        ex = KeyError('bar')
-        self.mock_client().del_txt_record = mock.Mock(
+        ex = ISPConfigBulkError("delete", {
+            ("_acme-challenge." + DOMAIN,
+             self.achall.validation(self.achall.account_key)): KeyError('bar')
+        })
+        self.mock_client().del_txt_records = mock.Mock(
             side_effect=ex
         )
         with self.assertRaises(errors.PluginError) as err:
             self.auth.cleanup([self.achall])
 
-        self.assertEqual(err.exception.args[0], ex)
+        self.assertEqual(
+            err.exception.args[0],
+            f"Failed to delete TXT record for 1 of 1 domain(s): "
+            f"{DOMAIN}: 'bar'"
+        )
+        self.mock_client.return_value.close.assert_called_once_with()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,112 @@
+"""Tests for certbot_dns_ispconfig_ddns.cassette."""
+import json
+
+import mock
+import responses
+from certbot.compat import os
+from certbot.plugins.dns_test_common import DOMAIN
+from certbot.tests import util as test_util
+
+from certbot_dns_ispconfig_ddns.cassette import Cassette, CassetteAdapter, \
+    CassetteError, redact_url
+from certbot_dns_ispconfig_ddns.ispconfig_client import ISPConfigBulkError, \
+    ISPConfigClient
+
+TEST_ENDPOINT = "http://endpoint"
+TEST_TOKEN = "token123"
+FQDN = "_acme-challenge." + DOMAIN
+UPDATE_URL = f"{TEST_ENDPOINT}/ddns/update.php"
+
+
+class CassetteTest(test_util.TempDirTestCase):
+
+    def setUp(self):
+        super(CassetteTest, self).setUp()
+        patcher = mock.patch('certbot_dns_ispconfig_ddns.ispconfig_client.'
+                             'sleep')
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        self.path = os.path.join(self.tempdir, "cassette.json")
+
+    def _client(self, cassette):
+        return ISPConfigClient(TEST_ENDPOINT, TEST_TOKEN,
+                               transport=CassetteAdapter(cassette))
+
+    @responses.activate
+    def _record(self):
+        responses.add(responses.POST, UPDATE_URL, body="OK")
+        responses.add(responses.DELETE, UPDATE_URL, body="NOP", status=503,
+                      headers={"Retry-After": "0", "X-Debug": "1"})
+        responses.add(responses.DELETE, UPDATE_URL, body="OK")
+        with Cassette(self.path, "record") as cassette, \
+                self._client(cassette) as client:
+            client.set_txt_record(FQDN, "recorded")
+            client.del_txt_record(FQDN, "recorded")
+        return len(responses.calls)
+
+    def test_record(self):
+        self.assertEqual(3, self._record())
+
+        with open(self.path) as cassette_file:
+            content = cassette_file.read()
+        self.assertNotIn(TEST_TOKEN, content)
+        interactions = json.loads(content)["interactions"]
+        self.assertEqual(["POST", "DELETE", "DELETE"],
+                         [i["method"] for i in interactions])
+        self.assertEqual({"Content-Type": "text/plain", "Retry-After": "0"},
+                         interactions[1]["headers"])
+        self.assertEqual(503, interactions[1]["status"])
+
+    def test_replay_without_network(self):
+        self._record()
+        cassette = Cassette(self.path)
+        with self._client(cassette) as client:
+            # the validation differs from the recorded one
+            client.set_txt_record(FQDN, "replayed")
+            # the retry after the recorded 503 gets the recorded 200
+            client.del_txt_record(FQDN, "replayed")
+
+    def test_replay_unknown_request(self):
+        self._record()
+        with self._client(Cassette(self.path)) as client:
+            with self.assertRaises(CassetteError):
+                client.set_txt_record("_acme-challenge.other.org", "value")
+            with self.assertRaises(ISPConfigBulkError) as err:
+                client.set_txt_records([("_acme-challenge.other.org", "v")])
+
+        self.assertIsInstance(
+            err.exception.failures[("_acme-challenge.other.org", "v")],
+            CassetteError
+        )
+
+    def test_replay_repeats_last_response(self):
+        self._record()
+        with self._client(Cassette(self.path)) as client:
+            for _ in range(3):
+                client.set_txt_record(FQDN, "replayed")
+
+    def test_missing_cassette(self):
+        with self.assertRaises(CassetteError):
+            Cassette(self.path)
+
+    def test_invalid_cassette(self):
+        with open(self.path, "w") as cassette_file:
+            json.dump({"version": 99, "interactions": []}, cassette_file)
+        with self.assertRaises(CassetteError):
+            Cassette(self.path)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(CassetteError):
+            Cassette(self.path, "rewind")
+
+    def test_replay_not_saved(self):
+        self._record()
+        with Cassette(self.path) as cassette:
+            cassette._interactions = []
+        self.assertEqual(3, len(Cassette(self.path)._interactions))
+
+    def test_redact_url(self):
+        self.assertEqual(
+            f"{UPDATE_URL}?action=add&token=REDACTED",
+            redact_url(f"{UPDATE_URL}?action=add&token={TEST_TOKEN}")
+        )
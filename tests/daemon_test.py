@@ -0,0 +1,204 @@
+"""Tests for certbot_dns_ispconfig_ddns.daemon."""
+import pathlib
+import socket
+import stat
+import threading
+import unittest
+
+import mock
+import requests
+from certbot.compat import os
+from certbot.plugins.dns_test_common import DOMAIN
+from certbot.tests import util as test_util
+
+from certbot_dns_ispconfig_ddns.daemon import DaemonClient, DDNSDaemon, \
+    hook_main
+from certbot_dns_ispconfig_ddns.ispconfig_client import CircuitOpenError, \
+    ISPConfigBulkError, ISPConfigClientError, is_not_applied
+from certbot_dns_ispconfig_ddns.retry import Deadline
+
+TEST_ENDPOINT = "http://endpoint"
+TEST_TOKEN = "token123"
+RECORD = ("_acme-challenge." + DOMAIN, "foo")
+
+
+class DaemonTest(test_util.TempDirTestCase):
+
+    def setUp(self):
+        super(DaemonTest, self).setUp()
+        patcher = mock.patch(
+            'certbot_dns_ispconfig_ddns.daemon.ISPConfigClient'
+        )
+        self.addCleanup(patcher.stop)
+        self.mock_client = patcher.start()
+
+        self.socket_path = os.path.join(self.tempdir, "daemon.sock")
+        self.daemon = DDNSDaemon(self.socket_path, pool_size=3,
+                                 max_workers=4, retries=1)
+        thread = threading.Thread(
+            target=self.daemon.serve_forever, kwargs={"poll_interval": 0.01}
+        )
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.daemon.server_close)
+        self.addCleanup(self.daemon.shutdown)
+        self.client = DaemonClient(self.socket_path, TEST_ENDPOINT + "/",
+                                   TEST_TOKEN, timeout=5)
+
+    def test_socket_permissions(self):
+        mode = pathlib.Path(self.socket_path).stat().st_mode
+        self.assertTrue(stat.S_ISSOCK(mode))
+        self.assertEqual(0o600, stat.S_IMODE(mode))
+
+    def test_updates_share_client(self):
+        self.client.set_txt_records([RECORD, ("a", "b")], max_workers=99)
+        self.client.del_txt_record(*RECORD)
+        self.client.set_txt_records([])
+
+        self.mock_client.assert_called_once_with(
+            endpoint=TEST_ENDPOINT, token=TEST_TOKEN, pool_maxsize=3,
+            retry_policy=mock.ANY, circuit_breakers=mock.ANY,
+            limiters=mock.ANY
+        )
+        client = self.mock_client.return_value
+        client.set_txt_records.assert_called_once_with(
+            [RECORD, ("a", "b")], max_workers=4, deadline=mock.ANY
+        )
+        client.del_txt_records.assert_called_once_with(
+            [RECORD], max_workers=4, deadline=mock.ANY
+        )
+
+    def test_deadline_forwarded(self):
+        self.client.set_txt_records([RECORD], deadline=Deadline(60))
+
+        deadline = self.mock_client.return_value.set_txt_records \
+            .call_args.kwargs["deadline"]
+        self.assertTrue(59 < deadline.remaining() <= 60)
+
+    def test_bulk_failure(self):
+        self.mock_client.return_value.set_txt_records.side_effect = \
+            ISPConfigBulkError("add", {RECORD: KeyError('foo')})
+        with self.assertRaises(ISPConfigBulkError) as err:
+            self.client.set_txt_records([RECORD, ("a", "b")])
+
+        self.assertEqual([RECORD], list(err.exception.failures))
+        self.assertEqual("'foo'", str(err.exception.failures[RECORD]))
+
+    def test_failure_applied_state(self):
+        response = requests.Response()
+        response.status_code = 502
+        self.mock_client.return_value.set_txt_records.side_effect = \
+            ISPConfigBulkError("add", {
+                RECORD: requests.exceptions.HTTPError(response=response),
+                ("a", "b"): CircuitOpenError("open"),
+            })
+        with self.assertRaises(ISPConfigBulkError) as err:
+            self.client.set_txt_records([RECORD, ("a", "b")])
+
+        # the 502 may have come after the record was added
+        self.assertFalse(is_not_applied(err.exception.failures[RECORD]))
+        self.assertTrue(is_not_applied(err.exception.failures[("a", "b")]))
+
+    def test_other_failure(self):
+        self.mock_client.return_value.del_txt_records.side_effect = \
+            KeyError('foo')
+        with self.assertRaises(ISPConfigBulkError) as err:
+            self.client.del_txt_records([RECORD])
+
+        self.assertEqual([RECORD], list(err.exception.failures))
+
+    def test_invalid_request(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.socket_path)
+            sock.sendall(b'{"action": "add"}\n'
+                         b'{"action": "nop", "endpoint": "e", "token": "t", '
+                         b'"records": []}\n')
+            with sock.makefile("rb") as stream:
+                responses = [stream.readline(), stream.readline()]
+
+        self.assertIn(b'"ok": false', responses[0])
+        self.assertIn(b"Invalid request", responses[0])
+        self.assertIn(b"Unknown action: nop", responses[1])
+
+    def test_already_running(self):
+        with self.assertRaises(ISPConfigClientError):
+            DDNSDaemon(self.socket_path)
+
+    def test_close_closes_clients(self):
+        self.client.set_txt_record(*RECORD)
+        self.daemon.server_close()
+
+        self.mock_client.return_value.close.assert_called_once_with()
+        self.assertFalse(os.path.exists(self.socket_path))
+
+
+class StaleSocketTest(test_util.TempDirTestCase):
+
+    def test_stale_socket_replaced(self):
+        path = os.path.join(self.tempdir, "daemon.sock")
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(path)
+        stale.close()
+
+        daemon = DDNSDaemon(path)
+        daemon.server_close()
+
+    def test_not_a_socket(self):
+        path = os.path.join(self.tempdir, "file")
+        open(path, "w").close()
+        with self.assertRaises(ISPConfigClientError):
+            DDNSDaemon(path)
+
+
+class HookTest(test_util.TempDirTestCase):
+
+    def setUp(self):
+        super(HookTest, self).setUp()
+        patcher = mock.patch.dict(os.environ, {
+            "CERTBOT_DOMAIN": DOMAIN, "CERTBOT_VALIDATION": "foo",
+            "ISPCONFIG_DDNS_ENDPOINT": TEST_ENDPOINT,
+            "ISPCONFIG_DDNS_TOKEN": TEST_TOKEN,
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.socket_path = os.path.join(self.tempdir, "daemon.sock")
+
+    @mock.patch('certbot_dns_ispconfig_ddns.daemon.DaemonClient')
+    @mock.patch('certbot_dns_ispconfig_ddns.daemon.time.sleep')
+    def test_add_through_daemon(self, sleep, daemon_client):
+        self.assertEqual(0, hook_main(["add", "--socket", self.socket_path,
+                                       "--propagation-seconds", "5"]))
+
+        daemon_client.assert_called_once_with(
+            self.socket_path, TEST_ENDPOINT, TEST_TOKEN
+        )
+        daemon_client.return_value.set_txt_records.assert_called_once_with(
+            [RECORD]
+        )
+        sleep.assert_called_once_with(5)
+
+    @mock.patch('certbot_dns_ispconfig_ddns.daemon.ISPConfigClient')
+    @mock.patch('certbot_dns_ispconfig_ddns.daemon.time.sleep')
+    def test_delete_without_daemon(self, sleep, client):
+        self.assertEqual(
+            0, hook_main(["delete", "--socket", self.socket_path])
+        )
+
+        client.return_value.__enter__.return_value.del_txt_record \
+            .assert_called_once_with(*RECORD)
+        sleep.assert_not_called()
+
+    @mock.patch('certbot_dns_ispconfig_ddns.daemon.ISPConfigClient')
+    def test_failure(self, client):
+        client.return_value.__enter__.return_value.set_txt_record \
+            .side_effect = KeyError('foo')
+        self.assertEqual(1, hook_main(["add", "--socket", self.socket_path]))
+
+    def test_missing_environment(self):
+        del os.environ["CERTBOT_VALIDATION"]
+        with self.assertRaises(SystemExit):
+            hook_main(["add"])
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
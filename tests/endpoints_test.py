@@ -0,0 +1,114 @@
+"""Tests for certbot_dns_ispconfig_ddns.endpoints."""
+import threading
+import unittest
+
+import mock
+
+from certbot_dns_ispconfig_ddns.endpoints import EndpointSelector, \
+    parse_endpoints
+from certbot_dns_ispconfig_ddns.retry import CircuitBreaker
+
+ENDPOINTS = ["http://a", "http://b", "http://c"]
+
+
+class ParseEndpointsTest(unittest.TestCase):
+
+    def test_comma_separated(self):
+        self.assertEqual(
+            ["http://a", "http://b"],
+            parse_endpoints(" http://a/, http://b ,,http://a")
+        )
+
+    def test_list(self):
+        self.assertEqual(["http://a"], parse_endpoints(["http://a/"]))
+
+    def test_empty(self):
+        self.assertEqual([], parse_endpoints(None))
+        self.assertEqual([], parse_endpoints(" , "))
+
+
+class EndpointSelectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.probe = mock.Mock()
+        self.selector = EndpointSelector(ENDPOINTS, self.probe,
+                                         probe_interval=None, smoothing=0.5)
+
+    def test_no_endpoints(self):
+        with self.assertRaises(ValueError):
+            EndpointSelector([], self.probe)
+
+    def test_first_endpoint_while_unknown(self):
+        self.assertEqual("http://a", self.selector.choose())
+
+    def test_lowest_latency(self):
+        self.selector.record_success("http://a", 0.4)
+        self.selector.record_success("http://b", 0.1)
+        self.assertEqual("http://b", self.selector.choose())
+
+        # a node that becomes slow is left for a faster one
+        self.selector.record_success("http://b", 0.9)
+        self.assertEqual(0.5, self.selector.latency("http://b"))
+        self.assertEqual("http://a", self.selector.choose())
+
+    def test_failover_and_recovery(self):
+        self.selector.record_success("http://a", 0.1)
+        self.selector.record_success("http://b", 0.2)
+        self.selector.record_failure("http://a")
+        self.assertEqual("http://b", self.selector.choose())
+        self.assertTrue(self.selector.has_healthy())
+
+        self.assertTrue(self.selector.probe("http://a"))
+        self.probe.assert_called_once_with("http://a")
+        self.assertEqual("http://a", self.selector.choose())
+
+    def test_all_down(self):
+        self.selector.record_success("http://c", 0.1)
+        for endpoint in ENDPOINTS:
+            self.selector.record_failure(endpoint)
+        self.assertFalse(self.selector.has_healthy())
+        self.assertEqual("http://c", self.selector.choose())
+
+    def test_choose_allowed(self):
+        breakers = {endpoint: CircuitBreaker(failure_threshold=1)
+                    for endpoint in ENDPOINTS}
+        selector = EndpointSelector(ENDPOINTS, self.probe,
+                                    probe_interval=None,
+                                    circuit_breakers=breakers)
+        selector.record_failure("http://b")
+        breakers["http://a"].record_failure()
+        self.assertEqual("http://c", selector.choose_allowed())
+
+        # a node that is down is tried once no healthy circuit is closed
+        breakers["http://c"].record_failure()
+        self.assertEqual("http://b", selector.choose_allowed())
+        breakers["http://b"].record_failure()
+        self.assertIsNone(selector.choose_allowed())
+
+    def test_failed_probe(self):
+        self.probe.side_effect = OSError("refused")
+        self.assertFalse(self.selector.probe("http://a"))
+        self.assertEqual("http://b", self.selector.choose())
+
+    def test_background_probes(self):
+        probed = threading.Event()
+        seen = set()
+
+        def probe(endpoint):
+            seen.add(endpoint)
+            if seen == set(ENDPOINTS):
+                probed.set()
+
+        selector = EndpointSelector(ENDPOINTS, probe, probe_interval=60)
+        selector.start()
+        self.assertTrue(probed.wait(5))
+        selector.close()
+        for thread in selector._threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        for endpoint in ENDPOINTS:
+            self.assertIsNotNone(selector.latency(endpoint))
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -1,12 +1,18 @@
 """Tests for certbot_dns_ispconfig.dns_ispconfig."""
 import unittest
 
+import mock
+
 import requests
 import responses
 from certbot.plugins.dns_test_common import DOMAIN
 
-from certbot_dns_ispconfig_ddns.ispconfig_client import ISPConfigClient, \
-    ISPConfigClientError
+from certbot_dns_ispconfig_ddns.ispconfig_client import CircuitOpenError, \
+    DeadlineExceededError, ISPConfigBulkError, ISPConfigClient, \
+    ISPConfigClientError, TokenRejectedError, group_records, is_not_applied
+from certbot_dns_ispconfig_ddns.metrics import Metrics
+from certbot_dns_ispconfig_ddns.retry import AdaptiveLimiter, CircuitBreaker, \
+    Deadline, RetryPolicy
 
 TEST_ENDPOINT = "http://endpoint"
 TEST_TOKEN = "token123"
@@ -17,8 +23,24 @@ class ISPConfigClientTest(unittest.TestCase):
     record_content = "bar"
 
     def setUp(self):
+        patcher = mock.patch(
+            'certbot_dns_ispconfig_ddns.ispconfig_client.sleep'
+        )
+        self.addCleanup(patcher.stop)
+        self.sleep = patcher.start()
         self.client = ISPConfigClient(TEST_ENDPOINT, TEST_TOKEN)
 
+    def _add_response(self, status, method=responses.POST, action="add",
+                      **kwargs):
+        responses.add(**{
+            'method': method,
+            'url': (f"{TEST_ENDPOINT}/ddns/update.php?action={action}&"
+                    f"type=TXT&record={DOMAIN}&data={self.record_content}"),
+            'body': 'OK' if status == 200 else 'NOP',
+            'status': status,
+            **kwargs
+        })
+
     def test_missing_endpoint(self):
         with self.assertRaises(ISPConfigClientError) as err:
             ISPConfigClient('', TEST_TOKEN)
@@ -29,6 +51,456 @@ class ISPConfigClientTest(unittest.TestCase):
             ISPConfigClient(TEST_ENDPOINT, '')
         self.assertEqual(err.exception.args[0], "Missing token: ")
 
+    def test_close(self):
+        with mock.patch.object(self.client._session, 'close') as close:
+            self.client.close()
+        close.assert_called_once_with()
+
+    def test_context_manager_closes_session(self):
+        client = ISPConfigClient(TEST_ENDPOINT, TEST_TOKEN)
+        with mock.patch.object(client._session, 'close') as close:
+            with client:
+                pass
+        close.assert_called_once_with()
+
+    def test_pool_size(self):
+        client = ISPConfigClient(TEST_ENDPOINT, TEST_TOKEN,
+                                 pool_connections=2, pool_maxsize=7)
+        adapter = client._session.get_adapter(TEST_ENDPOINT)
+        self.assertEqual(adapter._pool_connections, 2)
+        self.assertEqual(adapter._pool_maxsize, 7)
+
+    @responses.activate
+    def test_session_reused_for_all_requests(self):
+        for method, action in ((responses.POST, "add"),
+                               (responses.DELETE, "delete")):
+            responses.add(**{
+                'method': method,
+                'url': (f"{TEST_ENDPOINT}/ddns/update.php?"
+                        f"action={action}&type=TXT&"
+                        f"record={DOMAIN}&data={self.record_content}"),
+                'body': 'OK',
+                'status': 200,
+            })
+        with mock.patch.object(
+            self.client._session, 'request',
+            wraps=self.client._session.request
+        ) as request:
+            self.client.set_txt_record(DOMAIN, self.record_content)
+            self.client.del_txt_record(DOMAIN, self.record_content)
+        self.assertEqual(request.call_count, 2)
+        for call in responses.calls:
+            self.assertTrue(
+                call.request.headers['Authorization'].startswith('Basic ')
+            )
+
+    @responses.activate
+    def test_retry_server_error(self):
+        self._add_response(502)
+        self._add_response(503)
+        self._add_response(200)
+        self.client.set_txt_record(DOMAIN, self.record_content)
+
+        self.assertEqual(3, len(responses.calls))
+        self.assertEqual(2, self.sleep.call_count)
+
+    @responses.activate
+    def test_retry_honours_retry_after(self):
+        self._add_response(429, headers={'Retry-After': '4'})
+        self._add_response(200)
+        self.client.set_txt_record(DOMAIN, self.record_content)
+
+        self.sleep.assert_called_once_with(4)
+
+    @responses.activate
+    def test_retry_connection_error(self):
+        self._add_response(
+            200, body=requests.exceptions.ConnectionError('refused')
+        )
+        self._add_response(200)
+        self.client.set_txt_record(DOMAIN, self.record_content)
+
+        self.assertEqual(2, len(responses.calls))
+
+    @responses.activate
+    def test_metrics(self):
+        metrics = Metrics()
+        client = ISPConfigClient(TEST_ENDPOINT, TEST_TOKEN, metrics=metrics)
+        self._add_response(
+            200, body=requests.exceptions.ConnectionError('refused')
+        )
+        self._add_response(503, headers={'Retry-After': '2'})
+        self._add_response(200)
+        client.set_txt_record(DOMAIN, self.record_content)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(
+            [("add", "200", 1), ("add", "503", 1),
+             ("add", "connection_error", 1)],
+            [(r["action"], r["status"], r["count"])
+             for r in snapshot["requests"]]
+        )
+        self.assertEqual(3, snapshot["request_duration_seconds"][0]["count"])
+        self.assertEqual(2, snapshot["retries"][0]["count"])
+        self.assertNotIn(TEST_TOKEN, metrics.to_prometheus())
+
+    @responses.activate
+    def test_limiter_backs_off_on_server_errors(self):
+        limiter = AdaptiveLimiter(initial_limit=4, max_limit=8)
+        client = ISPConfigClient(TEST_ENDPOINT, TEST_TOKEN,
+                                 limiters={TEST_ENDPOINT: limiter})
+        self._add_response(503)
+        self._add_response(200)
+        client.set_txt_record(DOMAIN, self.record_content)
+
+        self.assertEqual(2, limiter.limit)
+
+    @responses.activate
+    def test_retries_exhausted(self):
+        client = ISPConfigClient(TEST_ENDPOINT, TEST_TOKEN,
+                                 retry_policy=RetryPolicy(retries=2))
+        self._add_response(500)
+        with self.assertRaises(requests.exceptions.HTTPError) as err:
+            client.set_txt_record(DOMAIN, self.record_content)
+
+        self.assertEqual(err.exception.response.status_code, 500)
+        self.assertEqual(3, len(responses.calls))
+
+    @responses.activate
+    def test_retries_exhausted_connection_error(self):
+        client = ISPConfigClient(TEST_ENDPOINT, TEST_TOKEN,
+                                 retry_policy=RetryPolicy(retries=1))
+        self._add_response(
+            200, body=requests.exceptions.ConnectionError('refused')
+        )
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            client.set_txt_record(DOMAIN, self.record_content)
+
+        self.assertEqual(2, len(responses.calls))
+
+    @responses.activate
+    def test_circuit_breaker_fails_fast(self):
+        breakers = {TEST_ENDPOINT: CircuitBreaker(failure_threshold=2)}
+        client = ISPConfigClient(TEST_ENDPOINT, TEST_TOKEN,
+                                 retry_policy=RetryPolicy(retries=5),
+                                 circuit_breakers=breakers)
+        self._add_response(503)
+        with self.assertRaises(CircuitOpenError) as err:
+            client.set_txt_record(DOMAIN, self.record_content)
+        self.assertEqual(2, len(responses.calls))
+        # the 503 responses may have come after the record was added
+        self.assertFalse(is_not_applied(err.exception))
+
+        with self.assertRaises(CircuitOpenError) as err:
+            client.del_txt_record(DOMAIN, self.record_content)
+        self.assertEqual(2, len(responses.calls))
+        self.assertTrue(is_not_applied(err.exception))
+
+        # the clients of other tokens share the breaker of the endpoint
+        other = ISPConfigClient(f"{TEST_ENDPOINT}/", "other-token",
+                                circuit_breakers=breakers)
+        with self.assertRaises(CircuitOpenError):
+            other.set_txt_record(DOMAIN, self.record_content)
+        self.assertEqual(2, len(responses.calls))
+
+    @responses.activate
+    def test_circuit_breaker_trial_unexpected_error(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        client = ISPConfigClient(TEST_ENDPOINT, TEST_TOKEN,
+                                 circuit_breakers={TEST_ENDPOINT: breaker})
+        responses.add(responses.POST, f"{TEST_ENDPOINT}/ddns/update.php",
+                      body=requests.exceptions.TooManyRedirects("loop"))
+        with self.assertRaises(requests.exceptions.TooManyRedirects):
+            client.set_txt_record(DOMAIN, self.record_content)
+
+        self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+
+    def test_circuit_breaker_trial_without_free_slot(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        limiter = AdaptiveLimiter(initial_limit=1, max_limit=1)
+        client = ISPConfigClient(TEST_ENDPOINT, TEST_TOKEN,
+                                 circuit_breakers={TEST_ENDPOINT: breaker},
+                                 limiters={TEST_ENDPOINT: limiter})
+        with limiter.slot():
+            with self.assertRaises(ISPConfigBulkError) as err:
+                client.set_txt_records([(DOMAIN, self.record_content)],
+                                       deadline=Deadline(0.01))
+
+        self.assertIsInstance(
+            err.exception.failures[(DOMAIN, self.record_content)],
+            DeadlineExceededError
+        )
+        # the trial was never sent, another one is let through later
+        self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+
+    @responses.activate
+    def test_client_error_not_retried(self):
+        breaker = CircuitBreaker(failure_threshold=1)
+        client = ISPConfigClient(TEST_ENDPOINT, TEST_TOKEN,
+                                 circuit_breakers={TEST_ENDPOINT: breaker})
+        self._add_response(401)
+        with self.assertRaises(requests.exceptions.HTTPError):
+            client.set_txt_record(DOMAIN, self.record_content)
+
+        self.assertEqual(1, len(responses.calls))
+        self.assertEqual(CircuitBreaker.CLOSED, breaker.state)
+
+    @responses.activate
+    def test_timeouts(self):
+        client = ISPConfigClient(TEST_ENDPOINT, TEST_TOKEN,
+                                 connect_timeout=3, read_timeout=20)
+        self._add_response(200)
+        self._add_response(200)
+        with mock.patch.object(
+            client._session, 'request', wraps=client._session.request
+        ) as request:
+            client.set_txt_record(DOMAIN, self.record_content)
+            client.set_txt_records([(DOMAIN, self.record_content)],
+                                   deadline=Deadline(5))
+
+        self.assertEqual((3, 20), request.call_args_list[0].kwargs['timeout'])
+        connect, read = request.call_args_list[1].kwargs['timeout']
+        self.assertEqual(3, connect)
+        self.assertTrue(4 < read <= 5)
+
+    @responses.activate
+    def test_retry_timeout(self):
+        metrics = Metrics()
+        client = ISPConfigClient(TEST_ENDPOINT, TEST_TOKEN, metrics=metrics)
+        self._add_response(200, body=requests.exceptions.ReadTimeout('slow'))
+        self._add_response(200)
+        client.set_txt_record(DOMAIN, self.record_content)
+
+        self.assertEqual(2, len(responses.calls))
+        self.assertEqual(
+            ["200", "timeout"],
+            sorted(r["status"] for r in metrics.snapshot()["requests"])
+        )
+
+    @responses.activate
+    def test_deadline_cancels_outstanding_requests(self):
+        now = [0.0]
+        deadline = Deadline(1, clock=lambda: now[0])
+        self._add_response(200)
+
+        def request(*args, **kwargs):
+            now[0] += 2
+            return responses_request(*args, **kwargs)
+
+        responses_request = self.client._session.request
+        with mock.patch.object(self.client._session, 'request',
+                               side_effect=request):
+            with self.assertRaises(ISPConfigBulkError) as err:
+                self.client.set_txt_records(
+                    [(DOMAIN, self.record_content), (DOMAIN, "other")],
+                    max_workers=1, deadline=deadline
+                )
+
+        self.assertEqual(1, len(responses.calls))
+        self.assertEqual([(DOMAIN, "other")], list(err.exception.failures))
+        self.assertIsInstance(err.exception.failures[(DOMAIN, "other")],
+                              DeadlineExceededError)
+        self.assertTrue(is_not_applied(
+            err.exception.failures[(DOMAIN, "other")]
+        ))
+
+    @responses.activate
+    def test_deadline_stops_retries(self):
+        self._add_response(503, headers={'Retry-After': '30'})
+        with self.assertRaises(ISPConfigBulkError) as err:
+            self.client.set_txt_records([(DOMAIN, self.record_content)],
+                                        deadline=Deadline(10))
+
+        self.assertIsInstance(
+            err.exception.failures[(DOMAIN, self.record_content)],
+            DeadlineExceededError
+        )
+        self.assertFalse(is_not_applied(
+            err.exception.failures[(DOMAIN, self.record_content)]
+        ))
+        self.assertEqual(1, len(responses.calls))
+        self.sleep.assert_not_called()
+
+    @responses.activate
+    def test_deadline_after_timeout_may_be_applied(self):
+        now = [0.0]
+        deadline = Deadline(5, clock=lambda: now[0])
+
+        def request(*args, **kwargs):
+            now[0] += 5
+            raise requests.exceptions.ReadTimeout("slow")
+
+        with mock.patch.object(self.client._session, 'request',
+                               side_effect=request) as sent:
+            with self.assertRaises(ISPConfigBulkError) as err:
+                self.client.set_txt_records([(DOMAIN, self.record_content)],
+                                            deadline=deadline)
+
+        error = err.exception.failures[(DOMAIN, self.record_content)]
+        self.assertIsInstance(error, DeadlineExceededError)
+        self.assertEqual(1, sent.call_count)
+        self.assertFalse(is_not_applied(error))
+
+    @responses.activate
+    def test_failover_to_other_endpoint(self):
+        metrics = Metrics()
+        client = ISPConfigClient(f"{TEST_ENDPOINT}, http://other/",
+                                 TEST_TOKEN, metrics=metrics,
+                                 probe_interval=None)
+        self._add_response(503)
+        responses.add(
+            responses.POST, "http://other/ddns/update.php", body="OK"
+        )
+        client.set_txt_record(DOMAIN, self.record_content)
+        client.set_txt_record(DOMAIN, self.record_content)
+
+        self.assertEqual(
+            [TEST_ENDPOINT, "http://other", "http://other"],
+            [call.request.url.split("/ddns")[0] for call in responses.calls]
+        )
+        self.sleep.assert_called_once_with(0.0)
+        self.assertEqual(
+            [(TEST_ENDPOINT, "503"), ("http://other", "200")],
+            [(r["endpoint"], r["status"])
+             for r in metrics.snapshot()["requests"]]
+        )
+
+    @responses.activate
+    def test_circuit_breaker_per_endpoint(self):
+        breakers = {}
+        client = ISPConfigClient(f"{TEST_ENDPOINT}, http://other",
+                                 TEST_TOKEN, circuit_breakers=breakers,
+                                 probe_interval=None)
+        breakers[TEST_ENDPOINT].failure_threshold = 1
+        self._add_response(503)
+        responses.add(
+            responses.POST, "http://other/ddns/update.php", body="OK"
+        )
+        client.set_txt_record(DOMAIN, self.record_content)
+        # the probes find the first endpoint up again, but its circuit is
+        # still open
+        client._selector.record_success(TEST_ENDPOINT, 0.0)
+        client.set_txt_record(DOMAIN, self.record_content)
+
+        self.assertEqual(
+            [TEST_ENDPOINT, "http://other", "http://other"],
+            [call.request.url.split("/ddns")[0] for call in responses.calls]
+        )
+        self.assertEqual(CircuitBreaker.OPEN, breakers[TEST_ENDPOINT].state)
+        self.assertEqual(CircuitBreaker.CLOSED, breakers["http://other"].state)
+
+    @responses.activate
+    def test_limiter_per_endpoint(self):
+        limiters = {}
+        client = ISPConfigClient(f"{TEST_ENDPOINT}, http://other",
+                                 TEST_TOKEN, limiters=limiters,
+                                 probe_interval=None)
+        limit = limiters[TEST_ENDPOINT].limit
+        self._add_response(503)
+        responses.add(
+            responses.POST, "http://other/ddns/update.php", body="OK"
+        )
+        client.set_txt_record(DOMAIN, self.record_content)
+
+        # the failure of the first endpoint does not cut the limit of the
+        # endpoint the request failed over to
+        self.assertLess(limiters[TEST_ENDPOINT].limit, limit)
+        self.assertGreater(limiters["http://other"].limit, limit)
+
+    @responses.activate
+    def test_probe(self):
+        client = ISPConfigClient(f"{TEST_ENDPOINT},http://other",
+                                 TEST_TOKEN, probe_interval=None)
+        responses.add(responses.HEAD, f"{TEST_ENDPOINT}/ddns/update.php",
+                      status=400)
+        responses.add(responses.HEAD, "http://other/ddns/update.php",
+                      status=502)
+
+        self.assertTrue(client._selector.probe(TEST_ENDPOINT))
+        self.assertFalse(client._selector.probe("http://other"))
+        client.close()
+
+    @responses.activate
+    def test_check_token(self):
+        responses.add(responses.HEAD, f"{TEST_ENDPOINT}/ddns/update.php",
+                      status=400)
+        self.client.check_token()
+
+        responses.replace(responses.HEAD,
+                          f"{TEST_ENDPOINT}/ddns/update.php", status=401)
+        with self.assertRaises(TokenRejectedError):
+            self.client.check_token()
+
+    def test_group_records(self):
+        self.assertEqual(
+            {"a": ["1", "2"], "b": ["1"]},
+            group_records([("a", "1"), ("b", "1"), ("a", "2"), ("a", "1"),
+                           ("b", "1")])
+        )
+
+    @responses.activate
+    def test_set_txt_records_coalesces_duplicates(self):
+        responses.add(responses.POST, f"{TEST_ENDPOINT}/ddns/update.php",
+                      body='OK')
+        records = [(f"_acme-challenge.{DOMAIN}", "v1"),
+                   (f"_acme-challenge.{DOMAIN}", "v2"),
+                   (f"_acme-challenge.{DOMAIN}", "v1"),
+                   (f"_acme-challenge.www.{DOMAIN}", "v3"),
+                   (f"_acme-challenge.www.{DOMAIN}", "v3")]
+        self.client.set_txt_records(records, max_workers=4)
+
+        sent = sorted(
+            (call.request.params['record'], call.request.params['data'])
+            for call in responses.calls
+        )
+        self.assertEqual(sorted(set(records)), sent)
+
+    @responses.activate
+    def test_del_txt_records(self):
+        responses.add(responses.DELETE, f"{TEST_ENDPOINT}/ddns/update.php",
+                      body='OK')
+        self.client.del_txt_records([(DOMAIN, "v1"), ("a." + DOMAIN, "v2")])
+
+        self.assertEqual(
+            {"delete"},
+            {call.request.params['action'] for call in responses.calls}
+        )
+        self.assertEqual(2, len(responses.calls))
+
+    def test_txt_records_empty(self):
+        with mock.patch.object(self.client, '_send') as send:
+            self.client.set_txt_records([])
+        send.assert_not_called()
+
+    @responses.activate
+    def test_set_txt_records_reports_all_failures(self):
+        responses.add(responses.POST, f"{TEST_ENDPOINT}/ddns/update.php",
+                      match=[responses.matchers.query_param_matcher(
+                          {"action": "add", "type": "TXT",
+                           "record": "b." + DOMAIN, "data": "v"})],
+                      status=401)
+        responses.add(responses.POST, f"{TEST_ENDPOINT}/ddns/update.php",
+                      body='OK')
+        with self.assertRaises(ISPConfigBulkError) as err:
+            self.client.set_txt_records([
+                ("a." + DOMAIN, "v"), ("b." + DOMAIN, "v"),
+                ("c." + DOMAIN, "v"), ("c." + DOMAIN, "a" * 256)
+            ])
+
+        self.assertEqual("add", err.exception.action)
+        self.assertEqual(
+            {("b." + DOMAIN, "v"), ("c." + DOMAIN, "a" * 256)},
+            set(err.exception.failures)
+        )
+        self.assertIsInstance(err.exception.failures[("b." + DOMAIN, "v")],
+                              requests.exceptions.HTTPError)
+        self.assertTrue(err.exception.args[0].startswith(
+            "Failed to add 2 TXT record(s): "
+        ))
+        self.assertEqual(3, len(responses.calls))
+
     def test_set_txt_record_too_big(self):
         with self.assertRaises(ISPConfigClientError) as err:
             self.client.set_txt_record(DOMAIN, 'a' * 256)
@@ -120,5 +592,32 @@ class ISPConfigClientTest(unittest.TestCase):
         self.client.del_txt_record(DOMAIN, self.record_content)
 
 
+class IsNotAppliedTest(unittest.TestCase):
+
+    def _http_error(self, status):
+        response = requests.Response()
+        response.status_code = status
+        return requests.exceptions.HTTPError(response=response)
+
+    def test_not_sent(self):
+        self.assertTrue(is_not_applied(CircuitOpenError("open")))
+        self.assertTrue(is_not_applied(ISPConfigClientError("too long")))
+
+    def test_attempted(self):
+        error = DeadlineExceededError("expired")
+        error.attempted = True
+        self.assertFalse(is_not_applied(error))
+
+    def test_status(self):
+        self.assertTrue(is_not_applied(self._http_error(403)))
+        self.assertFalse(is_not_applied(self._http_error(502)))
+        self.assertFalse(is_not_applied(requests.exceptions.HTTPError()))
+
+    def test_connection_error(self):
+        self.assertFalse(is_not_applied(
+            requests.exceptions.ConnectionError("reset")
+        ))
+
+
 if __name__ == "__main__":
     unittest.main()  # pragma: no cover
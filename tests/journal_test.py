@@ -0,0 +1,240 @@
+"""Tests for certbot_dns_ispconfig_ddns.journal."""
+import json
+import unittest
+
+import mock
+from certbot.compat import filesystem, os
+from certbot.plugins.dns_test_common import DOMAIN
+from certbot.tests import util as test_util
+
+from certbot_dns_ispconfig_ddns.ispconfig_client import ISPConfigBulkError
+from certbot_dns_ispconfig_ddns.journal import CleanupJournal, \
+    DeferredCleanup, PropagationHistory, RecordStateCache
+
+TEST_ENDPOINT = "http://endpoint"
+RECORD = ("_acme-challenge." + DOMAIN, "foo")
+
+
+class CleanupJournalTest(test_util.TempDirTestCase):
+
+    def setUp(self):
+        super(CleanupJournalTest, self).setUp()
+        self.path = os.path.join(self.tempdir, "sub", "journal.json")
+        self.journal = CleanupJournal(self.path)
+
+    def test_pending_without_file(self):
+        self.assertEqual([], self.journal.pending())
+
+    def test_add_and_remove(self):
+        self.journal.add(TEST_ENDPOINT, [RECORD, RECORD, ("a", "b")])
+        self.journal.add("http://other", [RECORD])
+
+        self.assertEqual(
+            [(TEST_ENDPOINT, *RECORD), (TEST_ENDPOINT, "a", "b")],
+            self.journal.pending(TEST_ENDPOINT)
+        )
+        self.assertEqual(3, len(self.journal.pending()))
+
+        self.journal.remove(TEST_ENDPOINT, [RECORD])
+        self.assertEqual(
+            [(TEST_ENDPOINT, "a", "b"), ("http://other", *RECORD)],
+            self.journal.pending()
+        )
+
+    def test_persisted(self):
+        self.journal.add(TEST_ENDPOINT, [RECORD])
+
+        self.assertEqual(
+            [(TEST_ENDPOINT, *RECORD)], CleanupJournal(self.path).pending()
+        )
+        with open(self.path) as journal_file:
+            self.assertEqual(1, len(json.load(journal_file)))
+
+    def test_corrupt_file(self):
+        filesystem.makedirs(os.path.dirname(self.path))
+        with open(self.path, "w") as journal_file:
+            journal_file.write("[{")
+        self.assertEqual([], self.journal.pending())
+
+    def test_failed_write_keeps_journal(self):
+        self.journal.add(TEST_ENDPOINT, [RECORD])
+        with mock.patch('json.dump', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                self.journal.add(TEST_ENDPOINT, [("a", "b")])
+
+        self.assertEqual([(TEST_ENDPOINT, *RECORD)], self.journal.pending())
+        self.assertEqual(
+            ["journal.json", "journal.json.lock"],
+            sorted(os.listdir(os.path.dirname(self.path)))
+        )
+
+    def test_leftovers(self):
+        now = [10000.0]
+        journal = CleanupJournal(self.path, clock=lambda: now[0])
+        journal.add(TEST_ENDPOINT, [RECORD])
+        now[0] += 60
+        journal.add(TEST_ENDPOINT, [("a", "b")])
+        self.assertEqual([], journal.leftovers(min_age=600))
+
+        now[0] += 570
+        self.assertEqual([(TEST_ENDPOINT, *RECORD, 630.0)],
+                         journal.leftovers(min_age=600))
+
+        # taken over by a new run
+        journal.add(TEST_ENDPOINT, [RECORD])
+        self.assertEqual([], journal.leftovers(min_age=600))
+
+    @mock.patch("certbot_dns_ispconfig_ddns.journal.os.kill")
+    def test_leftovers_of_dead_process(self, kill):
+        self.journal.add(TEST_ENDPOINT, [RECORD])
+        with open(self.path) as journal_file:
+            entries = json.load(journal_file)
+        entries[0]["pid"] = 99999
+        with open(self.path, "w") as journal_file:
+            json.dump(entries, journal_file)
+
+        kill.side_effect = PermissionError
+        self.assertEqual([], self.journal.leftovers())
+        kill.side_effect = ProcessLookupError
+        self.assertEqual([(TEST_ENDPOINT, *RECORD)],
+                         [entry[:3] for entry in self.journal.leftovers()])
+        kill.assert_called_with(99999, 0)
+
+
+class RecordStateCacheTest(test_util.TempDirTestCase):
+
+    def setUp(self):
+        super(RecordStateCacheTest, self).setUp()
+        self.now = 1000.0
+        self.path = os.path.join(self.tempdir, "state.json")
+        self.cache = RecordStateCache(self.path, ttl=60,
+                                      clock=lambda: self.now)
+
+    def test_known(self):
+        self.cache.mark(TEST_ENDPOINT, [RECORD], RecordStateCache.PRESENT)
+        self.cache.mark(TEST_ENDPOINT, [("a", "b")], RecordStateCache.ABSENT)
+        self.cache.mark("http://other", [("c", "d")],
+                        RecordStateCache.PRESENT)
+
+        self.assertEqual(
+            {RECORD: "present", ("a", "b"): "absent"},
+            self.cache.known(TEST_ENDPOINT, [RECORD, ("a", "b"), ("c", "d")])
+        )
+
+    def test_mark_replaces_state(self):
+        self.cache.mark(TEST_ENDPOINT, [RECORD], RecordStateCache.PRESENT)
+        self.cache.mark(TEST_ENDPOINT, [RECORD], RecordStateCache.ABSENT)
+
+        self.assertEqual({RECORD: "absent"},
+                         self.cache.known(TEST_ENDPOINT, [RECORD]))
+        with open(self.path) as state_file:
+            self.assertEqual(1, len(json.load(state_file)))
+
+    def test_expiry(self):
+        self.cache.mark(TEST_ENDPOINT, [RECORD], RecordStateCache.PRESENT)
+        self.now += 60
+
+        self.assertEqual({}, self.cache.known(TEST_ENDPOINT, [RECORD]))
+        self.cache.mark(TEST_ENDPOINT, [("a", "b")], RecordStateCache.ABSENT)
+        with open(self.path) as state_file:
+            self.assertEqual(["a"],
+                             [e["record"] for e in json.load(state_file)])
+
+    def test_mark_nothing(self):
+        self.cache.mark(TEST_ENDPOINT, [], RecordStateCache.PRESENT)
+        self.assertFalse(os.path.exists(self.path))
+
+
+class PropagationHistoryTest(test_util.TempDirTestCase):
+
+    def setUp(self):
+        super(PropagationHistoryTest, self).setUp()
+        self.path = os.path.join(self.tempdir, "history.json")
+        self.history = PropagationHistory(self.path, max_samples=5,
+                                          min_samples=2, percent=80)
+
+    def test_estimate_needs_min_samples(self):
+        self.history.record({DOMAIN: 10.0, "other.org": 3.0})
+        self.assertEqual({}, self.history.estimate([DOMAIN, "other.org"]))
+
+        self.history.record({DOMAIN: 4.0})
+        self.assertEqual({DOMAIN: 10.0},
+                         self.history.estimate([DOMAIN, "other.org"]))
+
+    def test_keeps_newest_samples(self):
+        for seconds in (60, 50, 5, 4, 6, 3, 2):
+            self.history.record({DOMAIN: seconds})
+
+        self.assertEqual({DOMAIN: 5}, self.history.estimate([DOMAIN]))
+        with open(self.path) as history_file:
+            self.assertEqual([{"zone": DOMAIN, "samples": [5, 4, 6, 3, 2]}],
+                             json.load(history_file))
+
+    def test_reset(self):
+        self.history.record({DOMAIN: 1.0, "other.org": 2.0})
+        self.history.record({DOMAIN: 1.0, "other.org": 2.0})
+        self.history.reset([DOMAIN])
+
+        self.assertEqual({"other.org": 2.0},
+                         self.history.estimate([DOMAIN, "other.org"]))
+
+    def test_record_nothing(self):
+        self.history.record({})
+        self.assertFalse(os.path.exists(self.path))
+
+
+class DeferredCleanupTest(test_util.TempDirTestCase):
+
+    def setUp(self):
+        super(DeferredCleanupTest, self).setUp()
+        self.journal = CleanupJournal(
+            os.path.join(self.tempdir, "journal.json")
+        )
+        self.journal.add(TEST_ENDPOINT, [RECORD, ("a", "b")])
+        self.cleanup = DeferredCleanup(self.journal, max_workers=2)
+        self.client = mock.Mock()
+
+    def test_submit(self):
+        self.cleanup.submit(self.client, TEST_ENDPOINT, [RECORD]).result()
+
+        self.client.del_txt_records.assert_called_once_with(
+            [RECORD], max_workers=2
+        )
+        self.assertEqual([(TEST_ENDPOINT, "a", "b")], self.journal.pending())
+
+    def test_submit_marks_state(self):
+        state = RecordStateCache(os.path.join(self.tempdir, "state.json"))
+        cleanup = DeferredCleanup(self.journal, max_workers=2, state=state)
+        cleanup.submit(self.client, TEST_ENDPOINT, [RECORD]).result()
+
+        self.assertEqual({RECORD: "absent"},
+                         state.known(TEST_ENDPOINT, [RECORD]))
+
+    def test_submit_nothing(self):
+        self.cleanup.submit(self.client, TEST_ENDPOINT, []).result()
+
+        self.client.del_txt_records.assert_not_called()
+
+    def test_submit_partial_failure(self):
+        self.client.del_txt_records.side_effect = ISPConfigBulkError(
+            "delete", {RECORD: KeyError('foo')}
+        )
+        self.cleanup.submit(
+            self.client, TEST_ENDPOINT, [RECORD, ("a", "b")]
+        ).result()
+
+        self.assertEqual([(TEST_ENDPOINT, *RECORD)], self.journal.pending())
+
+    def test_close(self):
+        self.cleanup.submit(self.client, TEST_ENDPOINT, [RECORD])
+        self.cleanup.close([self.client])
+        self.cleanup._executor.shutdown(wait=True)
+
+        self.assertEqual(
+            ['del_txt_records', 'close'],
+            [call[0] for call in self.client.method_calls]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,90 @@
+"""Tests for certbot_dns_ispconfig_ddns.metrics."""
+import json
+import unittest
+
+import mock
+from certbot.compat import os
+from certbot.tests import util as test_util
+
+from certbot_dns_ispconfig_ddns.metrics import Metrics
+
+TEST_ENDPOINT = "http://endpoint"
+
+
+class MetricsTest(test_util.TempDirTestCase):
+
+    def setUp(self):
+        super(MetricsTest, self).setUp()
+        self.metrics = Metrics()
+        for seconds in (0.02, 0.2, 0.3, 4.0):
+            self.metrics.observe_request(TEST_ENDPOINT, "add", "200", seconds)
+        self.metrics.observe_request(TEST_ENDPOINT, "delete", "503", 0.5)
+        self.metrics.observe_retry(TEST_ENDPOINT, "delete", 1.5)
+        self.metrics.observe_phase("propagation", 2.0)
+        self.metrics.observe_phase("propagation", 1.0)
+
+    def test_snapshot(self):
+        snapshot = self.metrics.snapshot()
+
+        self.assertEqual(
+            [("add", "200", 4), ("delete", "503", 1)],
+            [(r["action"], r["status"], r["count"])
+             for r in snapshot["requests"]]
+        )
+        add = snapshot["request_duration_seconds"][0]
+        self.assertEqual((4, 0.2, 4.0, 4.0),
+                         (add["count"], add["p50"], add["p95"], add["max"]))
+        self.assertEqual(
+            [{"endpoint": TEST_ENDPOINT, "action": "delete", "count": 1,
+              "wait_seconds": 1.5}],
+            snapshot["retries"]
+        )
+        self.assertEqual({"propagation": 3.0},
+                         snapshot["phase_duration_seconds"])
+
+    def test_to_prometheus(self):
+        text = self.metrics.to_prometheus()
+
+        self.assertIn("# TYPE ispconfig_ddns_request_duration_seconds "
+                      "histogram\n", text)
+        self.assertIn('ispconfig_ddns_requests_total{endpoint='
+                      '"http://endpoint",action="add",status="200"} 4\n', text)
+        self.assertIn('ispconfig_ddns_request_duration_seconds_bucket{'
+                      'endpoint="http://endpoint",action="add",le="0.25"} 2\n',
+                      text)
+        self.assertIn('ispconfig_ddns_request_duration_seconds_bucket{'
+                      'endpoint="http://endpoint",action="add",le="+Inf"} 4\n',
+                      text)
+        self.assertIn('ispconfig_ddns_phase_duration_seconds{'
+                      'phase="propagation"} 3.0\n', text)
+
+    def test_label_escaping(self):
+        self.metrics.observe_phase('a"b\\c\nd', 1.0)
+        self.assertIn('{phase="a\\"b\\\\c\\nd"}', self.metrics.to_prometheus())
+
+    def test_write_json(self):
+        path = os.path.join(self.tempdir, "sub", "metrics.json")
+        self.metrics.write(path)
+
+        with open(path) as metrics_file:
+            self.assertEqual(2, len(json.load(metrics_file)["requests"]))
+
+    def test_write_prometheus(self):
+        path = os.path.join(self.tempdir, "metrics.prom")
+        self.metrics.write(path)
+
+        with open(path) as metrics_file:
+            self.assertTrue(metrics_file.read().startswith("# HELP"))
+
+    def test_failed_write_keeps_file(self):
+        path = os.path.join(self.tempdir, "metrics.prom")
+        self.metrics.write(path)
+        with mock.patch('os.replace', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                self.metrics.write(path)
+
+        self.assertEqual(["metrics.prom"], os.listdir(self.tempdir))
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
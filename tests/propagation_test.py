@@ -0,0 +1,159 @@
+"""Tests for certbot_dns_ispconfig_ddns.propagation."""
+import socketserver
+import threading
+import time
+import unittest
+
+import dns.message
+import dns.name
+import dns.rdatatype
+import dns.rrset
+import mock
+from certbot.plugins.dns_test_common import DOMAIN
+
+from certbot_dns_ispconfig_ddns.propagation import PropagationChecker
+
+VALIDATION_NAME = "_acme-challenge." + DOMAIN
+
+
+class StubDNSServer(socketserver.ThreadingUDPServer):
+    """
+    Minimal authoritative DNS server answering TXT queries from a dict.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super(StubDNSServer, self).__init__(('127.0.0.1', 0), _StubHandler)
+        self.records = {}
+        self.queries = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+class _StubHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        data, sock = self.request
+        query = dns.message.from_wire(data)
+        self.server.queries += 1
+        response = dns.message.make_response(query)
+        question = query.question[0]
+        values = self.server.records.get(question.name.to_text(True), [])
+        if question.rdtype == dns.rdatatype.TXT and values:
+            response.answer.append(dns.rrset.from_text_list(
+                question.name, 60, 'IN', 'TXT',
+                [f'"{value}"' for value in values]
+            ))
+        sock.sendto(response.to_wire(), self.client_address)
+
+
+class PropagationCheckerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubDNSServer()
+        thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={"poll_interval": 0.01}
+        )
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.checker = PropagationChecker(
+            nameservers=['127.0.0.1'],
+            port=self.server.port,
+            query_timeout=0.5,
+            poll_interval=0.05,
+        )
+
+    def test_query_txt(self):
+        self.server.records[VALIDATION_NAME] = ['foo', 'bar']
+        self.assertEqual(
+            {'foo', 'bar'},
+            self.checker.query_txt('127.0.0.1', VALIDATION_NAME)
+        )
+
+    def test_query_txt_missing_record(self):
+        self.assertEqual(
+            set(), self.checker.query_txt('127.0.0.1', VALIDATION_NAME)
+        )
+
+    def test_query_txt_error(self):
+        with mock.patch('dns.query.udp', side_effect=OSError('refused')):
+            self.assertEqual(
+                set(), self.checker.query_txt('127.0.0.1', VALIDATION_NAME)
+            )
+
+    def test_query_txt_truncated_falls_back_to_tcp(self):
+        truncated = dns.message.make_response(
+            dns.message.make_query(VALIDATION_NAME, dns.rdatatype.TXT)
+        )
+        truncated.flags |= dns.flags.TC
+        full = dns.message.make_response(
+            dns.message.make_query(VALIDATION_NAME, dns.rdatatype.TXT)
+        )
+        full.answer.append(dns.rrset.from_text_list(
+            VALIDATION_NAME, 60, 'IN', 'TXT', ['"foo"']
+        ))
+        with mock.patch('dns.query.udp', return_value=truncated), \
+                mock.patch('dns.query.tcp', return_value=full) as tcp:
+            self.assertEqual(
+                {'foo'}, self.checker.query_txt('127.0.0.1', VALIDATION_NAME)
+            )
+        tcp.assert_called_once()
+
+    def test_wait_for_already_propagated(self):
+        self.server.records[VALIDATION_NAME] = ['foo', 'bar']
+        started = time.monotonic()
+        self.assertTrue(self.checker.wait_for(
+            [(VALIDATION_NAME, 'foo'), (VALIDATION_NAME, 'bar')], 5
+        ))
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(1, self.server.queries)
+
+    def test_wait_for_delayed_propagation(self):
+        timer = threading.Timer(
+            0.2, self.server.records.__setitem__, (VALIDATION_NAME, ['foo'])
+        )
+        timer.start()
+        self.addCleanup(timer.cancel)
+        started = time.monotonic()
+        times = {}
+        self.assertTrue(self.checker.wait_for([(VALIDATION_NAME, 'foo')], 5,
+                                              times=times))
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertGreater(self.server.queries, 1)
+        self.assertTrue(0.2 <= times[VALIDATION_NAME] < 2)
+
+    def test_wait_for_partial_propagation_times_out(self):
+        self.server.records[VALIDATION_NAME] = ['foo']
+        started = time.monotonic()
+        times = {}
+        self.assertFalse(self.checker.wait_for(
+            [(VALIDATION_NAME, 'foo'), (VALIDATION_NAME, 'bar')], 0.3,
+            times=times
+        ))
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+        self.assertEqual({}, times)
+
+    def test_nameservers_for_authoritative_lookup(self):
+        checker = PropagationChecker()
+        ns = mock.Mock(target=dns.name.from_text('ns1.' + DOMAIN))
+
+        def resolve(name, rdtype):
+            if rdtype == dns.rdatatype.NS:
+                return [ns]
+            if rdtype == dns.rdatatype.A:
+                return [mock.Mock(to_text=mock.Mock(return_value='192.0.2.1'))]
+            raise dns.resolver.NoAnswer()
+
+        with mock.patch('dns.resolver.zone_for_name',
+                        return_value=dns.name.from_text(DOMAIN)), \
+                mock.patch('dns.resolver.resolve', side_effect=resolve):
+            self.assertEqual(
+                ['192.0.2.1'], checker.nameservers_for(VALIDATION_NAME)
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,206 @@
+"""Tests for certbot_dns_ispconfig_ddns.purge."""
+import io
+import time
+import unittest
+
+import mock
+from certbot.compat import os
+from certbot.plugins.dns_test_common import DOMAIN
+from certbot.tests import util as test_util
+
+from certbot_dns_ispconfig_ddns.journal import CleanupJournal
+from certbot_dns_ispconfig_ddns.purge import main, plan, purge, read_records
+from certbot_dns_ispconfig_ddns.zones import Route, ZoneIndex
+
+TEST_ENDPOINT = "http://endpoint"
+TEST_TOKEN = "token123"
+ROUTE = Route(TEST_ENDPOINT, TEST_TOKEN)
+OTHER_ROUTE = Route("http://other", "other-token")
+FQDN = "_acme-challenge." + DOMAIN
+
+
+class ReadRecordsTest(unittest.TestCase):
+
+    def test_lines(self):
+        self.assertEqual(
+            [(None, FQDN, "foo"), (None, "_acme-challenge.a.org", "b a r")],
+            read_records(["# stale records", "", f"{FQDN} foo\n",
+                          '_acme-challenge.a.org  "b a r"'])
+        )
+
+    def test_missing_value(self):
+        with self.assertRaises(ValueError):
+            read_records([FQDN])
+
+
+class PlanTest(unittest.TestCase):
+
+    def test_routes(self):
+        zones = ZoneIndex()
+        zones.add("example.org", OTHER_ROUTE)
+        deletions, unroutable = plan([
+            (None, FQDN, "a"),
+            (None, "_acme-challenge.example.org", "b"),
+            ("http://gone", FQDN, "c"),
+        ], zones, ROUTE)
+
+        self.assertEqual(
+            [(ROUTE, FQDN, "a"),
+             (OTHER_ROUTE, "_acme-challenge.example.org", "b")],
+            deletions
+        )
+        self.assertEqual([("http://gone", FQDN, "c")], unroutable)
+
+    def test_no_credentials(self):
+        deletions, unroutable = plan([(None, FQDN, "a")], ZoneIndex(), None)
+
+        self.assertEqual([], deletions)
+        self.assertEqual([(None, FQDN, "a")], unroutable)
+
+
+class PurgeTest(unittest.TestCase):
+
+    @mock.patch("certbot_dns_ispconfig_ddns.retry.time.sleep")
+    def test_failures(self, sleep):
+        clients = {ROUTE: mock.Mock(), OTHER_ROUTE: mock.Mock()}
+        clients[OTHER_ROUTE].del_txt_record.side_effect = KeyError("foo")
+        deletions = [(ROUTE, FQDN, "a"), (ROUTE, FQDN, "b"),
+                     (OTHER_ROUTE, FQDN, "c")]
+
+        failures = purge(deletions, clients.__getitem__, workers=2, rate=0)
+
+        self.assertEqual([(OTHER_ROUTE, FQDN, "c")], list(failures))
+        self.assertEqual(
+            [mock.call(FQDN, "a"), mock.call(FQDN, "b")],
+            sorted(clients[ROUTE].del_txt_record.mock_calls)
+        )
+        sleep.assert_not_called()
+
+
+class MainTest(test_util.TempDirTestCase):
+
+    def setUp(self):
+        super(MainTest, self).setUp()
+        patcher = mock.patch(
+            "certbot_dns_ispconfig_ddns.purge.ISPConfigClient"
+        )
+        self.addCleanup(patcher.stop)
+        self.mock_client = patcher.start()
+        self.journal_path = os.path.join(self.tempdir, "journal.json")
+        self.journal = CleanupJournal(self.journal_path,
+                                      clock=lambda: time.time() - 7200)
+        self.journal.add(TEST_ENDPOINT, [(FQDN, "a"), (FQDN, "b")])
+        self.journal.add("http://gone", [(FQDN, "c")])
+        # of a run that may still wait for its validation
+        CleanupJournal(self.journal_path).add(TEST_ENDPOINT, [(FQDN, "d")])
+        self.credentials = os.path.join(self.tempdir, "credentials.ini")
+        with open(self.credentials, "w") as credentials:
+            credentials.write(
+                f"dns_ispconfig_ddns_endpoint={TEST_ENDPOINT}\n"
+                f"dns_ispconfig_ddns_token={TEST_TOKEN}\n"
+            )
+
+    def _main(self, argv):
+        with mock.patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            returncode = main(argv)
+        return returncode, stdout.getvalue()
+
+    def test_dry_run(self):
+        returncode, output = self._main([
+            "--journal", self.journal_path, "--credentials", self.credentials,
+            "--dry-run"
+        ])
+
+        self.assertEqual(0, returncode)
+        self.mock_client.assert_not_called()
+        self.assertRegex(output, f"would delete  {FQDN} a "
+                                 rf"\({TEST_ENDPOINT}, journaled 720[01]s "
+                                 r"ago\)")
+        self.assertIn(f"skipped  {FQDN} c: no credentials for http://gone",
+                      output)
+        self.assertNotIn(f"{FQDN} d", output)
+        self.assertIn("2 record(s) would be deleted, 1 skipped", output)
+        self.assertEqual(4, len(self.journal.pending()))
+
+    def test_min_age(self):
+        returncode, output = self._main([
+            "--journal", self.journal_path, "--credentials", self.credentials,
+            "--dry-run", "--min-age", "0"
+        ])
+
+        self.assertRegex(output, f"would delete  {FQDN} d "
+                                 rf"\({TEST_ENDPOINT}, journaled [01]s "
+                                 r"ago\)")
+        self.assertIn("3 record(s) would be deleted, 1 skipped", output)
+
+    def test_journal(self):
+        client = self.mock_client.return_value
+        client.del_txt_record.side_effect = \
+            lambda fqdn, content: content == "b" and 1 / 0
+        returncode, output = self._main([
+            "--journal", self.journal_path, "--credentials", self.credentials,
+            "--rate", "0"
+        ])
+
+        self.assertEqual(1, returncode)
+        self.mock_client.assert_called_once_with(
+            endpoint=TEST_ENDPOINT, token=TEST_TOKEN, pool_maxsize=mock.ANY
+        )
+        client.close.assert_called_once_with()
+        self.assertIn("1 record(s) deleted, 1 failed, 1 skipped", output)
+        self.assertEqual(
+            [(TEST_ENDPOINT, FQDN, "b"), ("http://gone", FQDN, "c"),
+             (TEST_ENDPOINT, FQDN, "d")],
+            self.journal.pending()
+        )
+
+    def test_records_file(self):
+        records = os.path.join(self.tempdir, "records.txt")
+        with open(records, "w") as records_file:
+            records_file.write(f"{FQDN} x\n")
+        returncode, output = self._main([
+            "--records", records, "--endpoint", TEST_ENDPOINT,
+            "--token", TEST_TOKEN
+        ])
+
+        self.assertEqual(0, returncode)
+        self.mock_client.return_value.del_txt_record.assert_called_once_with(
+            FQDN, "x"
+        )
+        self.assertIn(f"deleted  {FQDN} x", output)
+
+    @mock.patch("sys.stderr", new_callable=io.StringIO)
+    def test_invalid_records_file(self, stderr):
+        records = os.path.join(self.tempdir, "records.txt")
+        with open(records, "w") as records_file:
+            records_file.write(f"{FQDN}\n")
+        with self.assertRaises(SystemExit):
+            main(["--records", records])
+        self.assertIn("Line 1", stderr.getvalue())
+
+    @mock.patch("sys.stderr", new_callable=io.StringIO)
+    def test_missing_credentials_file(self, stderr):
+        with self.assertRaises(SystemExit):
+            main(["--journal", self.journal_path, "--credentials",
+                  os.path.join(self.tempdir, "missing.ini")])
+        self.assertIn("missing.ini", stderr.getvalue())
+        self.mock_client.assert_not_called()
+
+    @mock.patch("sys.stderr", new_callable=io.StringIO)
+    def test_invalid_credentials_section(self, stderr):
+        with open(self.credentials, "a") as credentials:
+            credentials.write("[example.org]\nendpoint = http://other\n")
+        with self.assertRaises(SystemExit):
+            main(["--journal", self.journal_path, "--credentials",
+                  self.credentials])
+        self.assertIn("[example.org] needs a token", stderr.getvalue())
+        self.mock_client.assert_not_called()
+
+    @mock.patch("sys.stderr", new_callable=io.StringIO)
+    def test_no_input(self, stderr):
+        with self.assertRaises(SystemExit):
+            main(["--dry-run"])
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
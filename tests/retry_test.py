@@ -0,0 +1,242 @@
+"""Tests for certbot_dns_ispconfig_ddns.retry."""
+import email.utils
+import threading
+import time
+import unittest
+
+import mock
+
+from certbot_dns_ispconfig_ddns.retry import AdaptiveLimiter, CircuitBreaker, \
+    Deadline, RateLimiter, RetryPolicy
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def test_is_retryable_status(self):
+        for status in (429, 500, 502, 503, 504):
+            self.assertTrue(RetryPolicy.is_retryable_status(status))
+        for status in (200, 400, 401, 403, 404):
+            self.assertFalse(RetryPolicy.is_retryable_status(status))
+
+    def test_negative_retries(self):
+        self.assertEqual(0, RetryPolicy(retries=-1).retries)
+
+    def test_delay_exponential_backoff(self):
+        policy = RetryPolicy(backoff_factor=0.5, backoff_max=3, jitter=False)
+        self.assertEqual(
+            [0.5, 1, 2, 3, 3], [policy.delay(attempt) for attempt in range(5)]
+        )
+
+    def test_delay_jitter(self):
+        policy = RetryPolicy(backoff_factor=1, backoff_max=30)
+        with mock.patch('random.uniform', return_value=1.5) as uniform:
+            self.assertEqual(1.5, policy.delay(2))
+        uniform.assert_called_once_with(0, 4)
+
+    def test_delay_retry_after_seconds(self):
+        policy = RetryPolicy(backoff_max=10)
+        self.assertEqual(7, policy.delay(0, "7"))
+        self.assertEqual(10, policy.delay(0, "120"))
+
+    def test_delay_retry_after_date(self):
+        policy = RetryPolicy(backoff_max=10)
+        date = email.utils.formatdate(time.time() + 5, usegmt=True)
+        self.assertAlmostEqual(5, policy.delay(0, date), delta=1.5)
+        date = email.utils.formatdate(time.time() - 5, usegmt=True)
+        self.assertEqual(0, policy.delay(0, date))
+
+    def test_delay_invalid_retry_after(self):
+        policy = RetryPolicy(backoff_factor=2, jitter=False)
+        self.assertEqual(2, policy.delay(0, "soon"))
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10,
+                                      clock=lambda: self.now)
+
+    def test_opens_after_consecutive_failures(self):
+        for _ in range(2):
+            self.breaker.record_failure()
+            self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(CircuitBreaker.OPEN, self.breaker.state)
+        self.assertFalse(self.breaker.allow())
+
+    def test_success_resets_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertEqual(CircuitBreaker.CLOSED, self.breaker.state)
+
+    def test_half_open_trial_success(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.now = 10
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(CircuitBreaker.HALF_OPEN, self.breaker.state)
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(CircuitBreaker.CLOSED, self.breaker.state)
+        self.assertTrue(self.breaker.allow())
+
+    def test_half_open_trial_failure(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.now = 10
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(CircuitBreaker.OPEN, self.breaker.state)
+        self.now = 15
+        self.assertFalse(self.breaker.allow())
+
+
+class AdaptiveLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.limiter = AdaptiveLimiter(initial_limit=2, max_limit=8,
+                                       latency_slack=0.0,
+                                       clock=lambda: self.now)
+
+    def _request(self, latency=0.1, failed=False):
+        with self.limiter.slot() as slot:
+            self.now += latency
+            if failed:
+                slot.failure()
+            else:
+                slot.success()
+
+    def test_slow_start_and_ceiling(self):
+        for _ in range(3):
+            self._request()
+        self.assertEqual(5, self.limiter.limit)
+        for _ in range(10):
+            self._request()
+        self.assertEqual(8, self.limiter.limit)
+
+    def test_failure_halves_and_ends_slow_start(self):
+        for _ in range(4):
+            self._request()
+        self._request(failed=True)
+        self.assertEqual(3, self.limiter.limit)
+
+        # additive increase: about one per round trip of `limit` requests
+        for _ in range(4):
+            self._request()
+        self.assertEqual(4, self.limiter.limit)
+
+    def test_one_decrease_per_round_trip(self):
+        for _ in range(6):
+            self._request()
+        slots = [self.limiter.slot() for _ in range(3)]
+        started = [slot.__enter__() for slot in slots]
+        self.now += 1
+        for slot, request_slot in zip(slots, started):
+            request_slot.failure()
+            slot.__exit__(None, None, None)
+
+        self.assertEqual(4, self.limiter.limit)
+
+    def test_latency_increase_signals_overload(self):
+        self._request(latency=0.1)
+        self._request(latency=0.15)
+        self.assertEqual(4, self.limiter.limit)
+        self._request(latency=0.5)
+        self.assertEqual(2, self.limiter.limit)
+
+    def test_min_limit(self):
+        for _ in range(5):
+            self._request(failed=True)
+            self.now += 1
+        self.assertEqual(1, self.limiter.limit)
+
+    def test_limits_requests_in_flight(self):
+        limiter = AdaptiveLimiter(initial_limit=2, max_limit=2)
+        in_flight = []
+        peak = []
+        lock = threading.Lock()
+        release = threading.Event()
+
+        def request():
+            with limiter.slot():
+                with lock:
+                    in_flight.append(1)
+                    peak.append(len(in_flight))
+                release.wait(5)
+                with lock:
+                    in_flight.pop()
+
+        threads = [threading.Thread(target=request) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(2, max(peak))
+
+    def test_slot_timeout(self):
+        limiter = AdaptiveLimiter(initial_limit=1, max_limit=1)
+        with limiter.slot():
+            with self.assertRaises(TimeoutError):
+                with limiter.slot(timeout=0.01):
+                    pass  # pragma: no cover
+
+
+class DeadlineTest(unittest.TestCase):
+
+    def test_remaining(self):
+        now = [10.0]
+        deadline = Deadline(5, clock=lambda: now[0])
+        self.assertEqual(5.0, deadline.remaining())
+        self.assertFalse(deadline.expired())
+
+        now[0] = 17.0
+        self.assertEqual(0.0, deadline.remaining())
+        self.assertTrue(deadline.expired())
+
+    def test_no_deadline(self):
+        deadline = Deadline()
+        self.assertIsNone(deadline.remaining())
+        self.assertFalse(deadline.expired())
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_spaces_requests(self):
+        sleep = mock.Mock()
+        limiter = RateLimiter(4, clock=lambda: 10.0, sleep=sleep)
+        for _ in range(3):
+            limiter.acquire()
+
+        self.assertEqual([mock.call(0.25), mock.call(0.5)],
+                         sleep.mock_calls)
+
+    def test_idle_time_not_saved_up(self):
+        now = [10.0]
+        sleep = mock.Mock()
+        limiter = RateLimiter(1, clock=lambda: now[0], sleep=sleep)
+        limiter.acquire()
+        now[0] = 20.0
+        limiter.acquire()
+        limiter.acquire()
+
+        sleep.assert_called_once_with(1.0)
+
+    def test_no_limit(self):
+        sleep = mock.Mock()
+        limiter = RateLimiter(0, sleep=sleep)
+        limiter.acquire()
+        limiter.acquire()
+
+        sleep.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
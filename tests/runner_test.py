@@ -0,0 +1,206 @@
+"""Tests for certbot_dns_ispconfig_ddns.runner."""
+import io
+import subprocess
+import unittest
+
+import mock
+from certbot.compat import filesystem, os
+from certbot.tests import util as test_util
+
+from certbot_dns_ispconfig_ddns.runner import SHARED_DIRS, Job, JobResult, \
+    build_command, format_summary, has_account, main, parse_jobs, \
+    prepare_config_dir, run_jobs
+
+
+class BuildCommandTest(unittest.TestCase):
+
+    def test_renew(self):
+        command = build_command(Job("example.com"), "/certs", "/tmp/d.sock",
+                                certbot_args=["--dry-run"])
+
+        self.assertEqual(["certbot", "renew", "--cert-name", "example.com"],
+                         command[:4])
+        self.assertEqual(
+            os.path.join("/certs", "example.com"),
+            command[command.index("--config-dir") + 1]
+        )
+        self.assertEqual(
+            "/tmp/d.sock",
+            command[command.index("--dns-ispconfig-ddns-daemon-socket") + 1]
+        )
+        self.assertEqual("--dry-run", command[-1])
+
+    def test_certonly(self):
+        command = build_command(
+            Job("example.com", ("example.com", "*.example.com")),
+            "/certs", "/tmp/d.sock", certbot="/opt/certbot"
+        )
+
+        self.assertEqual(
+            ["/opt/certbot", "certonly", "--cert-name", "example.com",
+             "-d", "example.com", "-d", "*.example.com"],
+            command[:8]
+        )
+        self.assertIn("dns-ispconfig-ddns", command)
+
+
+class PrepareConfigDirTest(test_util.TempDirTestCase):
+
+    def setUp(self):
+        super(PrepareConfigDirTest, self).setUp()
+        self.base = os.path.join(self.tempdir, "letsencrypt")
+        self.config_dir = os.path.join(self.tempdir, "root", "example.com")
+
+    def test_links_shared_dirs(self):
+        prepare_config_dir(self.config_dir, self.base)
+        # a second run keeps the links
+        prepare_config_dir(self.config_dir, self.base)
+
+        for name in SHARED_DIRS:
+            link = os.path.join(self.config_dir, name)
+            self.assertTrue(os.path.islink(link))
+            self.assertEqual(
+                filesystem.realpath(os.path.join(self.base, name)),
+                filesystem.realpath(link)
+            )
+
+    def test_own_dir(self):
+        filesystem.makedirs(os.path.join(self.config_dir, "accounts"))
+        with self.assertRaises(ValueError):
+            prepare_config_dir(self.config_dir, self.base)
+
+    def test_has_account(self):
+        self.assertFalse(has_account(self.base))
+        prepare_config_dir(self.config_dir, self.base)
+        self.assertFalse(has_account(self.base))
+        with open(os.path.join(self.config_dir, "accounts", "regr.json"),
+                  "w") as account:
+            account.write("{}")
+        self.assertTrue(has_account(self.base))
+
+
+class ParseJobsTest(unittest.TestCase):
+
+    def test_lineages_and_domains(self):
+        self.assertEqual(
+            [Job("a.com"),
+             Job("b.com", ("*.b.com", "b.com")),
+             Job("c.com", ("c.com",))],
+            parse_jobs(["a.com"], ["*.b.com, b.com", "c.com,", " "])
+        )
+
+
+class RunJobsTest(unittest.TestCase):
+
+    @mock.patch("certbot_dns_ispconfig_ddns.runner.subprocess.run")
+    def test_results_in_order(self, run):
+        run.side_effect = [
+            subprocess.CompletedProcess([], 0, stdout="renewed"),
+            OSError("no certbot"),
+        ]
+        results = run_jobs([(Job("a"), ["certbot", "a"]),
+                            (Job("b"), ["certbot", "b"])], workers=1)
+
+        self.assertEqual([Job("a"), Job("b")],
+                         [result.job for result in results])
+        self.assertEqual([0, 1], [result.returncode for result in results])
+        self.assertEqual(["renewed", "no certbot"],
+                         [result.output for result in results])
+
+    def test_summary(self):
+        summary = format_summary([
+            JobResult(Job("example.com"), 0, 65.0, ""),
+            JobResult(Job("a.org"), 1, 70.0, ""),
+        ], 71.0)
+
+        lines = summary.splitlines()
+        self.assertEqual("example.com  ok         65.0", lines[1])
+        self.assertEqual("a.org        failed     70.0", lines[2])
+        self.assertEqual(
+            "2 lineage(s), 1 failed, in 71.0 seconds (135.0 one after "
+            "another)", lines[3]
+        )
+
+
+class MainTest(test_util.TempDirTestCase):
+
+    def setUp(self):
+        super(MainTest, self).setUp()
+        self.base = os.path.join(self.tempdir, "letsencrypt")
+        account = os.path.join(self.base, "accounts", "acme", "directory",
+                               "1234")
+        filesystem.makedirs(account)
+        with open(os.path.join(account, "regr.json"), "w") as regr:
+            regr.write("{}")
+        self.config_root = os.path.join(self.tempdir, "root")
+
+    @mock.patch("sys.stdout", new_callable=io.StringIO)
+    @mock.patch("certbot_dns_ispconfig_ddns.runner.run_jobs")
+    def test_shared_daemon(self, run_jobs_mock, stdout):
+        def run(commands, workers):
+            for _, command in commands:
+                socket_path = command[
+                    command.index("--dns-ispconfig-ddns-daemon-socket") + 1
+                ]
+                # the daemon serves while the jobs run
+                self.assertTrue(os.path.exists(socket_path))
+            return [JobResult(job, 0, 1.0, "") for job, _ in commands]
+        run_jobs_mock.side_effect = run
+
+        self.assertEqual(0, main([
+            "a.com", "-d", "b.com,www.b.com", "--config-root",
+            self.config_root, "--base-config-dir", self.base,
+            "--workers", "4", "--", "--dns-ispconfig-ddns-credentials",
+            "/etc/ddns.ini"
+        ]))
+
+        commands = run_jobs_mock.call_args.args[0]
+        self.assertEqual(["a.com", "b.com"],
+                         [job.name for job, _ in commands])
+        self.assertEqual("/etc/ddns.ini", commands[0][1][-1])
+        self.assertEqual(4, run_jobs_mock.call_args.kwargs["workers"])
+        self.assertFalse(os.path.exists(commands[0][1][
+            commands[0][1].index("--dns-ispconfig-ddns-daemon-socket") + 1
+        ]))
+        self.assertIn("2 lineage(s), 0 failed", stdout.getvalue())
+        for name in ("a.com", "b.com"):
+            self.assertTrue(os.path.islink(
+                os.path.join(self.config_root, name, "accounts")
+            ))
+
+    @mock.patch("sys.stderr", new_callable=io.StringIO)
+    @mock.patch("sys.stdout", new_callable=io.StringIO)
+    @mock.patch("certbot_dns_ispconfig_ddns.runner.run_jobs")
+    @mock.patch("certbot_dns_ispconfig_ddns.runner.DDNSDaemon")
+    def test_running_daemon(self, daemon, run_jobs_mock, stdout, stderr):
+        run_jobs_mock.return_value = [
+            JobResult(Job("a.com"), 1, 1.0, "rate limited")
+        ]
+
+        self.assertEqual(1, main(["a.com", "--config-root", self.config_root,
+                                  "--base-config-dir", self.base,
+                                  "--socket", "/run/d.sock"]))
+
+        daemon.assert_not_called()
+        command = run_jobs_mock.call_args.args[0][0][1]
+        self.assertIn("/run/d.sock", command)
+        self.assertIn("rate limited", stderr.getvalue())
+
+    @mock.patch("sys.stderr", new_callable=io.StringIO)
+    def test_no_jobs(self, stderr):
+        with self.assertRaises(SystemExit):
+            main(["--config-root", self.config_root])
+
+    @mock.patch("sys.stderr", new_callable=io.StringIO)
+    @mock.patch("certbot_dns_ispconfig_ddns.runner.run_jobs")
+    def test_no_account(self, run_jobs_mock, stderr):
+        with self.assertRaises(SystemExit):
+            main(["a.com", "--config-root", self.config_root,
+                  "--base-config-dir", os.path.join(self.tempdir, "empty")])
+
+        run_jobs_mock.assert_not_called()
+        self.assertIn("certbot register", stderr.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
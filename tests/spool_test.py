@@ -0,0 +1,221 @@
+"""Tests for certbot_dns_ispconfig_ddns.spool."""
+import fcntl
+import json
+import threading
+import time
+import unittest
+
+import mock
+import requests
+from certbot.compat import os
+from certbot.plugins.dns_test_common import DOMAIN
+from certbot.tests import util as test_util
+
+from certbot_dns_ispconfig_ddns.ispconfig_client import ISPConfigBulkError, \
+    ISPConfigClientError, is_not_applied
+from certbot_dns_ispconfig_ddns.retry import Deadline
+from certbot_dns_ispconfig_ddns.spool import LOCK_FILE_NAME, SpoolClient, \
+    SpoolCoordinator
+from certbot_dns_ispconfig_ddns.zones import Route
+
+ROUTE = Route("http://endpoint", "token123")
+RECORD = ("_acme-challenge." + DOMAIN, "foo")
+OTHER_RECORD = ("_acme-challenge.other." + DOMAIN, "bar")
+
+
+class SpoolCoordinatorTest(test_util.TempDirTestCase):
+
+    def setUp(self):
+        super(SpoolCoordinatorTest, self).setUp()
+        self.directory = os.path.join(self.tempdir, "spool")
+        self.client_factory = mock.Mock()
+        self.client = self.client_factory.return_value
+        self.coordinator = self._coordinator(self.client_factory)
+
+    def _coordinator(self, client_factory, **kwargs):
+        kwargs.setdefault("window", 0)
+        coordinator = SpoolCoordinator(self.directory, client_factory,
+                                       max_workers=3, poll_interval=0.01,
+                                       **kwargs)
+        self.addCleanup(coordinator.close)
+        return coordinator
+
+    def _queue(self, request_id, records, action="add", age=0.0,
+               expires=None):
+        # a request of another process, which crashed or is still waiting
+        with open(os.path.join(self.directory, request_id + ".request"),
+                  "w") as request_file:
+            json.dump({"action": action, "endpoint": ROUTE.endpoint,
+                       "token": ROUTE.token, "records": records,
+                       "created": time.time() - age, "expires": expires},
+                      request_file)
+
+    def _response(self, request_id):
+        with open(os.path.join(self.directory,
+                               request_id + ".response")) as response_file:
+            return json.load(response_file)
+
+    def test_update(self):
+        self.coordinator.update("delete", ROUTE, [RECORD], Deadline(60))
+
+        self.client_factory.assert_called_once_with(ROUTE)
+        self.client.del_txt_records.assert_called_once_with(
+            [RECORD], max_workers=3, deadline=mock.ANY
+        )
+        deadline = self.client.del_txt_records.call_args.kwargs["deadline"]
+        self.assertTrue(59 < deadline.remaining() <= 60)
+        self.assertEqual([LOCK_FILE_NAME], os.listdir(self.directory))
+
+    def test_no_records(self):
+        self.coordinator.update("add", ROUTE, [])
+
+        self.client_factory.assert_not_called()
+
+    def test_concurrent_updates_coalesced(self):
+        other_factory = mock.Mock()
+        other = self._coordinator(other_factory, window=0.3)
+        leader = self._coordinator(self.client_factory, window=0.3)
+        threads = [
+            threading.Thread(target=coordinator.update,
+                             args=("add", ROUTE, [record]))
+            for coordinator, record in ((leader, RECORD),
+                                        (other, OTHER_RECORD))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+
+        calls = self.client.set_txt_records.mock_calls \
+            + other_factory.return_value.set_txt_records.mock_calls
+        self.assertEqual(1, len(calls))
+        self.assertEqual({RECORD, OTHER_RECORD}, set(calls[0].args[0]))
+
+    def test_requests_of_crashed_process_sent(self):
+        self._queue("left", [list(OTHER_RECORD)])
+        self.coordinator.update("add", ROUTE, [RECORD])
+
+        self.client.set_txt_records.assert_called_once_with(
+            mock.ANY, max_workers=3, deadline=mock.ANY
+        )
+        self.assertEqual(
+            {RECORD, OTHER_RECORD},
+            set(self.client.set_txt_records.call_args.args[0])
+        )
+        self.assertEqual({"ok": True}, self._response("left"))
+
+    def test_failures_per_request(self):
+        self._queue("other", [list(OTHER_RECORD)])
+        self.client.set_txt_records.side_effect = ISPConfigBulkError(
+            "add", {RECORD: KeyError("foo")}
+        )
+        with self.assertRaises(ISPConfigBulkError) as err:
+            self.coordinator.update("add", ROUTE, [RECORD])
+
+        self.assertEqual([RECORD], list(err.exception.failures))
+        self.assertEqual({"ok": True}, self._response("other"))
+
+    def test_sent_failure_may_be_applied(self):
+        self._queue("other", [list(OTHER_RECORD)])
+        response = requests.Response()
+        response.status_code = 502
+        error = requests.exceptions.HTTPError(response=response)
+        self.client.set_txt_records.side_effect = ISPConfigBulkError(
+            "add", {RECORD: error, OTHER_RECORD: error}
+        )
+        with self.assertRaises(ISPConfigBulkError) as err:
+            self.coordinator.update("add", ROUTE, [RECORD])
+
+        # the leader's 502 may have come after the record was added, for
+        # every process of the batch
+        self.assertFalse(is_not_applied(err.exception.failures[RECORD]))
+        self.assertEqual(
+            [list(OTHER_RECORD) + [str(error), False]],
+            self._response("other")["failures"]
+        )
+
+    def test_client_failure(self):
+        self.client_factory.side_effect = ISPConfigClientError("down")
+        with self.assertRaises(ISPConfigBulkError) as err:
+            self.coordinator.update("delete", ROUTE, [RECORD])
+
+        self.assertEqual("down", str(err.exception.failures[RECORD]))
+
+    def test_invalid_requests_dropped(self):
+        self._queue("unknown", [list(OTHER_RECORD)], action="nop")
+        with open(os.path.join(self.directory, "broken.request"), "w") as f:
+            f.write("{")
+        self.coordinator.update("add", ROUTE, [RECORD])
+
+        self.assertEqual(
+            [list(OTHER_RECORD) + ["Unknown action: nop", True]],
+            self._response("unknown")["failures"]
+        )
+        self.assertEqual(
+            sorted([LOCK_FILE_NAME, "unknown.response"]),
+            sorted(os.listdir(self.directory))
+        )
+
+    def test_expired_requests_dropped(self):
+        self._queue("old", [list(OTHER_RECORD)], age=301)
+        self._queue("late", [list(OTHER_RECORD)], expires=time.time() - 60)
+        self._queue("recent", [list(OTHER_RECORD)], age=299)
+        self.coordinator.update("add", ROUTE, [RECORD])
+
+        self.assertEqual(
+            {RECORD, OTHER_RECORD},
+            set(self.client.set_txt_records.call_args.args[0])
+        )
+        self.assertEqual(2, len(self.client.set_txt_records.call_args.args[0]))
+        for request_id in ("old", "late"):
+            self.assertEqual(
+                {"ok": False, "error": "Spool request expired",
+                 "failures": []},
+                self._response(request_id)
+            )
+        self.assertEqual({"ok": True}, self._response("recent"))
+
+    def test_timeout_while_other_leads(self):
+        with open(os.path.join(self.directory, LOCK_FILE_NAME), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with self.assertRaises(ISPConfigClientError):
+                self.coordinator.update("add", ROUTE, [RECORD],
+                                        Deadline(0))
+
+        self.client_factory.assert_not_called()
+        self.assertEqual([LOCK_FILE_NAME], os.listdir(self.directory))
+
+    def test_close_closes_clients(self):
+        self.coordinator.update("add", ROUTE, [RECORD])
+        self.coordinator.close()
+
+        self.client.close.assert_called_once_with()
+
+
+class SpoolClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.coordinator = mock.Mock()
+        self.client = SpoolClient(self.coordinator, ROUTE)
+
+    def test_set_txt_record(self):
+        with self.client as client:
+            client.set_txt_record(*RECORD)
+
+        self.coordinator.update.assert_called_once_with(
+            "add", ROUTE, [RECORD], None
+        )
+
+    def test_del_txt_records(self):
+        deadline = Deadline(10)
+        self.client.del_txt_records(iter([RECORD]), max_workers=5,
+                                    deadline=deadline)
+
+        self.coordinator.update.assert_called_once_with(
+            "delete", ROUTE, [RECORD], deadline
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover
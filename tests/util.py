@@ -0,0 +1,26 @@
+"""Helpers shared by the tests and the benchmarks."""
+from acme import messages
+from certbot import achallenges
+from certbot.plugins.dns_test_common import KEY
+from certbot.tests import acme_util
+
+
+def achall(domain: str) -> achallenges.KeyAuthorizationAnnotatedChallenge:
+    """
+    Create a DNS-01 challenge for a domain, on all supported certbot
+    versions.
+
+    :param domain: the domain being validated
+    :return: the annotated challenge
+    """
+    # certbot >= 4 replaced the domain field with an identifier
+    slots = achallenges.KeyAuthorizationAnnotatedChallenge.__slots__
+    if "identifier" in slots:
+        kwargs = {"identifier": messages.Identifier(
+            typ=messages.IDENTIFIER_FQDN, value=domain
+        )}
+    else:  # pragma: no cover
+        kwargs = {"domain": domain}
+    return achallenges.KeyAuthorizationAnnotatedChallenge(
+        challb=acme_util.DNS01, account_key=KEY, **kwargs
+    )
@@ -0,0 +1,99 @@
+"""Tests for certbot_dns_ispconfig_ddns.zones."""
+import unittest
+
+from certbot import errors
+
+from certbot_dns_ispconfig_ddns.zones import Route, ZoneIndex, \
+    load_zone_routes
+
+TEST_ENDPOINT = "http://endpoint"
+
+
+class ZoneIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = ZoneIndex()
+        self.index.add("example.com", "com")
+        self.index.add("sub.example.com.", "sub")
+        self.index.add("Example.ORG", "org")
+
+    def test_len(self):
+        self.assertEqual(3, len(self.index))
+        self.index.add("example.com", "replaced")
+        self.assertEqual(3, len(self.index))
+
+    def test_lookup_longest_suffix(self):
+        self.assertEqual(
+            ("example.com", "com"),
+            self.index.lookup("_acme-challenge.www.example.com")
+        )
+        self.assertEqual(
+            ("sub.example.com", "sub"),
+            self.index.lookup("_acme-challenge.a.sub.example.com")
+        )
+        self.assertEqual(
+            ("sub.example.com", "sub"), self.index.lookup("sub.example.com.")
+        )
+
+    def test_lookup_case_insensitive(self):
+        self.assertEqual(
+            ("example.org", "org"),
+            self.index.lookup("_ACME-challenge.example.org")
+        )
+
+    def test_lookup_no_match(self):
+        self.assertIsNone(self.index.lookup("_acme-challenge.example.net"))
+        self.assertIsNone(self.index.lookup("com"))
+        self.assertIsNone(self.index.lookup("notexample.com"))
+        self.assertIsNone(self.index.lookup(""))
+
+    def test_root_zone(self):
+        self.index.add(".", "root")
+        self.assertEqual(("", "root"), self.index.lookup("example.net"))
+        self.assertEqual(("example.com", "com"),
+                         self.index.lookup("www.example.com"))
+
+    def test_many_zones(self):
+        index = ZoneIndex()
+        for i in range(5000):
+            index.add(f"zone{i}.example", i)
+        self.assertEqual(
+            ("zone4321.example", 4321),
+            index.lookup("_acme-challenge.www.zone4321.example")
+        )
+
+
+class LoadZoneRoutesTest(unittest.TestCase):
+
+    def test_sections(self):
+        index = load_zone_routes({
+            "dns_ispconfig_ddns_token": "ignored",
+            "example.com": {"token": "token-com"},
+            "customer": {"endpoint": "http://panel-b/", "token": "token-b",
+                         "zones": "example.org, example.net"},
+            "listed": {"token": "token-l", "zones": ["a.example", " "]},
+        }, TEST_ENDPOINT)
+
+        self.assertEqual(4, len(index))
+        self.assertEqual(
+            ("example.com", Route(TEST_ENDPOINT, "token-com")),
+            index.lookup("_acme-challenge.example.com")
+        )
+        self.assertEqual(
+            ("example.net", Route("http://panel-b", "token-b")),
+            index.lookup("_acme-challenge.example.net")
+        )
+        self.assertEqual(
+            Route(TEST_ENDPOINT, "token-l"), index.lookup("a.example")[1]
+        )
+
+    def test_missing_token(self):
+        with self.assertRaises(errors.PluginError):
+            load_zone_routes({"example.com": {}}, TEST_ENDPOINT)
+
+    def test_no_sections(self):
+        self.assertEqual(0, len(load_zone_routes({"a": "b"}, None)))
+
+
+if __name__ == "__main__":
+    unittest.main()  # pragma: no cover